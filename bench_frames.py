@@ -0,0 +1,281 @@
+"""
+bench_frames.py
+
+Бенчмарк рендера рамок (frame_render) на локальных данных — без Telegram, Google Sheets и сети.
+
+Карточки-фикстуры генерируются во временный каталог (JPEG/PNG разных размеров, как в Drive),
+фоны — настоящие 10.png / 11.png / 12.png из репозитория. Прогоняются все наборы из FRAME_SLOTS,
+для каждой комбинации:
+  - кэш: cold (фоны, плитки и холсты пусты в начале сценария — сброс один раз до постановки задач,
+    первые рендеры платят за загрузку) / warm (всё прогрето);
+  - профиль: RENDER_PROFILES (preview / final / png);
+  - исполнение: thread (пул потоков в этом процессе) / process (пул процессов, как у RENDERER);
+  - конкурентность: 1 / 5 / 50 одновременных рендеров.
+Отчёт: p50 / p95 / p99 задержки, пропускная способность (рендеров/сек) и пиковый RSS (процесс + воркеры,
+без прогрева).
+
+Замеряется CPU-стадия frame_render._compose_and_encode в собственных пулах бенчмарка, а не
+frame_render.RENDERER: без его affinity по пользователю, инкрементальной перерисовки и запасного
+пути через потоки.
+
+Примеры:
+    python bench_frames.py
+    python bench_frames.py --profiles final --modes process --concurrency 1,50 --renders 200
+    python bench_frames.py --json bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from PIL import Image, ImageDraw
+
+import frame_render
+
+CARD_COUNT = 24
+
+
+def make_fixture_cards(path, count=CARD_COUNT, seed=1):
+    """Сгенерировать count картинок-карточек; возвращает {card_id: путь}."""
+    rnd = random.Random(seed)
+    cards = {}
+    for card_id in range(1, count + 1):
+        w, h = rnd.choice([(600, 800), (900, 1200), (1080, 1350), (512, 512)])
+        img = Image.new("RGB", (w, h), (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x0, y0 = rnd.randrange(w), rnd.randrange(h)
+            x1, y1 = x0 + rnd.randrange(20, w // 2), y0 + rnd.randrange(20, h // 2)
+            draw.ellipse((x0, y0, x1, y1), fill=(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        # часть карточек — PNG с альфой, как бывает в каталоге
+        if card_id % 4 == 0:
+            fn = os.path.join(path, f"card_{card_id}.png")
+            img.convert("RGBA").save(fn, format="PNG")
+        else:
+            fn = os.path.join(path, f"card_{card_id}.jpg")
+            img.save(fn, format="JPEG", quality=90)
+        cards[card_id] = fn
+    return cards
+
+
+def make_specs(frame_sets, cards, count=32, seed=2):
+    """Набор рамок для прогона: случайные карточки по слотам, иногда пустые слоты."""
+    rnd = random.Random(seed)
+    ids = list(cards.keys())
+    specs = []
+    for i in range(count):
+        frame_set = frame_sets[i % len(frame_sets)]
+        slots = tuple(rnd.choice(ids) if rnd.random() > 0.15 else 0 for _ in range(5))
+        specs.append(frame_render.FrameSpec(frame_set, slots))
+    return specs
+
+
+SCOPE_NOTE = ("замеряется frame_render._compose_and_encode в пулах бенчмарка, не RENDERER "
+              "(без affinity, инкрементальной перерисовки и запасного пути через потоки)")
+
+
+def _reset_caches():
+    frame_render.TILES.clear()
+    frame_render.CANVASES.clear()
+    with frame_render._BG_LOCK:
+        frame_render._BACKGROUNDS.clear()
+
+
+def _cold_worker_init():
+    # воркер для cold-сценария: свежий процесс без предзагрузки фонов
+    frame_render.logger.disabled = True
+
+
+def bench_job(frame_set, sources, card_ids, profile):
+    """Один рендер (в потоке или в воркере): -> (мс, байт)."""
+    t0 = time.perf_counter()
+    out, _, _ = frame_render._compose_and_encode(frame_set, sources, None, card_ids, profile)
+    return (time.perf_counter() - t0) * 1000, out.getbuffer().nbytes
+
+
+# ------------------ RSS ------------------
+
+def _rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except Exception:
+        pass
+    return 0
+
+
+class RssSampler:
+    """Пиковый суммарный RSS процесса и воркеров пула (Linux /proc; иначе — ru_maxrss процесса)."""
+
+    def __init__(self, pids_fn=lambda: [], interval=0.02):
+        self.pids_fn = pids_fn
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        if self.peak_kb == 0:
+            try:
+                import resource
+                self.peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            except Exception:
+                pass
+
+    def _run(self):
+        while not self._stop.is_set():
+            total = _rss_kb(os.getpid()) + sum(_rss_kb(p) for p in self.pids_fn())
+            self.peak_kb = max(self.peak_kb, total)
+            self._stop.wait(self.interval)
+
+
+# ------------------ Прогон ------------------
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+async def run_scenario(executor, specs, cards, profile, concurrency, renders):
+    """renders рендеров, не более concurrency одновременно. Задержка — с момента постановки в очередь."""
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    sizes = []
+
+    async def _one(i):
+        spec = specs[i % len(specs)]
+        sources = [cards.get(cid) for cid in spec.slot_card_ids]
+        async with sem:
+            t0 = time.perf_counter()
+            _, size = await loop.run_in_executor(executor, bench_job, spec.frame_set, sources,
+                                                 list(spec.slot_card_ids), profile)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            sizes.append(size)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(_one(i) for i in range(renders)))
+    wall = time.perf_counter() - t0
+    return {
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "throughput_rps": round(renders / wall, 1) if wall > 0 else 0.0,
+        "avg_kb": round(sum(sizes) / len(sizes) / 1024, 1) if sizes else 0.0,
+    }
+
+
+def _make_executor(mode, workers, cold=False):
+    """Новый пул на каждый сценарий. cold + process — воркеры без предзагрузки фонов (кэши пусты)."""
+    if mode == "process":
+        # обычный spawn: задачи (bench_job) определены в этом скрипте, а он сам импортирует только frame_render
+        ctx = multiprocessing.get_context("spawn")
+        init = _cold_worker_init if cold else frame_render._worker_init
+        return ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=init)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def _warm_executor(executor, mode, workers):
+    # поднять все процессы заранее — время spawn не должно попадать в замер
+    if mode == "process":
+        for f in [executor.submit(frame_render._worker_ping) for _ in range(workers)]:
+            f.result(timeout=60)
+
+
+def _worker_pids(executor):
+    procs = getattr(executor, "_processes", None) or {}
+    return list(procs.keys())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк рендера рамок")
+    parser.add_argument("--sets", default=",".join(str(k) for k in frame_render.FRAME_SLOTS),
+                        help="наборы фонов через запятую (по умолчанию все из FRAME_SLOTS)")
+    parser.add_argument("--profiles", default=",".join(frame_render.RENDER_PROFILES))
+    parser.add_argument("--modes", default="thread,process")
+    parser.add_argument("--caches", default="cold,warm")
+    parser.add_argument("--concurrency", default="1,5,50")
+    parser.add_argument("--renders", type=int, default=100, help="рендеров на сценарий (не меньше конкурентности)")
+    parser.add_argument("--workers", type=int, default=max(2, frame_render.FRAME_RENDER_PROCESSES),
+                        help="потоков / процессов в пуле")
+    parser.add_argument("--json", default=None, help="сохранить результаты в JSON")
+    args = parser.parse_args(argv)
+
+    frame_sets = [int(x) for x in args.sets.split(",") if x.strip()]
+    profiles = [x.strip() for x in args.profiles.split(",") if x.strip()]
+    modes = [x.strip() for x in args.modes.split(",") if x.strip()]
+    caches = [x.strip() for x in args.caches.split(",") if x.strip()]
+    levels = [int(x) for x in args.concurrency.split(",") if x.strip()]
+
+    # логи рендера внутри замеров не нужны
+    frame_render.logger.disabled = True
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_frames_") as tmp:
+        cards = make_fixture_cards(tmp)
+        specs = make_specs(frame_sets, cards)
+        print(f"fixtures: {len(cards)} cards, {len(specs)} frames, sets={frame_sets}, workers={args.workers}")
+        print(f"note: {SCOPE_NOTE}")
+        header = f"{'mode':8} {'cache':5} {'profile':8} {'conc':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'rps':>7} {'KB':>7} {'peakRSS':>9}"
+        print(header)
+        print("-" * len(header))
+
+        for mode in modes:
+            for cache in caches:
+                for profile in profiles:
+                    for conc in levels:
+                        executor = _make_executor(mode, args.workers, cold=cache == "cold")
+                        try:
+                            _warm_executor(executor, mode, args.workers)
+                            renders = max(args.renders, conc)
+                            if cache == "warm":
+                                # прогрев: каждая рамка по разу (в каждом воркере хотя бы часть)
+                                asyncio.run(run_scenario(executor, specs, cards, profile,
+                                                         args.workers, len(specs) * args.workers))
+                            else:
+                                # один раз до постановки задач: сброс посреди сценария выбивал бы кэши
+                                # у параллельных рендеров (в process-режиме воркеры и так свежие)
+                                _reset_caches()
+                            # RSS — только за сам замер, без прогрева
+                            with RssSampler(lambda: _worker_pids(executor)) as rss:
+                                stats = asyncio.run(run_scenario(executor, specs, cards, profile, conc, renders))
+                        finally:
+                            executor.shutdown(wait=True)
+                        row = {"mode": mode, "cache": cache, "profile": profile, "concurrency": conc,
+                               "renders": renders, "peak_rss_mb": round(rss.peak_kb / 1024, 1), **stats}
+                        results.append(row)
+                        print(f"{mode:8} {cache:5} {profile:8} {conc:>4} {stats['p50_ms']:>8} {stats['p95_ms']:>8} "
+                              f"{stats['p99_ms']:>8} {stats['throughput_rps']:>7} {stats['avg_kb']:>7} "
+                              f"{row['peak_rss_mb']:>8}M")
+                        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"saved: {args.json}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
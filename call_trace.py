@@ -0,0 +1,177 @@
+"""
+call_trace.py
+
+Бюджет внешних вызовов на апдейт: каждый вызов Google Sheets, Bot API и скачивание картинки
+приписывается апдейту (и его маршруту — префиксу callback_data / команде), который его вызвал.
+- UpdateTrace живёт в contextvars: задачи asyncio наследуют его сами, потоки executor — через
+  ContextThreadPoolExecutor (ставится как executor по умолчанию в post_init);
+- по завершении апдейта в лог пишется сводка: число вызовов, байты и время по видам и операциям;
+  после stop() трасса закрыта: фоновые задачи (app.create_task), унаследовавшие её, больше ничего не дописывают;
+- TRACER хранит агрегаты по маршрутам: top(n) — самые дорогие маршруты (для /routes и разбора, где оптимизировать).
+"""
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+TRACE_LOG_MIN_CALLS = int(os.environ.get("TRACE_LOG_MIN_CALLS", "1"))      # не логировать апдейты без внешних вызовов
+TRACE_SHEETS_BUDGET = int(os.environ.get("TRACE_SHEETS_BUDGET", "10"))     # больше — сводка уровнем WARNING
+TRACE_ROUTES_MAX = int(os.environ.get("TRACE_ROUTES_MAX", "500"))
+
+KINDS = ("sheets", "bot", "download")
+
+_CURRENT = contextvars.ContextVar("call_trace", default=None)
+
+
+class UpdateTrace:
+    """Вызовы одного апдейта. record() может приходить из потоков executor — под lock; после finish() — игнорируется."""
+
+    def __init__(self, route, update_id=None, user_id=None):
+        self.route = route
+        self.update_id = update_id
+        self.user_id = user_id
+        self.t0 = time.perf_counter()
+        self.wall_ms = 0.0
+        self.closed = False
+        self.late = 0                   # вызовы после закрытия (фоновые задачи апдейта) — не учитываются
+        self._lock = threading.Lock()
+        self.calls = {k: 0 for k in KINDS}
+        self.ms = {k: 0.0 for k in KINDS}
+        self.bytes = {k: 0 for k in KINDS}
+        self.ops = Counter()
+
+    def record(self, kind, op, seconds, nbytes=0):
+        with self._lock:
+            if self.closed:
+                self.late += 1
+                return
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.ms[kind] = self.ms.get(kind, 0.0) + seconds * 1000
+            self.bytes[kind] = self.bytes.get(kind, 0) + (nbytes or 0)
+            self.ops[f"{kind}.{op}"] += 1
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def finish(self):
+        with self._lock:
+            self.closed = True
+        self.wall_ms = (time.perf_counter() - self.t0) * 1000
+        return self
+
+    def summary(self) -> str:
+        parts = []
+        for k in KINDS:
+            if self.calls.get(k):
+                parts.append(f"{k} {self.calls[k]} ({self.ms[k]:.0f} ms, {self.bytes[k] // 1024} KB)")
+        ops = ", ".join(f"{op}×{n}" for op, n in self.ops.most_common(8))
+        return (f"update {self.update_id} [{self.route}] user={self.user_id}: {self.wall_ms:.0f} ms; "
+                + "; ".join(parts) + (f" | {ops}" if ops else ""))
+
+
+def current():
+    return _CURRENT.get()
+
+
+def record(kind, op, seconds, nbytes=0):
+    """Приписать вызов текущему апдейту (вне апдейта — ничего не делает)."""
+    trace = _CURRENT.get()
+    if trace is not None:
+        trace.record(kind, op, seconds, nbytes)
+
+
+class _RouteStats:
+    __slots__ = ("count", "calls", "ms", "bytes", "wall_ms", "max_calls", "max_wall_ms")
+
+    def __init__(self):
+        self.count = 0
+        self.calls = Counter()
+        self.ms = Counter()
+        self.bytes = Counter()
+        self.wall_ms = 0.0
+        self.max_calls = 0
+        self.max_wall_ms = 0.0
+
+
+class Tracer:
+    """Агрегаты по маршрутам: сколько внешних вызовов в среднем стоит один апдейт маршрута."""
+
+    def __init__(self, max_routes=TRACE_ROUTES_MAX):
+        self.max_routes = max_routes
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def start(self, route, update_id=None, user_id=None):
+        """Начать трассировку апдейта: (trace, token для stop)."""
+        trace = UpdateTrace(route, update_id, user_id)
+        return trace, _CURRENT.set(trace)
+
+    def stop(self, trace, token):
+        _CURRENT.reset(token)
+        trace.finish()
+        self._add(trace)
+        if trace.total_calls >= TRACE_LOG_MIN_CALLS:
+            level = logging.WARNING if trace.calls.get("sheets", 0) > TRACE_SHEETS_BUDGET else logging.INFO
+            logger.log(level, "trace %s", trace.summary())
+
+    def _add(self, trace):
+        with self._lock:
+            st = self._routes.get(trace.route)
+            if st is None:
+                if len(self._routes) >= self.max_routes:
+                    return
+                st = self._routes[trace.route] = _RouteStats()
+            st.count += 1
+            st.calls.update(trace.calls)
+            st.ms.update({k: v for k, v in trace.ms.items()})
+            st.bytes.update(trace.bytes)
+            st.wall_ms += trace.wall_ms
+            st.max_calls = max(st.max_calls, trace.total_calls)
+            st.max_wall_ms = max(st.max_wall_ms, trace.wall_ms)
+
+    def top(self, n=10, by="sheets"):
+        """
+        n самых дорогих маршрутов. by: вид вызова (sheets / bot / download) — по суммарному числу вызовов,
+        или "wall" — по суммарному времени апдейтов.
+        """
+        with self._lock:
+            rows = []
+            for route, st in self._routes.items():
+                c = st.count or 1
+                rows.append({
+                    "route": route,
+                    "updates": st.count,
+                    "avg_wall_ms": round(st.wall_ms / c, 1),
+                    "max_wall_ms": round(st.max_wall_ms, 1),
+                    "max_calls": st.max_calls,
+                    **{f"avg_{k}_calls": round(st.calls[k] / c, 2) for k in KINDS},
+                    **{f"avg_{k}_ms": round(st.ms[k] / c, 1) for k in KINDS},
+                    **{f"total_{k}_calls": st.calls[k] for k in KINDS},
+                    "total_kb": sum(st.bytes.values()) // 1024,
+                    "_wall": st.wall_ms,
+                })
+        key = (lambda r: r["_wall"]) if by == "wall" else (lambda r: r.get(f"total_{by}_calls", 0))
+        rows.sort(key=key, reverse=True)
+        for r in rows:
+            r.pop("_wall", None)
+        return rows[:n]
+
+
+TRACER = Tracer()
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor, который запускает задачу в копии contextvars вызывающего
+    (loop.run_in_executor сам контекст не переносит) — вызовы Sheets в потоках попадают в трассу апдейта.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        ctx = contextvars.copy_context()
+        return super().submit(ctx.run, fn, *args, **kwargs)
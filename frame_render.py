@@ -0,0 +1,808 @@
+# frame_render.py
+# CPU-часть рендера рамки: фон + вставка уже скачанных карточек в слоты + encode.
+# Модуль не ходит ни в Telegram, ни в Google Sheets, ни в сеть — его импортируют воркеры пула рендера.
+import asyncio
+import importlib
+import logging
+import mmap
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import List, NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+import metrics
+
+logger = logging.getLogger(__name__)
+FRAME_DEBUG = False
+
+# ------------------ Настройки рамки (настройте под себя) ------------------
+BG_WIDTH = 1280
+BG_HEIGHT = 800
+
+# Словарь слотов рамки для каждого фона
+FRAME_SLOTS = {
+    10: [  # фон 10
+        {"x":  83, "y": 102, "w": 237, "h": 268},
+        {"x": 405, "y": 102, "w": 238, "h": 268},
+        {"x": 718, "y": 102, "w": 239, "h": 268},
+        {"x": 236, "y": 458, "w": 235, "h": 268},
+        {"x": 554, "y": 458, "w": 235, "h": 268},
+    ],
+    11: [  # фон 11 (замените на реальные координаты)
+        {"x":  83, "y": 102, "w": 237, "h": 268},
+        {"x": 405, "y": 102, "w": 238, "h": 268},
+        {"x": 718, "y": 102, "w": 239, "h": 268},
+        {"x": 236, "y": 458, "w": 235, "h": 268},
+        {"x": 554, "y": 458, "w": 235, "h": 268},
+    ],
+    12: [  # фон 12
+        {"x":  95, "y": 102, "w": 236, "h": 268},
+        {"x": 416, "y": 102, "w": 238, "h": 268},
+        {"x": 728, "y": 102, "w": 238, "h": 268},
+        {"x": 245, "y": 457, "w": 238, "h": 269},
+        {"x": 564, "y": 457, "w": 235, "h": 269},
+    ],
+}
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__)) or "."
+
+# кэш готовых к вставке плиток (card_id, w, h) -> RGB; ~190 КБ на плитку слота
+TILE_CACHE_MAX = int(os.environ.get("TILE_CACHE_MAX", "256"))
+
+# ------------------ Профили рендера ------------------
+# format — формат файла для Telegram (он всё равно пережимает в JPEG, PNG 1280x800 — самый медленный и тяжёлый),
+# resample — фильтр вписывания карточек в слот, quality — качество JPEG/WebP.
+RENDER_PROFILES = {
+    # превью для подтверждения слота: уменьшенная копия (по умолчанию 640x400). resample тот же, что у final, —
+    # плитки и холст общие, и полный рендер после подтверждения попадает в кэш холстов
+    "preview": {
+        "format": "JPEG",
+        "quality": 80,
+        "resample": Image.LANCZOS,
+        "size": (int(os.environ.get("FRAME_PREVIEW_WIDTH", "640")), int(os.environ.get("FRAME_PREVIEW_HEIGHT", "400"))),
+    },
+    "final": {
+        "format": os.environ.get("FRAME_FINAL_FORMAT", "JPEG").upper(),
+        "quality": int(os.environ.get("FRAME_FINAL_QUALITY", "92")),
+        "resample": Image.LANCZOS,
+    },
+    "png": {"format": "PNG", "compress_level": 6, "resample": Image.LANCZOS},
+}
+DEFAULT_PROFILE = os.environ.get("FRAME_PROFILE", "final")
+
+_EXT = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}
+
+
+def get_profile(profile=None) -> dict:
+    name = profile or DEFAULT_PROFILE
+    if name not in RENDER_PROFILES:
+        logger.warning("Неизвестный профиль рендера %s — используем final", name)
+        name = "final"
+    return RENDER_PROFILES[name]
+
+
+class RenderStats:
+    """Время рендера по профилям: композиция и кодирование отдельно, плюс размер результата."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def add(self, profile, compose_ms, encode_ms, size):
+        with self._lock:
+            st = self._data.setdefault(profile, {"count": 0, "compose_ms": 0.0, "encode_ms": 0.0, "max_ms": 0.0, "bytes": 0})
+            st["count"] += 1
+            st["compose_ms"] += compose_ms
+            st["encode_ms"] += encode_ms
+            st["max_ms"] = max(st["max_ms"], compose_ms + encode_ms)
+            st["bytes"] += size
+
+    def summary(self):
+        """profile -> средние значения (мс, байты)."""
+        with self._lock:
+            out = {}
+            for name, st in self._data.items():
+                n = st["count"] or 1
+                out[name] = {
+                    "count": st["count"],
+                    "avg_compose_ms": round(st["compose_ms"] / n, 1),
+                    "avg_encode_ms": round(st["encode_ms"] / n, 1),
+                    "max_ms": round(st["max_ms"], 1),
+                    "avg_kb": round(st["bytes"] / n / 1024, 1),
+                }
+            return out
+
+
+RENDER_STATS = RenderStats()
+
+
+class FrameSpec(NamedTuple):
+    """Всё, от чего зависит картинка рамки: набор фона и id карточек по слотам (0 — пусто)."""
+    frame_set: int
+    slot_card_ids: Tuple[int, ...]
+
+
+def get_frame_slots(frame_set: int):
+    return FRAME_SLOTS.get(frame_set, FRAME_SLOTS.get(10))
+
+
+def _find_background_path(frame_set: int) -> Optional[str]:
+    candidates = [
+        os.path.join(BASE_DIR, f"{frame_set}.png"),
+        os.path.join(BASE_DIR, "assets", f"{frame_set}.png"),
+        os.path.join(BASE_DIR, "assets", str(frame_set) + ".PNG"),
+        os.path.join(BASE_DIR, f"{frame_set}.PNG"),
+    ]
+    for p in candidates:
+        if p and os.path.isfile(p):
+            return p
+    return None
+
+
+def _load_background(frame_set: int, log_info=None) -> Optional[Image.Image]:
+    """
+    attempts to load <FRAME_SET>.png (or assets/<FRAME_SET>.png)
+    and forces it to BG_WIDTH x BG_HEIGHT using ImageOps.fit (guarantees exact size)
+    """
+    log_info = log_info or (lambda s: None)
+    bg_img = None
+    try:
+        found_path = _find_background_path(frame_set)
+        if found_path:
+            log_info(f"Found background file: {found_path}")
+            bg_img = Image.open(found_path)
+            log_info(f"Original bg size: {bg_img.size}, mode={bg_img.mode}")
+            # convert to RGBA (to preserve alpha) then fit to exact size
+            try:
+                bg_img = bg_img.convert("RGBA")
+            except Exception:
+                bg_img = bg_img.convert("RGB").convert("RGBA")
+            # force-fit to exact BG_WIDTH x BG_HEIGHT (this crops/pads as needed)
+            if bg_img.size != (int(BG_WIDTH), int(BG_HEIGHT)):
+                try:
+                    bg_img = ImageOps.fit(bg_img, (int(BG_WIDTH), int(BG_HEIGHT)), method=Image.LANCZOS)
+                    log_info(f"Bg after fit size: {bg_img.size}")
+                except Exception as e:
+                    logger.exception("ImageOps.fit failed: %s", e)
+                    # fallback to simple resize
+                    try:
+                        bg_img = bg_img.resize((int(BG_WIDTH), int(BG_HEIGHT)), Image.LANCZOS)
+                        log_info(f"Bg after resize size: {bg_img.size}")
+                    except Exception as e2:
+                        logger.exception("Fallback resize failed: %s", e2)
+                        bg_img = None
+        else:
+            log_info(f"No background file found for frame {frame_set}")
+    except Exception as e:
+        logger.exception("Ошибка при загрузке фона: %s", e)
+        bg_img = None
+    return bg_img
+
+
+# ------------------ Предзагруженные фоны ------------------
+# frame_set -> готовая база BG_WIDTH x BG_HEIGHT (RGB, либо RGBX поверх mmap-файла).
+# Каждый рендер начинает с копии базы; новый фон = строка в FRAME_SLOTS + файл <set>.png.
+
+FRAME_BG_RAW_CACHE = os.environ.get("FRAME_BG_RAW_CACHE", "0") == "1"
+BG_CACHE_DIR = os.environ.get("FRAME_BG_CACHE_DIR") or os.path.join(
+    os.environ.get("MEDIA_CACHE_DIR") or os.path.join(BASE_DIR, ".cache"), "bg")
+
+_BACKGROUNDS = {}
+_BG_MMAPS = {}
+_BG_LOCK = threading.Lock()
+
+
+def _raw_cache_path(frame_set: int, src_path: str) -> str:
+    st = os.stat(src_path)
+    return os.path.join(BG_CACHE_DIR, f"{frame_set}-{int(st.st_mtime)}-{st.st_size}-{BG_WIDTH}x{BG_HEIGHT}.rgbx")
+
+
+def _load_background_raw_cached(frame_set: int) -> Optional[Image.Image]:
+    """
+    База из сырого RGBX-файла через mmap: без декодирования PNG и без fit.
+    Файл пересобирается, если поменялся исходник (mtime/size в имени).
+    """
+    src = _find_background_path(frame_set)
+    if not src:
+        return None
+    raw_path = _raw_cache_path(frame_set, src)
+    size = (int(BG_WIDTH), int(BG_HEIGHT))
+    if not os.path.isfile(raw_path):
+        bg = _load_background(frame_set)
+        if bg is None:
+            return None
+        os.makedirs(BG_CACHE_DIR, exist_ok=True)
+        tmp = f"{raw_path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(bg.convert("RGB").convert("RGBX").tobytes())
+        os.replace(tmp, raw_path)
+    with open(raw_path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) != size[0] * size[1] * 4:
+        mm.close()
+        os.remove(raw_path)
+        return _load_background_raw_cached(frame_set)
+    _BG_MMAPS[frame_set] = mm
+    return Image.frombuffer("RGBX", size, mm, "raw", "RGBX", 0, 1)
+
+
+def _load_base(frame_set: int) -> Optional[Image.Image]:
+    if FRAME_BG_RAW_CACHE:
+        try:
+            return _load_background_raw_cached(frame_set)
+        except Exception:
+            logger.exception("raw-кэш фона %s не сработал, грузим PNG", frame_set)
+    bg = _load_background(frame_set)
+    if bg is None:
+        return None
+    base = bg.convert("RGB")
+    base.load()
+    return base
+
+
+def preload_backgrounds(frame_sets=None) -> int:
+    """Загрузить фоны всех наборов из FRAME_SLOTS (вызывается при старте). Возвращает число загруженных."""
+    loaded = 0
+    for frame_set in (frame_sets or list(FRAME_SLOTS.keys())):
+        if get_background_base(frame_set) is not None:
+            loaded += 1
+    logger.info("frame backgrounds preloaded: %d", loaded)
+    return loaded
+
+
+def get_background_base(frame_set: int) -> Optional[Image.Image]:
+    """Общая (только для чтения!) база фона; грузится один раз."""
+    base = _BACKGROUNDS.get(frame_set)
+    if base is not None or frame_set in _BACKGROUNDS:
+        return base
+    with _BG_LOCK:
+        if frame_set not in _BACKGROUNDS:
+            _BACKGROUNDS[frame_set] = _load_base(frame_set)
+        return _BACKGROUNDS[frame_set]
+
+
+def new_frame_canvas(frame_set: int) -> Image.Image:
+    """Свежий RGB-холст для рендера: копия предзагруженного фона или белый лист."""
+    base = get_background_base(frame_set)
+    if base is None:
+        return Image.new("RGB", (int(BG_WIDTH), int(BG_HEIGHT)), "white")
+    if base.mode == "RGB":
+        return base.copy()
+    return base.convert("RGB")
+
+
+def _card_tile(content: bytes, w: int, h: int, resample=Image.LANCZOS) -> Optional[Image.Image]:
+    """Декодирует картинку карточки, убирает альфу на белый фон и вписывает в слот w x h."""
+    try:
+        img = Image.open(BytesIO(content))
+        if img.format == "JPEG":
+            # JPEG умеет декодироваться сразу в 1/2, 1/4, 1/8 — не меньше слота
+            img.draft("RGB", (w, h))
+    except Exception as e:
+        logger.warning("Failed to decode card image: %s", e)
+        return None
+
+    try:
+        if img.mode in ("RGBA", "LA"):
+            bg = Image.new("RGBA", img.size, (255,255,255,255))
+            bg.paste(img, (0,0), img)
+            img = bg.convert("RGB")
+        else:
+            img = img.convert("RGB")
+    except Exception:
+        try:
+            img = img.convert("RGB")
+        except Exception:
+            logger.exception("Failed to convert card image")
+            return None
+
+    try:
+        return ImageOps.fit(img, (w, h), method=resample)
+    except Exception:
+        try:
+            return img.resize((w, h))
+        except Exception:
+            logger.exception("Failed to resize card img")
+            return None
+
+
+def _source_fingerprint(src):
+    """
+    Дешёвый отпечаток источника плитки. Путь к файлу дискового кэша — (путь, inode, размер) из stat,
+    без чтения файла: новая версия картинки пишется через os.replace (новый inode), а mtime
+    не подходит — кэш трогает его при каждом попадании (LRU). bytes — crc32 (запасной путь).
+    None — файла нет.
+    """
+    if isinstance(src, (bytes, bytearray)):
+        return ("crc32", zlib.crc32(src))
+    try:
+        st = os.stat(src)
+    except OSError:
+        return None
+    return (src, st.st_ino, st.st_size)
+
+
+class TileCache:
+    """
+    LRU-кэш плиток карточек, уже приведённых к RGB и вписанных в слот: (card_id, w, h, resample) -> Image.
+    Рядом хранится отпечаток источника (_source_fingerprint) — если картинка карточки поменялась,
+    плитка пересобирается. Источник (bytes или путь к файлу) читается только при промахе.
+    Потокобезопасен (рендер идёт в executor).
+    """
+
+    def __init__(self, max_items=TILE_CACHE_MAX):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_tile(self, card_id, src, w: int, h: int, resample=Image.LANCZOS) -> Optional[Image.Image]:
+        """src — bytes карточки или путь к файлу дискового кэша. None — источника нет или он битый."""
+        if not card_id or self.max_items <= 0:
+            content = _read_source(src)
+            return _card_tile(content, w, h, resample) if content else None
+        key = (card_id, w, h, resample)
+        fp = _source_fingerprint(src)
+        if fp is None:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == fp:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        content = _read_source(src)
+        if not content:
+            return None
+        tile = _card_tile(content, w, h, resample)
+        if tile is None:
+            return None
+        with self._lock:
+            self._data[key] = (fp, tile)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+        return tile
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"items": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+TILES = TileCache()
+
+
+# последние собранные холсты (до кодирования): ~3 МБ на холст 1280x800 RGB
+CANVAS_CACHE_MAX = int(os.environ.get("CANVAS_CACHE_MAX", "8"))
+
+
+class CanvasCache:
+    """
+    LRU-кэш собранных холстов: (frame_set, id по слотам, resample) -> (отпечатки источников по слотам, Image).
+    Нужен для инкрементального рендера: при смене одного слота берём копию прошлого холста
+    и перерисовываем только изменившиеся слоты. Отпечатки (_source_fingerprint) — как у TileCache:
+    если картинка карточки поменялась (каталог перечитан), холст не отдаётся как есть, а её слот перерисовывается.
+    Кэшируются только полностью собранные холсты. Холсты из кэша не изменяются — только копируются.
+    """
+
+    def __init__(self, max_items=CANVAS_CACHE_MAX):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.partial = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(frame_set, card_ids, resample):
+        if not card_ids:
+            return None
+        return (int(frame_set), tuple(int(i or 0) for i in card_ids), resample)
+
+    def get(self, key):
+        """(отпечатки по слотам, Image) или None."""
+        if key is None or self.max_items <= 0:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def count(self, outcome):
+        """Учесть исход поиска холста: "hits", "partial" или "misses" (рендеры идут в потоках — под lock)."""
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def put(self, key, img, fingerprints):
+        if key is None or self.max_items <= 0:
+            return
+        with self._lock:
+            self._data[key] = (tuple(fingerprints), img)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"items": len(self._data), "hits": self.hits, "partial": self.partial, "misses": self.misses}
+
+
+CANVASES = CanvasCache()
+
+
+def encode_frame(frame_img: Image.Image, profile=None) -> BytesIO:
+    """Кодирует холст по профилю; у результата выставлен .name (frame.jpg / .webp / .png).
+    Если у профиля задан size — кодируется уменьшенная копия (сам холст не меняется)."""
+    prof = get_profile(profile)
+    fmt = prof.get("format", "JPEG")
+    size = prof.get("size")
+    if size and tuple(size) != frame_img.size:
+        w, h = frame_img.size
+        if w % size[0] == 0 and h % size[1] == 0 and w // size[0] == h // size[1]:
+            # целый коэффициент (1280x800 -> 640x400): reduce заметно быстрее resize
+            frame_img = frame_img.reduce(w // size[0])
+        else:
+            frame_img = frame_img.resize(tuple(size), Image.BILINEAR, reducing_gap=2.0)
+    out = BytesIO()
+    try:
+        if fmt == "PNG":
+            frame_img.save(out, format="PNG", compress_level=prof.get("compress_level", 6))
+        elif fmt == "WEBP":
+            frame_img.save(out, format="WEBP", quality=prof.get("quality", 90), method=4)
+        else:
+            fmt = "JPEG"
+            frame_img.save(out, format="JPEG", quality=prof.get("quality", 90), optimize=False, subsampling=0 if prof.get("quality", 90) >= 90 else 2)
+    except Exception:
+        logger.exception("Не удалось закодировать рамку в %s — сохраняем PNG", fmt)
+        fmt = "PNG"
+        out = BytesIO()
+        try:
+            frame_img.convert("RGB").save(out, format="PNG")
+        except Exception:
+            logger.exception("Не удалось сохранить итоговое изображение")
+    out.name = f"frame.{_EXT.get(fmt, 'png')}"
+    out.seek(0)
+    return out
+
+
+def _read_source(src) -> Optional[bytes]:
+    """Источник картинки слота: bytes как есть, str — путь к файлу дискового кэша."""
+    if not src or isinstance(src, (bytes, bytearray)):
+        return src or None
+    try:
+        with open(src, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        logger.warning("Card image vanished from cache: %s", src)
+    except Exception:
+        logger.exception("Failed to read card image %s", src)
+    return None
+
+
+def _slot_box(slot):
+    x = int(slot.get("x", 0))
+    y = int(slot.get("y", 0))
+    w = int(slot.get("w", 0))
+    h = int(slot.get("h", 0))
+    return x, y, w, h
+
+
+def _id_at(ids, idx):
+    try:
+        return int(ids[idx] or 0) if ids and idx < len(ids) else 0
+    except Exception:
+        return 0
+
+
+def _restore_slot_background(frame_img: Image.Image, frame_set: int, x: int, y: int, w: int, h: int):
+    """Вернуть в слот исходный фон (перед вставкой новой карточки или если слот очищен)."""
+    base = get_background_base(frame_set)
+    if base is None:
+        frame_img.paste((255, 255, 255), (x, y, x + w, y + h))
+        return
+    patch = base.crop((x, y, x + w, y + h))
+    frame_img.paste(patch if patch.mode == "RGB" else patch.convert("RGB"), (x, y))
+
+
+def _compose_and_encode(frame_set: int, images, debug_tag=None, card_ids=None, profile=None, base_ids=None):
+    """
+    Возвращает (BytesIO, compose_ms, encode_ms). images[i] — bytes, путь к файлу или None.
+    base_ids — id слотов прошлой рамки этого пользователя: если её холст (тот же frame_set) ещё в CANVASES,
+    перерисовываются только изменившиеся слоты (другой id или другая картинка карточки).
+    Смена фона — всегда полная сборка.
+    """
+    profile = profile or DEFAULT_PROFILE
+    resample = get_profile(profile).get("resample", Image.LANCZOS)
+    t0 = time.perf_counter()
+    # info_lines собираются только если FRAME_DEBUG включён
+    info_lines = [] if FRAME_DEBUG else None
+
+    def log_info(s):
+        # Если отладка включена — записываем в info_lines и (по желанию) логируем через logger.info
+        if not FRAME_DEBUG:
+            return
+        try:
+            logger.info(s)
+        except Exception:
+            pass
+        info_lines.append(str(s))
+
+    # pick slots
+    slots = get_frame_slots(frame_set)
+    log_info(f"Using {len(slots)} slots for frame {frame_set}")
+
+    # отпечатки источников по слотам (stat файла, без чтения) — холст с устаревшей картинкой не отдаём
+    fingerprints = tuple(_source_fingerprint(images[i]) if i < len(images) and images[i] else None
+                         for i in range(len(slots)))
+    canvas_key = CanvasCache.key(frame_set, card_ids, resample)
+    cached = CANVASES.get(canvas_key)
+    todo = []
+    if cached is not None and cached[0] == fingerprints:
+        frame_img = cached[1]
+        CANVASES.count("hits")
+        log_info(f"Canvas cache hit for frame {frame_set}")
+    else:
+        # основа: тот же набор id с поменявшейся картинкой карточки, иначе прошлая рамка пользователя
+        prev_ids = card_ids
+        if cached is None and base_ids:
+            cached = CANVASES.get(CanvasCache.key(frame_set, base_ids, resample))
+            prev_ids = base_ids
+        if cached is not None:
+            CANVASES.count("partial")
+            prev_fps, base_img = cached
+            frame_img = base_img.copy()
+            todo = [i for i in range(len(slots))
+                    if _id_at(card_ids, i) != _id_at(prev_ids, i) or fingerprints[i] != prev_fps[i]]
+            for idx in todo:
+                x, y, w, h = _slot_box(slots[idx])
+                if w > 0 and h > 0:
+                    _restore_slot_background(frame_img, frame_set, x, y, w, h)
+            log_info(f"Incremental render: slots {todo}")
+        else:
+            CANVASES.count("misses")
+            frame_img = new_frame_canvas(frame_set)
+            todo = list(range(len(slots)))
+            log_info(f"Canvas for frame {frame_set}: {frame_img.size}")
+
+    # paste cards
+    complete = True
+    for idx in todo:
+        slot = slots[idx]
+        card_id = card_ids[idx] if card_ids and idx < len(card_ids) else None
+        src = images[idx] if idx < len(images) else None
+        if not src:
+            if card_id:
+                complete = False
+            continue
+
+        # slot expected as dict with x,y,w,h
+        x, y, w, h = _slot_box(slot)
+        if w <= 0 or h <= 0:
+            logger.warning("Invalid slot size for frame %s slot %s", frame_set, slot)
+            continue
+
+        # файл читается только при промахе кэша плиток
+        tile = TILES.get_tile(card_id, src, w, h, resample)
+        if tile is None:
+            complete = False
+            continue
+
+        try:
+            frame_img.paste(tile, (x, y))
+        except Exception as e:
+            logger.exception("Failed to paste card into frame: %s", e)
+            complete = False
+            continue
+
+    if todo and complete:
+        CANVASES.put(canvas_key, frame_img, fingerprints)
+
+    # Save debug image and info next to module for inspection only if FRAME_DEBUG True
+    if FRAME_DEBUG:
+        try:
+            debug_name = os.path.join(BASE_DIR, f"debug_frame_{debug_tag}_{frame_set}.png")
+            frame_img.save(debug_name, format="PNG")
+            log_info(f"Saved debug framing image: {debug_name} size={frame_img.size}")
+            info_txt = os.path.join(BASE_DIR, f"debug_frame_{debug_tag}_{frame_set}.txt")
+            with open(info_txt, "w", encoding="utf-8") as f:
+                f.write("\n".join(info_lines or []))
+            log_info(f"Wrote debug info: {info_txt}")
+        except Exception:
+            logger.exception("Не удалось записать debug файлы")
+
+    t1 = time.perf_counter()
+    out = encode_frame(frame_img, profile)
+    t2 = time.perf_counter()
+    return out, (t1 - t0) * 1000, (t2 - t1) * 1000
+
+
+def _record_render(profile, frame_set, compose_ms, encode_ms, size):
+    profile = profile or DEFAULT_PROFILE
+    RENDER_STATS.add(profile, compose_ms, encode_ms, size)
+    metrics.FRAME_RENDER_SECONDS.observe(profile, "compose", value=compose_ms / 1000.0)
+    metrics.FRAME_RENDER_SECONDS.observe(profile, "encode", value=encode_ms / 1000.0)
+    metrics.FRAME_RENDER_BYTES.inc(profile, amount=size)
+    logger.info("frame render [%s] set=%s: compose %.0f ms, encode %.0f ms, %d KB",
+                profile, frame_set, compose_ms, encode_ms, size // 1024)
+
+
+def compose_frame(frame_set: int, images: List[Optional[bytes]], debug_tag=None, card_ids=None, profile=None) -> BytesIO:
+    """
+    CPU-стадия рендера (в текущем процессе): фон frame_set + images[i] в слот i.
+    images[i] — байты карточки, путь к файлу дискового кэша или None.
+    card_ids[i] (если переданы) — ключ для кэша готовых плиток TILES.
+    profile — имя из RENDER_PROFILES (по умолчанию FRAME_PROFILE).
+    Возвращает закодированную картинку в BytesIO.
+    """
+    out, compose_ms, encode_ms = _compose_and_encode(frame_set, images, debug_tag, card_ids, profile)
+    _record_render(profile, frame_set, compose_ms, encode_ms, out.getbuffer().nbytes)
+    return out
+
+
+# ------------------ Рендер в пуле процессов ------------------
+# Pillow (resize/encode) держит GIL лишь частично — в потоках рендеры мешают event loop и друг другу.
+# Воркеры стартуют заранее (spawn, импортируют только этот модуль) и сразу грузят фоны;
+# задача — маленький picklable набор (frame_set, пути к файлам кэша, id, профиль), ответ — байты.
+
+FRAME_RENDER_PROCESSES = int(os.environ.get("FRAME_RENDER_PROCESSES", "2"))  # 0 — рендер в пуле потоков
+
+# spawn исполняет в воркере «главный» модуль родителя как __mp_main__ — для бота это main.py
+# (winter, gspread, telegram, реестр кэшей). На время запуска процесса главным подставляется
+# frame_worker, который импортирует только этот модуль. Поэтому задачи для таких пулов —
+# только функции из importable-модулей (render_job и т.п.), не из __main__.
+WORKER_MAIN_MODULE = "frame_worker"
+_SPAWN = multiprocessing.get_context("spawn")
+_worker_main_lock = threading.Lock()
+
+
+class _WorkerProcess(_SPAWN.Process):
+    @staticmethod
+    def _Popen(process_obj):
+        worker_main = importlib.import_module(WORKER_MAIN_MODULE)
+        with _worker_main_lock:
+            saved = sys.modules["__main__"]
+            sys.modules["__main__"] = worker_main
+            try:
+                return _SPAWN.Process._Popen(process_obj)
+            finally:
+                sys.modules["__main__"] = saved
+
+
+class _WorkerContext(type(_SPAWN)):
+    Process = _WorkerProcess
+
+
+WORKER_CONTEXT = _WorkerContext()
+
+
+def _worker_init():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    preload_backgrounds()
+
+
+def _worker_ping():
+    return os.getpid()
+
+
+def render_job(frame_set: int, sources, card_ids=None, profile=None, debug_tag=None, base_ids=None):
+    """Точка входа воркера: -> (bytes, filename, compose_ms, encode_ms)."""
+    out, compose_ms, encode_ms = _compose_and_encode(frame_set, sources, debug_tag, card_ids, profile, base_ids)
+    return out.getvalue(), out.name, compose_ms, encode_ms
+
+
+class FrameRenderer:
+    """
+    Рендер рамок в отдельных процессах (FRAME_RENDER_PROCESSES однопроцессных пулов).
+    Рендеры одного пользователя по возможности идут в один и тот же воркер (affinity) —
+    там лежит его прошлый холст для инкрементальной перерисовки; если этот воркер заметно
+    загружен сильнее других — берём наименее загруженный.
+    Если пулы выключены или сломались — тот же render_job в пуле потоков.
+    """
+
+    AFFINITY_SLACK = 2  # насколько очередь «своего» воркера может быть длиннее минимальной
+
+    def __init__(self, processes=FRAME_RENDER_PROCESSES):
+        self.processes = processes
+        self._pools = []
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.processes <= 0:
+            preload_backgrounds()
+            return
+        with self._lock:
+            if self._pools:
+                return
+            self._pools = [ProcessPoolExecutor(max_workers=1, mp_context=WORKER_CONTEXT, initializer=_worker_init)
+                           for _ in range(self.processes)]
+            self._pending = [0] * self.processes
+            pools = list(self._pools)
+        # поднимаем всех воркеров сразу, чтобы первый пользователь не ждал spawn + загрузку фонов
+        pings = [pool.submit(_worker_ping) for pool in pools]
+        pids = set()
+        for f in pings:
+            try:
+                pids.add(f.result(timeout=60))
+            except Exception:
+                logger.exception("frame render worker не поднялся")
+        logger.info("frame render pool: %d workers (%s)", len(pids), ", ".join(str(p) for p in sorted(pids)))
+
+    def shutdown(self):
+        with self._lock:
+            pools, self._pools, self._pending = self._pools, [], []
+        for pool in pools:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _pick(self, affinity=None):
+        with self._lock:
+            if not self._pools:
+                return None, None
+            least = min(range(len(self._pools)), key=lambda i: self._pending[i])
+            idx = least
+            if affinity is not None:
+                own = hash(affinity) % len(self._pools)
+                if self._pending[own] <= self._pending[least] + self.AFFINITY_SLACK:
+                    idx = own
+            self._pending[idx] += 1
+            return idx, self._pools[idx]
+
+    def _release(self, idx, pool):
+        with self._lock:
+            if idx is not None and idx < len(self._pools) and self._pools[idx] is pool:
+                self._pending[idx] -= 1
+
+    def _replace_broken(self, idx, broken):
+        with self._lock:
+            if idx < len(self._pools) and self._pools[idx] is broken:
+                self._pools[idx] = ProcessPoolExecutor(max_workers=1, mp_context=WORKER_CONTEXT, initializer=_worker_init)
+                self._pending[idx] = 0
+        try:
+            broken.shutdown(wait=False, cancel_futures=True)
+        except Exception:
+            pass
+
+    async def render(self, frame_set: int, sources, card_ids=None, profile=None, debug_tag=None, base_ids=None, affinity=None) -> BytesIO:
+        loop = asyncio.get_running_loop()
+        args = (frame_set, list(sources), list(card_ids) if card_ids else None, profile, debug_tag,
+                list(base_ids) if base_ids else None)
+        idx, pool = self._pick(affinity)
+        result = None
+        if pool is not None:
+            try:
+                result = await loop.run_in_executor(pool, render_job, *args)
+            except BrokenProcessPool:
+                logger.exception("Воркер рендера упал — пересоздаём, этот рендер делаем в потоке")
+                self._replace_broken(idx, pool)
+            finally:
+                self._release(idx, pool)
+        if result is None:
+            result = await loop.run_in_executor(None, render_job, *args)
+        data, name, compose_ms, encode_ms = result
+        _record_render(profile, frame_set, compose_ms, encode_ms, len(data))
+        out = BytesIO(data)
+        out.name = name
+        return out
+
+
+RENDERER = FrameRenderer()
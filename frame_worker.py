@@ -0,0 +1,8 @@
+"""
+frame_worker.py
+
+Главный модуль процессов пула рендера (FrameRenderer, spawn). Воркер исполняет «главный» модуль
+родителя как __mp_main__; чтобы это был не main.py (winter, gspread, telegram, реестр кэшей),
+frame_render на время запуска процесса подставляет этот модуль. Здесь — только frame_render.
+"""
+import frame_render  # noqa: F401
@@ -1,5 +1,13 @@
 import winter
 import winter_frame
+import media
+import frame_render
+import send_limiter
+import update_processor
+import web_server
+import metrics
+import call_trace
+import ttl_cache
 
 # main_v3.py — стрик + оптимизация
 import os
@@ -12,11 +20,7 @@ import time as _time
 import asyncio
 import os
 import json
-import threading
-import http.server
-import socketserver
 import re
-import aiohttp
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
@@ -27,6 +31,7 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
+from telegram.error import TimedOut
 
 import gspread
 from google.oauth2.service_account import Credentials
@@ -62,19 +67,8 @@ RARITY_STYLES = {
         "LEG": "🟠 Легендарный"
     }
 
-# --- Кэш для leaderboard ---
-LEADERBOARD_CACHE = {
-    "ts": 0,         # unix time последнего обновления
-    "records": None  # список записей (rows) полученный из sheet_leaderboard().get_all_records()
-}
-LEADERBOARD_TTL = 10  # время жизни кэша в секундах (настраиваемо)
-leaderboard_cache_lock = asyncio.Lock()
-
-# --- Кэш для списка котов ---
-CATS_CACHE = {
-    "ts": 0,       # время последнего обновления
-    "data": None   # список котов после clean_cat_records()
-}
+# --- Кэши (ttl_cache.TTLCache: LEADERBOARD и CATS объявлены рядом со своими загрузчиками) ---
+LEADERBOARD_TTL = 10  # время жизни кэша leaderboard в секундах (настраиваемо)
 CATS_TTL = 300     # 5 минут
 
 # Логирование
@@ -91,7 +85,7 @@ SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapi
 # --- Helpers for GSheets ---
 def gs_client():
     creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-    return gspread.authorize(creds)
+    return gspread.authorize(creds, http_client=metrics.sheets_http_client())
 
 
 def sheet_users():
@@ -266,41 +260,24 @@ def ensure_sum_column(sheet):
     sheet.update([["SUM"]], f"{colnum_to_letter(next_idx)}1")
     return next_idx
 
+def _load_leaderboard(_key=None):
+    """Записи листа leaderboard (get_all_records); нет листа — пустой список."""
+    s_lb = sheet_leaderboard()
+    if not s_lb:
+        return []
+    return s_lb.get_all_records()
+
+
+LEADERBOARD = ttl_cache.TTLCache("leaderboard", _load_leaderboard, ttl=LEADERBOARD_TTL, default=[],
+                                 description="лист leaderboard (топ по SUM)")
+
+
 async def get_leaderboard_cached():
     """
     Возвращает список записей leaderboard (get_all_records).
-    Если кэш свежий — возвращает кэш. Иначе — обновляет leaderboard (формула)
-    и считывает данные, записывает в кэш и возвращает.
+    Если кэш свежий — возвращает кэш, иначе одна загрузка на всех ждущих (в executor).
     """
-    now = time.time()
-    # быстрый путь без блокировки
-    if LEADERBOARD_CACHE["records"] is not None and (now - LEADERBOARD_CACHE["ts"]) < LEADERBOARD_TTL:
-        return LEADERBOARD_CACHE["records"]
-
-    # блокируем обновление кэша, чтобы только один запрос делал heavy work
-    async with leaderboard_cache_lock:
-        # другой таск мог уже обновить кэш — проверить ещё раз
-        now = time.time()
-        if LEADERBOARD_CACHE["records"] is not None and (now - LEADERBOARD_CACHE["ts"]) < LEADERBOARD_TTL:
-            return LEADERBOARD_CACHE["records"]
-
-        # читаем данные из leaderboard
-        try:
-            s_lb = sheet_leaderboard()
-            if not s_lb:
-                # пустой / нет leaderboard
-                LEADERBOARD_CACHE["records"] = []
-                LEADERBOARD_CACHE["ts"] = time.time()
-                return []
-            records = s_lb.get_all_records()
-        except Exception as e:
-            logger.warning("Ошибка при чтении leaderboard: %s", e)
-            records = []
-
-        # сохраняем в кэш
-        LEADERBOARD_CACHE["records"] = records
-        LEADERBOARD_CACHE["ts"] = time.time()
-        return records
+    return await LEADERBOARD.aget() or []
 
 
 # --- Menu & cards ---
@@ -357,30 +334,19 @@ def clean_cat_records(records):
         cleaned.append({"id": cid, "url": url, "desc": desc, "rarity": rarity})
     return cleaned
 
+def _load_cats(_key=None):
+    return clean_cat_records(sheet_cats().get_all_records())
+
+
+CATS = ttl_cache.TTLCache("cats", _load_cats, ttl=CATS_TTL, default=[], description="лист cats (основной каталог)")
+
+
 def get_cats_cached():
     """
     Возвращает список котов (список словарей) с кэшированием на 5 минут.
+    При ошибке чтения — прошлый список (или пустой).
     """
-    now = time.time()
-
-    # если кэш свежий — возвращаем его
-    if CATS_CACHE["data"] is not None and (now - CATS_CACHE["ts"]) < CATS_TTL:
-        return CATS_CACHE["data"]
-
-    # иначе — загружаем из таблицы
-    s_cats = sheet_cats()
-    try:
-        records = s_cats.get_all_records()
-        cats = clean_cat_records(records)
-    except Exception as e:
-        logger.exception("Ошибка при получении списка котов: %s", e)
-        # если кэш пуст — вернём пустой список
-        return CATS_CACHE["data"] or []
-
-    # сохраняем в кэш
-    CATS_CACHE["data"] = cats
-    CATS_CACHE["ts"] = now
-    return cats
+    return CATS.get() or []
 
 
 def choose_rarity(weights):
@@ -909,43 +875,29 @@ async def handle_spin_and_send(chat_id, user_id, context: ContextTypes.DEFAULT_T
     logger.info("User %s получил кот %s (редкость=%s), +%d очков, спины %d->%d",
                 user_id, chosen.get("id"), chosen.get("rarity"), gained, spins, new_spins)
 
-    # Обработка ссылки Drive -> direct download
-    url = (chosen.get("url") or "").strip()
-    if "drive.google.com" in url:
-        if "/d/" in url:
-            file_id = url.split("/d/")[1].split("/")[0]
-            url = f"https://drive.google.com/uc?export=download&id={file_id}"
-        elif "id=" in url:
-            file_id = url.split("id=")[1].split("&")[0]
-            url = f"https://drive.google.com/uc?export=download&id={file_id}"
-
     # Формируем подпись
     rarity_label = RARITY_STYLES.get(chosen.get("rarity"), chosen.get("rarity"))
     caption = f"{rarity_label}\n{chosen.get('desc')}\n\n⭐ За эту карточку: +{gained} ⭐"
 
-    # Попытка отправить изображение по URL, затем fallback на скачивание + отправку байтов
+    # file_id из кэша -> URL -> скачивание байтов (выученный способ доставки запоминается);
+    # спин уже списан — ошибка отправки не должна оставить пользователя без карточки
     try:
-        await context.bot.send_photo(chat_id=chat_id, photo=url, caption=caption)
-    except Exception as e:
-        logger.warning("send_photo по URL не удался: %s; пытаюсь скачать и отправить байты...", e)
-        try:
-            from io import BytesIO
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, timeout=15) as resp:
-                    if resp.status != 200:
-                        raise Exception(f"HTTP {resp.status}")
-
-                    content = await resp.read()
-
-            bio = BytesIO(content)
-            bio.name = f"cat_{chosen.get('id')}.jpg"
-
-            await context.bot.send_photo(chat_id=chat_id, photo=bio, caption=caption)
-
-        except Exception as e2:
-            logger.exception("Не удалось скачать/отправить изображение: %s", e2)
-            await context.bot.send_message(chat_id=chat_id, text="(Не удалось отправить изображение)\n" + caption)
+        sent = await media.send_photo_cached(
+            context.bot, chat_id, f"cat:{chosen.get('id')}", chosen.get("url") or "",
+            caption=caption, filename=f"cat_{chosen.get('id')}.jpg",
+        )
+    except TimedOut:
+        # фото могло дойти — подпись текстом не дублируем
+        logger.warning("Таймаут отправки изображения кота %s", chosen.get("id"))
+        await context.bot.send_message(chat_id=chat_id, text="⏳ Telegram не ответил вовремя. Карточка засчитана, "
+                                                              "картинка может прийти с задержкой.")
+        return
+    except Exception:
+        logger.exception("Ошибка отправки изображения кота %s", chosen.get("id"))
+        sent = None
+    if sent is None:
+        logger.error("Не удалось отправить изображение кота %s", chosen.get("id"))
+        await context.bot.send_message(chat_id=chat_id, text="(Не удалось отправить изображение)\n" + caption)
 
 
 # --- Handle promo & nick input text ---
@@ -1254,18 +1206,138 @@ async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def reload_leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    async with leaderboard_cache_lock:
-        LEADERBOARD_CACHE["records"] = None
-        LEADERBOARD_CACHE["ts"] = 0
+    LEADERBOARD.clear()
     await update.message.reply_text("Кэш лидерборда сброшен.")
 
 
+async def caches_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /caches — состояние всех кэшей (только админ).
+    /caches reload <имя|all> — перечитать сейчас; /caches clear <имя|all> — сбросить (загрузится при обращении).
+    """
+    if not update.effective_user or update.effective_user.id != getattr(winter, "ADMIN_ID", None):
+        return
+    args = [a.strip() for a in (context.args or []) if a.strip()]
+    if not args:
+        lines = [ttl_cache.format_stats(c.stats()) for c in ttl_cache.all_caches()]
+        lines.append("\n/caches reload <имя|all> — перечитать, /caches clear <имя|all> — сбросить")
+        await update.message.reply_text("Кэши:\n" + "\n".join(lines))
+        return
+
+    action = args[0].lower()
+    name = args[1] if len(args) > 1 else "all"
+    if action not in ("reload", "clear"):
+        await update.message.reply_text("Использование: /caches [reload|clear] [имя|all]")
+        return
+    targets = ttl_cache.all_caches() if name == "all" else [c for c in [ttl_cache.get_cache(name)] if c]
+    if not targets:
+        names = ", ".join(c.name for c in ttl_cache.all_caches())
+        await update.message.reply_text(f"Нет кэша {name}. Есть: {names}")
+        return
+
+    loop = asyncio.get_running_loop()
+    done = []
+    for c in targets:
+        try:
+            if action == "reload":
+                # загрузчики — блокирующие чтения таблиц
+                await loop.run_in_executor(None, c.reload_all)
+            else:
+                c.clear()
+            done.append(c.name)
+        except Exception:
+            logger.exception("caches: %s %s не удалось", action, c.name)
+    verb = "перечитаны" if action == "reload" else "сброшены"
+    await update.message.reply_text(f"Кэши {verb}: {', '.join(done) or '—'}\n\n"
+                                    + "\n".join(ttl_cache.format_stats(ttl_cache.get_cache(n).stats()) for n in done))
+
+
+# --- File_id warmup ---
+def collect_warmup_items():
+    """Все картинки каталогов (cats, winter_cats, магазин) в формате media.warmup_file_ids."""
+    items = []
+    for c in get_cats_cached() or []:
+        if c.get("id") is not None and c.get("url"):
+            items.append((f"cat:{c['id']}", c["url"], f"cat_{c['id']}.jpg"))
+    for c in winter.get_winter_cats_cached() or []:
+        if c.get("id") is not None and c.get("url"):
+            items.append((f"winter:{c['id']}", c["url"], f"winter_cat_{c['id']}.jpg"))
+    for it in winter.load_shop_items() or []:
+        if it.get("IMAGE_URL"):
+            items.append((f"shop:{it['ITEM_ID']}", it["IMAGE_URL"], f"shop_{it['ITEM_ID']}.jpg"))
+    return items
+
+
+async def warmup_job(app):
+    chat_id = media.MEDIA_CACHE_CHAT_ID or getattr(winter, "ADMIN_ID", None)
+    if not chat_id:
+        logger.warning("warmup: не задан MEDIA_CACHE_CHAT_ID / ADMIN_ID — прогрев пропущен")
+        return
+    try:
+        loop = asyncio.get_running_loop()
+        items = await loop.run_in_executor(None, collect_warmup_items)
+        await media.warmup_file_ids(app.bot, items, chat_id)
+    except Exception:
+        logger.exception("warmup job failed")
+
+
+async def post_init(app):
+    # потоки executor получают contextvars вызывающего — вызовы Sheets приписываются апдейту (call_trace)
+    asyncio.get_running_loop().set_default_executor(call_trace.ContextThreadPoolExecutor(thread_name_prefix="executor"))
+    await media.DOWNLOADS.start()
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, frame_render.RENDERER.start)
+    except Exception:
+        logger.exception("Не удалось запустить пул рендера рамок")
+    # file_id рамок: канал-хранилище, иначе служебный/админский чат с удалением после загрузки
+    upload_chat = media.CACHE_CHANNEL_ID or media.MEDIA_CACHE_CHAT_ID or getattr(winter, "ADMIN_ID", None)
+    media.UPLOADER.start(app.bot, upload_chat, delete_after=not media.CACHE_CHANNEL_ID)
+    if media.WARMUP_ON_START:
+        app.create_task(warmup_job(app))
+    # один HTTP-сервер: health для хостинга, в режиме webhook — ещё и приём апдейтов
+    web_server.SERVER.add_health("updates", update_processor.UPDATE_PROCESSOR.stats)
+    web_server.SERVER.add_health("send", send_limiter.SEND_LIMITER.stats)
+    try:
+        await web_server.SERVER.start(app, webhook=bool(web_server.WEBHOOK_URL))
+    except Exception:
+        logger.exception("Не удалось поднять HTTP-сервер на порту %s", web_server.PORT)
+
+
+async def post_shutdown(app):
+    await web_server.SERVER.stop()
+    # отложенная запись остатков магазина не должна потеряться при остановке
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, winter.SHOP_INVENTORY.flush)
+    except Exception:
+        logger.exception("Не удалось записать остатки магазина при остановке")
+    # отложенные записи дисковых кэшей (file_id, индекс картинок)
+    for cache in (media.FILE_IDS, winter_frame.FRAME_FILE_IDS, media.IMAGES):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, cache.flush)
+        except Exception:
+            logger.exception("Не удалось записать кэш при остановке")
+    await media.UPLOADER.stop()
+    await media.DOWNLOADS.close()
+    frame_render.RENDERER.shutdown()
+
+
 # --- Main and handlers registration ---
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .rate_limiter(send_limiter.SEND_LIMITER)
+        .concurrent_updates(update_processor.UPDATE_PROCESSOR)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("reload_lb", reload_leaderboard_command))
+    app.add_handler(CommandHandler("caches", caches_command))
 
 
     # подключаем winter-пакет (специфичные callback'ы и frame-хендлеры)
@@ -1282,17 +1354,13 @@ def main():
 
 
     print("Бот запущен")
-    app.run_polling()
-
-def keep_alive():
-    port = int(os.environ.get("PORT", 8080))
-    handler = http.server.SimpleHTTPRequestHandler
-    with socketserver.TCPServer(("", port), handler) as httpd:
-        print(f"✅ Keep-alive web server running on port {port}")
-        httpd.serve_forever()
-
-threading.Thread(target=keep_alive, daemon=True).start()
+    if web_server.WEBHOOK_URL:
+        web_server.run_webhook(app)
+    else:
+        app.run_polling(allowed_updates=web_server.ALLOWED_UPDATES)
 
+# бот (и его HTTP-сервер) поднимаем только при запуске скрипта, не при импорте
+# (воркеры рендера этот модуль не импортируют — у них __main__ = frame_worker)
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,1017 @@
+"""
+media.py
+
+Общие помощники для картинок карточек:
+- drive_direct_url: ссылка Google Drive -> прямое скачивание;
+- DOWNLOADS: общий менеджер скачиваний (один пул соединений на всё приложение);
+- IMAGES: дисковый кэш оригиналов картинок (LRU по размеру, атомарная запись, опциональная ревалидация);
+- FILE_IDS: постоянный кэш key -> Telegram file_id (+ какой способ доставки сработал);
+- send_photo_cached: отправка фото через file_id / URL / скачанные байты;
+- UPLOADER: фоновая загрузка картинок в канал-хранилище ради file_id (пакетами, со своим темпом);
+- warmup_file_ids: фоновая предзагрузка всего каталога в служебный чат, чтобы получить file_id заранее.
+
+Ключи кэша: "cat:<ID>" — основные коты, "winter:<ID>" — зимние, "shop:<ITEM_ID>" — картинки магазина.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import asyncio
+import logging
+import threading
+import contextvars
+from io import BytesIO
+from collections import OrderedDict
+
+import aiohttp
+from telegram import InputFile, InputMediaPhoto
+from telegram.error import BadRequest, RetryAfter
+
+import metrics
+import call_trace
+import send_limiter
+
+logger = logging.getLogger(__name__)
+
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+FILE_IDS_PATH = os.path.join(MEDIA_CACHE_DIR, "file_ids.json")
+
+# прогрев: служебный чат для загрузок (по умолчанию — ADMIN_ID из winter), параллельность, пауза
+MEDIA_CACHE_CHAT_ID = os.environ.get("MEDIA_CACHE_CHAT_ID")
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "1") == "1"
+WARMUP_CONCURRENCY = int(os.environ.get("WARMUP_CONCURRENCY", "3"))
+WARMUP_DELAY = float(os.environ.get("WARMUP_DELAY", "1.0"))
+
+# скачивание картинок
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", "15"))
+DOWNLOAD_CONNECT_TIMEOUT = float(os.environ.get("DOWNLOAD_CONNECT_TIMEOUT", "5"))
+DOWNLOAD_MAX_BYTES = int(os.environ.get("DOWNLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+DOWNLOAD_MAX_CONNECTIONS = int(os.environ.get("DOWNLOAD_MAX_CONNECTIONS", "20"))
+DOWNLOAD_PER_HOST = int(os.environ.get("DOWNLOAD_PER_HOST", "6"))
+
+# дисковый кэш оригиналов картинок карточек
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR") or os.path.join(MEDIA_CACHE_DIR, "images")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", str(300 * 1024 * 1024)))
+IMAGE_REVALIDATE_AFTER = float(os.environ.get("IMAGE_REVALIDATE_AFTER", "0"))  # сек; 0 — не ревалидировать
+CACHE_SAVE_DELAY = float(os.environ.get("CACHE_SAVE_DELAY", "5"))  # сек: JSON-индексы кэшей пишутся не чаще
+
+# загрузки ради file_id (рамки и т.п.): отдельный канал-хранилище, пакеты send_media_group, свой темп
+CACHE_CHANNEL_ID = os.environ.get("CACHE_CHANNEL_ID")
+UPLOAD_BATCH_SIZE = int(os.environ.get("UPLOAD_BATCH_SIZE", "10"))          # максимум send_media_group
+UPLOAD_BATCH_WINDOW = float(os.environ.get("UPLOAD_BATCH_WINDOW", "0.5"))   # сек ожидания, чтобы собрать пакет
+UPLOAD_MIN_INTERVAL = float(os.environ.get("UPLOAD_MIN_INTERVAL", "3.0"))   # сек между запросами в один чат
+
+# способы доставки
+METHOD_URL = "url"      # Telegram сам скачивает по ссылке
+METHOD_BYTES = "bytes"  # скачиваем сами и загружаем байты
+
+
+def drive_direct_url(url: str) -> str:
+    if not url:
+        return url
+    url = url.strip()
+    if "drive.google.com" in url:
+        try:
+            if "/d/" in url:
+                file_id = url.split("/d/")[1].split("/")[0]
+                return f"https://drive.google.com/uc?export=download&id={file_id}"
+            if "id=" in url:
+                file_id = url.split("id=")[1].split("&")[0]
+                return f"https://drive.google.com/uc?export=download&id={file_id}"
+        except Exception:
+            return url
+    return url
+
+
+class DownloadError(Exception):
+    pass
+
+
+# сессия и схлопывание запросов для run_sync вне работающего бота: свои на каждый asyncio.run,
+# общий DOWNLOADS (сессия основного loop, его SingleFlight) при этом не трогается
+_STANDALONE = contextvars.ContextVar("downloads_standalone", default=None)
+
+
+class SingleFlight:
+    """
+    Схлопывание одинаковых одновременных операций: пока задача с ключом key выполняется,
+    повторные вызовы do(key, ...) ждут тот же результат (или ту же ошибку).
+    Отмена одного ожидающего не отменяет общую задачу.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def __contains__(self, key):
+        return key in self._inflight
+
+    async def do(self, key, make_coro):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_coro())
+            self._inflight[key] = task
+
+            def _done(t, key=key):
+                if self._inflight.get(key) is t:
+                    self._inflight.pop(key, None)
+                if not t.cancelled():
+                    t.exception()  # чтобы не было "exception was never retrieved"
+
+            task.add_done_callback(_done)
+        return await asyncio.shield(task)
+
+
+class DownloadManager:
+    """
+    Скачивание картинок через один aiohttp.ClientSession на всё время жизни бота:
+    - пул соединений (DNS/TCP/TLS переиспользуются), лимит соединений всего и на хост;
+    - общий таймаут и таймаут соединения;
+    - ограничение размера ответа (DOWNLOAD_MAX_BYTES);
+    - одновременные запросы одного и того же URL схлопываются в одно скачивание.
+    Из потоков (executor) можно звать fetch_sync / run_sync — запрос выполнится в основном event loop;
+    без запущенного бота — во временном loop со своей сессией (см. run_sync).
+    """
+
+    def __init__(self, timeout=DOWNLOAD_TIMEOUT, connect_timeout=DOWNLOAD_CONNECT_TIMEOUT,
+                 max_bytes=DOWNLOAD_MAX_BYTES, max_connections=DOWNLOAD_MAX_CONNECTIONS,
+                 per_host=DOWNLOAD_PER_HOST):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_bytes = max_bytes
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self._session = None
+        self._loop = None
+        self._inflight = SingleFlight()
+
+    def _client_timeout(self):
+        return aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout)
+
+    def _new_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host, ttl_dns_cache=300)
+        return aiohttp.ClientSession(connector=connector, timeout=self._client_timeout())
+
+    async def start(self):
+        local = _STANDALONE.get()
+        if local is not None:
+            return local[0]
+        if self._session is None or self._session.closed:
+            self._loop = asyncio.get_running_loop()
+            self._session = self._new_session()
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _read_body(self, resp):
+        if resp.status != 200:
+            raise DownloadError(f"HTTP {resp.status}")
+        if resp.content_length and resp.content_length > self.max_bytes:
+            raise DownloadError(f"слишком большой файл: {resp.content_length} байт")
+        buf = bytearray()
+        async for chunk in resp.content.iter_chunked(64 * 1024):
+            buf.extend(chunk)
+            if len(buf) > self.max_bytes:
+                raise DownloadError(f"слишком большой файл: > {self.max_bytes} байт")
+        return bytes(buf)
+
+    async def _read(self, session, url):
+        t0 = time.perf_counter()
+        try:
+            async with session.get(url) as resp:
+                content = await self._read_body(resp)
+        except Exception:
+            metrics.DOWNLOADS.inc("error")
+            raise
+        finally:
+            metrics.DOWNLOAD_SECONDS.observe(value=time.perf_counter() - t0)
+        metrics.DOWNLOADS.inc("ok")
+        metrics.DOWNLOAD_BYTES.inc(amount=len(content))
+        call_trace.record("download", "image", time.perf_counter() - t0, len(content))
+        return content
+
+    async def fetch(self, url):
+        """Скачать url (bytes). Параллельные вызовы с тем же url ждут одно скачивание."""
+        session = await self.start()
+        local = _STANDALONE.get()
+        inflight = local[1] if local is not None else self._inflight
+        return await inflight.do(url, lambda: self._read(session, url))
+
+    async def _fetch_or_none(self, url):
+        if not url:
+            return None
+        try:
+            return await self.fetch(url)
+        except Exception as e:
+            logger.warning("Failed to download image %s: %s", url, e)
+            return None
+
+    async def fetch_many(self, urls):
+        """
+        Параллельная загрузка списка URL. Порядок сохраняется;
+        на месте пустого URL или неудачной загрузки — None.
+        """
+        return list(await asyncio.gather(*(self._fetch_or_none(u) for u in urls)))
+
+    def run_sync(self, make_coro, timeout=None):
+        """
+        Выполнить корутину make_coro() из потока (executor) и дождаться результата.
+        Если бот запущен — в основном loop (общий пул соединений);
+        если нет (скрипты, бенчмарки) — во временном loop с короткоживущей сессией и своим
+        SingleFlight, локальными для этого вызова: параллельные run_sync из разных потоков
+        не делят сессии между loop'ами и не трогают состояние DOWNLOADS.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("блокирующие *_sync методы нельзя вызывать из event loop — используйте await")
+        loop = self._loop
+        if loop is not None and loop.is_running() and self._session is not None and not self._session.closed:
+            fut = asyncio.run_coroutine_threadsafe(make_coro(), loop)
+            return fut.result(timeout if timeout is not None else self.timeout + 5)
+
+        async def _standalone():
+            # asyncio.run выполняет корутину в копии контекста — _STANDALONE виден только этому вызову
+            session = self._new_session()
+            _STANDALONE.set((session, SingleFlight()))
+            try:
+                return await make_coro()
+            finally:
+                await session.close()
+
+        return asyncio.run(_standalone())
+
+    def fetch_sync(self, url):
+        """Блокирующая версия fetch для кода в потоках."""
+        return self.run_sync(lambda: self.fetch(url))
+
+    def fetch_many_sync(self, urls):
+        """Блокирующая версия fetch_many."""
+        return self.run_sync(lambda: self.fetch_many(urls))
+
+    async def fetch_conditional(self, url, etag=None, last_modified=None):
+        """
+        Условный GET для ревалидации: (None, validators) если 304 Not Modified,
+        иначе (bytes, validators). validators — {"etag", "last_modified"} из ответа.
+        """
+        session = await self.start()
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        async with session.get(url, headers=headers) as resp:
+            validators = {
+                "etag": resp.headers.get("ETag") or etag,
+                "last_modified": resp.headers.get("Last-Modified") or last_modified,
+            }
+            if resp.status == 304:
+                return None, validators
+            return await self._read_body(resp), validators
+
+
+DOWNLOADS = DownloadManager()
+
+
+def _atomic_write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class _DebouncedJsonWriter:
+    """
+    Отложенная атомарная запись JSON-файла: mark() только помечает изменения, сам файл пишется
+    не чаще раза в delay секунд в потоке таймера (не в event loop и не на пути ответа пользователю).
+    flush() — записать сразу (остановка бота).
+    """
+
+    def __init__(self, path, snapshot_fn, delay=CACHE_SAVE_DELAY, what="кэш"):
+        self.path = path
+        self.snapshot_fn = snapshot_fn
+        self.delay = delay
+        self.what = what
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._timer = None
+        self.writes = 0
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def mark(self):
+        with self._lock:
+            self._dirty = True
+            if self._timer is not None:
+                return
+            if self.delay <= 0:
+                timer = None
+            else:
+                timer = self._timer = threading.Timer(self.delay, self.flush)
+                timer.daemon = True
+        if timer is None:
+            self.flush()
+        else:
+            timer.start()
+
+    def flush(self):
+        """Записать, если есть изменения. True — файл записан."""
+        with self._write_lock:
+            with self._lock:
+                timer, self._timer = self._timer, None
+                if not self._dirty:
+                    return False
+                self._dirty = False
+            if timer is not None and timer is not threading.current_thread():
+                timer.cancel()
+            try:
+                _atomic_write_json(self.path, self.snapshot_fn())
+            except Exception:
+                logger.exception("Не удалось сохранить %s (%s)", self.what, self.path)
+                with self._lock:
+                    self._dirty = True
+                return False
+            self.writes += 1
+            return True
+
+
+class FileIdCache:
+    """
+    Постоянный кэш key -> {"file_id", "url", "method", "ts"} в JSON-файле.
+    file_id берётся из первой успешной отправки (message.photo[-1].file_id);
+    если у карточки поменялся URL — запись считается устаревшей.
+    Файл пишется отложенно (раз в CACHE_SAVE_DELAY, в потоке таймера, атомарно) — remember/forget
+    на пути ответа пользователю только меняют словарь; flush() — при остановке бота.
+    """
+
+    def __init__(self, path=FILE_IDS_PATH, max_items=None):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        metrics.CACHE_ITEMS.track(self.name, fn=lambda: len(self._data) if self._loaded else None)
+        self.max_items = max_items  # None — без ограничения; иначе LRU по обращениям
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._loaded = False
+        self._writer = _DebouncedJsonWriter(path, self._snapshot, what="кэш file_id")
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._data = OrderedDict(json.load(f) or {})
+                logger.info("file_id cache loaded: %d entries", len(self._data))
+            except FileNotFoundError:
+                self._data = OrderedDict()
+            except Exception:
+                logger.exception("Не удалось прочитать %s — начинаем с пустого кэша", self.path)
+                self._data = OrderedDict()
+            self._loaded = True
+
+    def _snapshot(self):
+        with self._lock:
+            return dict(self._data)
+
+    def _save(self):
+        self._writer.mark()
+
+    def flush(self):
+        """Записать отложенные изменения сразу (при остановке бота). Блокирующая."""
+        return self._writer.flush()
+
+    def get(self, key, url=None):
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and self.max_items:
+                self._data.move_to_end(key)
+        if not entry:
+            return None
+        if url is not None and entry.get("url") and entry.get("url") != url:
+            return None
+        return entry
+
+    def get_file_id(self, key, url=None):
+        entry = self.get(key, url)
+        fid = entry.get("file_id") if entry else None
+        if fid:
+            metrics.cache_hit(self.name)
+        else:
+            metrics.cache_miss(self.name)
+        return fid
+
+    def method(self, key):
+        entry = self.get(key)
+        return entry.get("method") if entry else None
+
+    def remember(self, key, url, file_id, method):
+        if not file_id:
+            return
+        self._ensure_loaded()
+        with self._lock:
+            self._data[key] = {"file_id": file_id, "url": url, "method": method, "ts": int(time.time())}
+            self._data.move_to_end(key)
+            if self.max_items:
+                while len(self._data) > self.max_items:
+                    self._data.popitem(last=False)
+        self._save()
+
+    def forget(self, key):
+        """Сбросить file_id (например, Telegram перестал его принимать), сохранив выученный method."""
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._data.get(key)
+            if not entry:
+                return
+            entry["file_id"] = None
+        self._save()
+
+    def __len__(self):
+        self._ensure_loaded()
+        return sum(1 for e in self._data.values() if e.get("file_id"))
+
+
+FILE_IDS = FileIdCache()
+
+
+class ImageDiskCache:
+    """
+    Дисковый кэш оригинальных байтов картинок: файл <key>-<sha1(url)>.img в IMAGE_CACHE_DIR.
+    - смена URL у карточки = другой файл (старый удаляется при записи нового);
+    - LRU-вытеснение по суммарному размеру (порядок — mtime файла, при попадании обновляется);
+    - запись атомарная (tmp + os.replace), битых файлов после падения не бывает;
+    - если IMAGE_REVALIDATE_AFTER > 0 — после этого срока условный GET (ETag / Last-Modified).
+    Метаданные ревалидации хранятся в index.json рядом с файлами; он пишется отложенно
+    (раз в CACHE_SAVE_DELAY, flush() — при остановке).
+    get/put — блокирующие (диск); async-методы (fetch, fetch_source) зовут их через executor.
+    """
+
+    def __init__(self, path=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES, revalidate_after=IMAGE_REVALIDATE_AFTER):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.index_path = os.path.join(path, "index.json")
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # name -> size (от старых к свежим)
+        self._meta = {}              # name -> {"etag", "last_modified", "checked"}
+        self._total = 0
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+        self._meta_writer = _DebouncedJsonWriter(self.index_path, self._meta_snapshot, what="индекс кэша картинок")
+
+    @staticmethod
+    async def _io(fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    @staticmethod
+    def _name(key, url):
+        safe_key = re.sub(r"[^A-Za-z0-9_.-]", "_", str(key))
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        return f"{safe_key}-{digest}.img"
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            entries = []
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                for fn in os.listdir(self.path):
+                    if not fn.endswith(".img"):
+                        continue
+                    try:
+                        st = os.stat(os.path.join(self.path, fn))
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, fn, st.st_size))
+            except Exception:
+                logger.exception("Не удалось прочитать каталог кэша картинок %s", self.path)
+            entries.sort()
+            self._files = OrderedDict((fn, size) for _, fn, size in entries)
+            self._total = sum(self._files.values())
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f) or {}
+                self._meta = {k: v for k, v in meta.items() if k in self._files}
+            except FileNotFoundError:
+                self._meta = {}
+            except Exception:
+                logger.exception("Не удалось прочитать %s", self.index_path)
+                self._meta = {}
+            self._loaded = True
+            logger.info("image cache loaded: %d files, %.1f MB", len(self._files), self._total / 1048576)
+
+    def _meta_snapshot(self):
+        with self._lock:
+            return dict(self._meta)
+
+    def _save_meta(self):
+        self._meta_writer.mark()
+
+    def flush(self):
+        """Записать отложенные изменения index.json (при остановке бота)."""
+        return self._meta_writer.flush()
+
+    def _remove_locked(self, name):
+        size = self._files.pop(name, None)
+        if size is not None:
+            self._total -= size
+        self._meta.pop(name, None)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception("Не удалось удалить %s из кэша картинок", name)
+
+    def get(self, key, url):
+        """Байты из кэша или None. Попадание поднимает файл в начало LRU."""
+        url = drive_direct_url((url or "").strip())
+        if not url:
+            return None
+        self._ensure_loaded()
+        name = self._name(key, url)
+        with self._lock:
+            if name not in self._files:
+                self.misses += 1
+                metrics.cache_miss("images")
+                return None
+            self._files.move_to_end(name)
+        full = os.path.join(self.path, name)
+        try:
+            with open(full, "rb") as f:
+                content = f.read()
+            os.utime(full)
+        except FileNotFoundError:
+            with self._lock:
+                self._remove_locked(name)
+                self.misses += 1
+            metrics.cache_miss("images")
+            return None
+        except Exception:
+            logger.exception("Не удалось прочитать %s из кэша картинок", name)
+            return None
+        with self._lock:
+            self.hits += 1
+        metrics.cache_hit("images")
+        return content
+
+    def put(self, key, url, content, validators=None):
+        url = drive_direct_url((url or "").strip())
+        if not url or not content:
+            return
+        self._ensure_loaded()
+        name = self._name(key, url)
+        full = os.path.join(self.path, name)
+        tmp = f"{full}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, full)
+        except Exception:
+            logger.exception("Не удалось записать %s в кэш картинок", name)
+            try:
+                os.remove(tmp)
+            except Exception:
+                pass
+            return
+        prefix = name.rsplit("-", 1)[0] + "-"
+        with self._lock:
+            # та же карточка со старым URL больше не нужна
+            for old in [n for n in self._files if n.startswith(prefix) and n != name]:
+                self._remove_locked(old)
+            self._total -= self._files.pop(name, 0)
+            self._files[name] = len(content)
+            self._total += len(content)
+            meta = dict(validators or {})
+            meta["checked"] = int(time.time())
+            self._meta[name] = meta
+            while self._total > self.max_bytes and len(self._files) > 1:
+                oldest = next(iter(self._files))
+                self._remove_locked(oldest)
+        self._save_meta()
+
+    def _revalidate_due(self, name):
+        if self.revalidate_after <= 0:
+            return False
+        meta = self._meta.get(name) or {}
+        return time.time() - float(meta.get("checked") or 0) >= self.revalidate_after
+
+    async def _revalidate(self, key, url, name, cached):
+        meta = dict(self._meta.get(name) or {})
+        try:
+            content, validators = await DOWNLOADS.fetch_conditional(url, meta.get("etag"), meta.get("last_modified"))
+        except Exception as e:
+            logger.warning("Ревалидация %s не удалась (%s) — отдаём кэш", key, e)
+            return cached
+        if content is None or content == cached:
+            with self._lock:
+                validators["checked"] = int(time.time())
+                self._meta[name] = validators
+            self._save_meta()
+            return cached
+        await self._io(self.put, key, url, content, validators)
+        return content
+
+    async def fetch(self, key, url):
+        """Байты картинки: с диска, иначе скачать (DOWNLOADS) и сохранить."""
+        url = drive_direct_url((url or "").strip())
+        if not url:
+            raise DownloadError("пустой URL")
+        cached = await self._io(self.get, key, url)
+        if cached is not None:
+            name = self._name(key, url)
+            if self._revalidate_due(name):
+                return await self._revalidate(key, url, name, cached)
+            return cached
+        content = await DOWNLOADS.fetch(url)
+        await self._io(self.put, key, url, content)
+        return content
+
+    async def _fetch_or_none(self, key, url):
+        if not url:
+            return None
+        try:
+            return await self.fetch(key, url)
+        except Exception as e:
+            logger.warning("Failed to download image %s: %s", url, e)
+            return None
+
+    async def fetch_many(self, items):
+        """items: [(key, url) | None, ...] -> [bytes | None, ...] (параллельно, порядок сохраняется)."""
+        return list(await asyncio.gather(*(self._fetch_or_none(*(it or (None, None))) for it in items)))
+
+    async def fetch_source(self, key, url):
+        """
+        Как fetch, но для рендера в другом процессе: путь к файлу в кэше (без чтения байтов),
+        либо bytes, если файл записать не удалось. None — пустой URL или ошибка загрузки.
+        """
+        url = drive_direct_url((url or "").strip())
+        if not url:
+            return None
+        if not self._loaded:
+            await self._io(self._ensure_loaded)
+        name = self._name(key, url)
+        with self._lock:
+            present = name in self._files
+        content = None
+        try:
+            if not present or self._revalidate_due(name):
+                content = await self.fetch(key, url)
+        except Exception as e:
+            logger.warning("Failed to download image %s: %s", url, e)
+            return None
+        full = await self._io(self._touch, name, content is None)
+        return full if full is not None else content
+
+    def _touch(self, name, count_hit):
+        """Путь к файлу кэша (и подъём в LRU) или None, если файла в кэше нет. Блокирующая."""
+        full = os.path.join(self.path, name)
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+            if count_hit:
+                self.hits += 1
+        if count_hit:
+            metrics.cache_hit("images")
+        try:
+            os.utime(full)
+        except OSError:
+            pass
+        return full
+
+    async def fetch_sources(self, items):
+        """items: [(key, url) | None, ...] -> [путь | bytes | None, ...]."""
+        return list(await asyncio.gather(*(self.fetch_source(*(it or (None, None))) for it in items)))
+
+    def fetch_sync(self, key, url):
+        return DOWNLOADS.run_sync(lambda: self.fetch(key, url))
+
+    def fetch_many_sync(self, items):
+        return DOWNLOADS.run_sync(lambda: self.fetch_many(items))
+
+    def stats(self):
+        self._ensure_loaded()
+        return {"files": len(self._files), "bytes": self._total, "hits": self.hits, "misses": self.misses}
+
+
+IMAGES = ImageDiskCache()
+metrics.CACHE_ITEMS.track("images", fn=lambda: len(IMAGES._files) if IMAGES._loaded else None)
+
+
+# ответы Telegram на протухший / чужой file_id: "Wrong file identifier/HTTP URL specified",
+# "Wrong remote file identifier specified", "Invalid file_id", "File reference expired" ...
+_BAD_FILE_ID_RE = re.compile(r"wrong (remote )?file|invalid file|file_id|file reference|file identifier", re.IGNORECASE)
+
+
+def is_bad_file_id(exc) -> bool:
+    """
+    True — Telegram отверг сам file_id (его можно забыть). Сетевые ошибки, таймауты, RetryAfter,
+    Forbidden и прочие BadRequest — нет: file_id рабочий, а повторная загрузка может задвоить сообщение.
+    """
+    return isinstance(exc, BadRequest) and bool(_BAD_FILE_ID_RE.search(getattr(exc, "message", "") or str(exc)))
+
+
+def file_id_from_message(msg):
+    try:
+        if getattr(msg, "photo", None):
+            return msg.photo[-1].file_id
+        if getattr(msg, "document", None):
+            return msg.document.file_id
+    except Exception:
+        logger.exception("Не удалось прочитать file_id из сообщения")
+    return None
+
+
+async def download_bytes(url, key=None):
+    """Байты картинки; с ключом — через дисковый кэш IMAGES."""
+    if key:
+        return await IMAGES.fetch(key, url)
+    return await DOWNLOADS.fetch(url)
+
+
+async def send_photo_cached(bot, chat_id, key, url, caption=None, reply_markup=None, filename="photo.jpg", bulk=False):
+    """
+    Отправляет картинку с ключом key:
+      1) по сохранённому file_id (мгновенно, без трафика);
+      2) по URL (если для ключа это работало или способ ещё неизвестен);
+      3) байтами из дискового кэша IMAGES (скачиваются один раз) с загрузкой в Telegram.
+    Успешный file_id и способ доставки запоминаются. Возвращает Message или None.
+    file_id забывается только если Telegram отверг именно его (is_bad_file_id); прочие ошибки
+    отправки по file_id пробрасываются — без повторной загрузки и двойного сообщения.
+    bulk=True — фоновая отправка (прогрев): пропускает вперёд ответы пользователям.
+    """
+    extra = send_limiter.bulk_args(bot) if bulk else {}
+    url = drive_direct_url((url or "").strip())
+    entry = FILE_IDS.get(key, url)
+
+    fid = entry.get("file_id") if entry else None
+    if fid:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=fid, caption=caption, reply_markup=reply_markup, **extra)
+        except BadRequest as e:
+            if not is_bad_file_id(e):
+                raise
+            logger.warning("send_photo по file_id (%s) не удался: %s", key, e)
+            FILE_IDS.forget(key)
+
+    if not url:
+        return None
+
+    known_method = entry.get("method") if entry else None
+    tried_url = False
+    if known_method != METHOD_BYTES:
+        tried_url = True
+        try:
+            sent = await bot.send_photo(chat_id=chat_id, photo=url, caption=caption, reply_markup=reply_markup, **extra)
+            FILE_IDS.remember(key, url, file_id_from_message(sent), METHOD_URL)
+            return sent
+        except Exception as e:
+            logger.warning("send_photo по URL (%s) не удался: %s; пробую скачать байты", key, e)
+
+    try:
+        content = await download_bytes(url, key)
+        bio = BytesIO(content)
+        bio.name = filename
+        sent = await bot.send_photo(chat_id=chat_id, photo=InputFile(bio, filename=filename), caption=caption, reply_markup=reply_markup, **extra)
+        FILE_IDS.remember(key, url, file_id_from_message(sent), METHOD_BYTES)
+        return sent
+    except Exception as e:
+        logger.warning("Не удалось скачать/отправить байты (%s): %s", key, e)
+
+    if not tried_url:
+        try:
+            sent = await bot.send_photo(chat_id=chat_id, photo=url, caption=caption, reply_markup=reply_markup, **extra)
+            FILE_IDS.remember(key, url, file_id_from_message(sent), METHOD_URL)
+            return sent
+        except Exception as e:
+            logger.warning("send_photo по URL (%s) не удался: %s", key, e)
+    return None
+
+
+
+class _UploadItem:
+    __slots__ = ("data", "filename", "caption", "future")
+
+    def __init__(self, data, filename, caption, future):
+        self.data = data
+        self.filename = filename
+        self.caption = caption
+        self.future = future
+
+
+class CacheUploader:
+    """
+    Сервис загрузки картинок в канал-хранилище (CACHE_CHANNEL_ID) только ради file_id.
+    - upload() кладёт картинку в очередь и возвращает future с file_id;
+    - один фоновый воркер собирает пакеты до UPLOAD_BATCH_SIZE за UPLOAD_BATCH_WINDOW сек
+      и отправляет их одним send_media_group (одиночные — send_photo);
+    - между запросами выдерживается UPLOAD_MIN_INTERVAL, RetryAfter от Telegram соблюдается;
+    - в канале сообщения остаются (это и есть хранилище). Если канал не задан и загрузки идут
+      в служебный/админский чат (delete_after=True) — сообщения удаляются после получения file_id.
+    """
+
+    def __init__(self, batch_size=UPLOAD_BATCH_SIZE, window=UPLOAD_BATCH_WINDOW, min_interval=UPLOAD_MIN_INTERVAL):
+        self.batch_size = max(1, min(10, batch_size))
+        self.window = window
+        self.min_interval = min_interval
+        self.bot = None
+        self.chat_id = None
+        self.delete_after = False
+        self._queue = None
+        self._task = None
+        self._last_call = 0.0
+        self.uploaded = 0
+        self.batches = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, bot, chat_id, delete_after=False):
+        if not chat_id:
+            logger.warning("uploader: не задан CACHE_CHANNEL_ID / служебный чат — загрузки ради file_id отключены")
+            return
+        if self.running:
+            return
+        self.bot = bot
+        self.chat_id = chat_id
+        self.delete_after = delete_after
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info("uploader: chat=%s batch=%d window=%.1fs interval=%.1fs", chat_id, self.batch_size, self.window, self.min_interval)
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            # незавершённый пакет воркер сам отклоняет при отмене (см. _run)
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        # никто не должен зависнуть на future навсегда
+        pending = []
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        self._fail(pending, RuntimeError("uploader остановлен"))
+
+    @staticmethod
+    def _fail(items, exc):
+        for it in items:
+            if not it.future.done():
+                it.future.set_exception(exc)
+
+    def submit(self, data, filename="photo.jpg", caption=None):
+        """Поставить картинку в очередь; возвращает asyncio.Future с file_id (или исключением)."""
+        if not self.running:
+            raise RuntimeError("uploader не запущен")
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_UploadItem(bytes(data), filename, caption, fut))
+        return fut
+
+    async def upload(self, data, filename="photo.jpg", caption=None):
+        """Загрузить картинку и вернуть file_id (или None)."""
+        return await self.submit(data, filename, caption)
+
+    async def _collect(self, batch):
+        """Набрать пакет в batch (список воркера — при отмене на середине сбора элементы не теряются)."""
+        loop = asyncio.get_running_loop()
+        batch.append(await self._queue.get())
+        deadline = loop.time() + self.window
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        batch[:] = [it for it in batch if not it.future.done()]
+        return batch
+
+    async def _pace(self):
+        loop = asyncio.get_running_loop()
+        wait = self._last_call + self.min_interval - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_call = loop.time()
+
+    async def _send(self, batch):
+        def _input(it):
+            bio = BytesIO(it.data)
+            bio.name = it.filename
+            return InputFile(bio, filename=it.filename)
+
+        if len(batch) == 1:
+            it = batch[0]
+            return [await self.bot.send_photo(chat_id=self.chat_id, photo=_input(it), caption=it.caption,
+                                              **send_limiter.bulk_args(self.bot))]
+        media_items = [InputMediaPhoto(media=_input(it), caption=it.caption) for it in batch]
+        return list(await self.bot.send_media_group(chat_id=self.chat_id, media=media_items,
+                                                    **send_limiter.bulk_args(self.bot)))
+
+    async def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = []
+                await self._process(await self._collect(batch))
+        except asyncio.CancelledError:
+            # stop() посреди пакета: элементы уже сняты с очереди — отклоняем их future здесь
+            self._fail(batch, RuntimeError("uploader остановлен"))
+            raise
+
+    async def _process(self, batch):
+        if not batch:
+            return
+        for attempt in range(3):
+            await self._pace()
+            try:
+                messages = await self._send(batch)
+            except RetryAfter as e:
+                delay = getattr(e, "retry_after", 5)
+                delay = delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+                logger.warning("uploader: RetryAfter %.1fs", delay)
+                await asyncio.sleep(delay)
+                continue
+            except Exception as e:
+                logger.exception("uploader: не удалось загрузить пакет из %d картинок", len(batch))
+                self._fail(batch, e)
+                break
+            self.batches += 1
+            for it, msg in zip(batch, messages):
+                fid = file_id_from_message(msg)
+                if fid:
+                    self.uploaded += 1
+                if not it.future.done():
+                    it.future.set_result(fid)
+            if self.delete_after:
+                for msg in messages:
+                    try:
+                        await self.bot.delete_message(chat_id=self.chat_id, message_id=msg.message_id,
+                                                      **send_limiter.bulk_args(self.bot))
+                    except Exception:
+                        pass
+            break
+        else:
+            self._fail(batch, RuntimeError("uploader: превышено число попыток"))
+
+
+UPLOADER = CacheUploader()
+
+async def warmup_file_ids(bot, items, chat_id, concurrency=WARMUP_CONCURRENCY, delay=WARMUP_DELAY):
+    """
+    Прогрев кэша file_id: загружает в служебный чат chat_id картинки, для которых ещё нет file_id,
+    и сразу удаляет служебные сообщения.
+    items: [(key, url, filename), ...]. Уже прогретые ключи пропускаются — после рестарта
+    прогрев продолжается с того места, где остановился (FILE_IDS сохраняется на диск).
+    Возвращает количество новых file_id.
+    """
+    pending = [(k, u, f) for k, u, f in items if u and not FILE_IDS.get_file_id(k, drive_direct_url(u))]
+    if not pending:
+        logger.info("warmup: все %d картинок уже имеют file_id", len(items))
+        return 0
+    logger.info("warmup: нужно загрузить %d из %d картинок", len(pending), len(items))
+
+    sem = asyncio.Semaphore(max(1, concurrency))
+    done = 0
+
+    async def _one(key, url, filename):
+        nonlocal done
+        async with sem:
+            try:
+                sent = await send_photo_cached(bot, chat_id, key, url, caption=f"cache {key}", filename=filename, bulk=True)
+                if sent is not None:
+                    done += 1
+                    try:
+                        await bot.delete_message(chat_id=chat_id, message_id=sent.message_id, **send_limiter.bulk_args(bot))
+                    except Exception:
+                        pass
+                else:
+                    logger.warning("warmup: не удалось загрузить %s (%s)", key, url)
+            except Exception:
+                logger.exception("warmup: ошибка при загрузке %s", key)
+            # не упираемся в лимиты Telegram на один чат
+            await asyncio.sleep(delay)
+
+    await asyncio.gather(*(_one(*it) for it in pending))
+    logger.info("warmup: готово, новых file_id: %d (всего в кэше: %d)", done, len(FILE_IDS))
+    return done
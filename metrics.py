@@ -0,0 +1,339 @@
+"""
+metrics.py
+
+Метрики процесса в формате Prometheus (text exposition 0.0.4), без внешних зависимостей:
+- Counter / Gauge / Histogram с метками, потокобезопасные (Sheets и рендер работают в потоках executor);
+- REGISTRY.render() — текст для GET /metrics (web_server);
+- готовые метрики: обработка апдейтов по маршруту, вызовы Google Sheets, Bot API, скачивания картинок,
+  рендер рамок, попадания/промахи и возраст кэшей.
+
+Sheets считаются на уровне HTTP: gspread.authorize(creds, http_client=metrics.sheets_http_client()).
+Те же точки сообщают вызовы в call_trace (бюджет вызовов на апдейт).
+"""
+import re
+import time
+import threading
+from urllib.parse import unquote
+
+import call_trace
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names, values, extra=None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _fmt_value(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получено {labels}")
+        return tuple(str(v) for v in labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1.0):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, *labels):
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Значение задаётся set() или функцией (track) — функция вызывается при каждом чтении /metrics."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._functions = {}
+
+    def set(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def track(self, *labels, fn):
+        """fn() -> число или None (None — значения нет, строка не выводится)."""
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = fn
+
+    def render(self):
+        with self._lock:
+            items = dict(self._values)
+            functions = dict(self._functions)
+        for key, fn in functions.items():
+            try:
+                v = fn()
+            except Exception:
+                v = None
+            if v is not None:
+                items[key] = float(v)
+        return self.header() + [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}"
+                                for k, v in sorted(items.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            st = self._values.get(key)
+            if st is None:
+                st = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    st[0][i] += 1
+                    break
+            st[1] += value
+            st[2] += 1
+
+    def time(self, *labels):
+        """with HIST.time("label"): ... — наблюдает длительность блока в секундах."""
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                le_label = 'le="%s"' % _fmt_value(le)
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le_label)} {acc}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(total)}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "t0")
+
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(*self.labels, value=time.perf_counter() - self.t0)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- апдейты ---
+UPDATE_SECONDS = REGISTRY.histogram("bot_update_seconds", "Время обработки апдейта по маршруту", ["route"])
+UPDATE_ERRORS = REGISTRY.counter("bot_update_errors_total", "Апдейты, обработка которых упала", ["route"])
+
+# --- Google Sheets ---
+SHEETS_CALLS = REGISTRY.counter("sheets_calls_total", "HTTP-вызовы Google Sheets API", ["op", "worksheet"])
+SHEETS_SECONDS = REGISTRY.histogram("sheets_call_seconds", "Длительность вызова Google Sheets API", ["op"])
+SHEETS_ERRORS = REGISTRY.counter("sheets_errors_total", "Ошибки Google Sheets API", ["op", "status"])
+
+# --- Bot API ---
+BOT_API_CALLS = REGISTRY.counter("bot_api_calls_total", "Вызовы Bot API", ["endpoint", "result"])
+BOT_API_SECONDS = REGISTRY.histogram("bot_api_call_seconds", "Длительность вызова Bot API (без ожидания лимитера)", ["endpoint"])
+BOT_API_WAIT_SECONDS = REGISTRY.histogram("bot_api_wait_seconds", "Ожидание в лимитере отправки", ["priority"])
+
+# --- скачивания картинок ---
+DOWNLOADS = REGISTRY.counter("image_downloads_total", "Скачивания картинок по сети", ["result"])
+DOWNLOAD_SECONDS = REGISTRY.histogram("image_download_seconds", "Длительность скачивания картинки")
+DOWNLOAD_BYTES = REGISTRY.counter("image_download_bytes_total", "Скачано байт картинок")
+
+# --- рендер рамок ---
+FRAME_RENDER_SECONDS = REGISTRY.histogram("frame_render_seconds", "Рендер рамки: композиция / кодирование", ["profile", "stage"])
+FRAME_RENDER_BYTES = REGISTRY.counter("frame_render_bytes_total", "Размер отрендеренных рамок", ["profile"])
+
+# --- кэши ---
+CACHE_REQUESTS = REGISTRY.counter("cache_requests_total", "Обращения к кэшам", ["cache", "result"])
+CACHE_AGE = REGISTRY.gauge("cache_age_seconds", "Возраст данных в кэше", ["cache"])
+CACHE_ITEMS = REGISTRY.gauge("cache_items", "Число элементов в кэше", ["cache"])
+
+
+def cache_hit(cache):
+    CACHE_REQUESTS.inc(cache, "hit")
+
+
+def cache_miss(cache):
+    CACHE_REQUESTS.inc(cache, "miss")
+
+
+# --- маршрут апдейта ---
+
+_TAIL_IDS = re.compile(r"([_:]-?\d+)+$")
+
+
+def update_route(update) -> str:
+    """Метка маршрута: callback:<префикс без id>, cmd:/<команда>, text, message или other."""
+    query = getattr(update, "callback_query", None)
+    if query is not None:
+        data = str(query.data or "")
+        head = data.split(":", 1)[0]
+        head = _TAIL_IDS.sub("", head) or "?"
+        return "callback:" + head[:48]
+    message = getattr(update, "message", None) or getattr(update, "edited_message", None)
+    if message is not None:
+        text = getattr(message, "text", None) or ""
+        if text.startswith("/"):
+            cmd = text.split()[0].split("@", 1)[0]
+            return "cmd:" + cmd[:32]
+        return "text" if text else "message"
+    return "other"
+
+
+# --- Google Sheets: HTTP-клиент gspread с метриками ---
+
+_SHEETS_OPS = (
+    ("values:batchGet", "values_batch_get"),
+    ("values:batchUpdate", "values_batch_update"),
+    ("values:batchClear", "values_batch_clear"),
+    (":batchUpdate", "batch_update"),
+    (":append", "values_append"),
+    (":clear", "values_clear"),
+)
+
+
+def sheets_op(method: str, url: str):
+    """(операция, лист) по HTTP-запросу gspread."""
+    path = url.split("?", 1)[0]
+    op = None
+    for suffix, name in _SHEETS_OPS:
+        if path.endswith(suffix):
+            op = name
+            break
+    worksheet = "-"
+    m = re.search(r"/values/([^:]+)", path)
+    if m:
+        rng = unquote(m.group(1))
+        worksheet = rng.split("!", 1)[0].strip("'") if "!" in rng else rng.strip("'")
+        if op is None:
+            op = "values_get" if method.upper() == "GET" else "values_update"
+    if op is None:
+        if "/spreadsheets/" in path:
+            op = "metadata" if method.upper() == "GET" else method.lower()
+        elif "googleapis.com/drive" in path:
+            op = "drive"
+        else:
+            op = method.lower()
+    return op, worksheet or "-"
+
+
+def _worksheet_from_body(params, json_body):
+    try:
+        ranges = (params or {}).get("ranges")
+        if ranges:
+            rng = ranges[0] if isinstance(ranges, (list, tuple)) else ranges
+            return str(rng).split("!", 1)[0].strip("'")
+        data = (json_body or {}).get("data")
+        if data:
+            return str(data[0].get("range", "-")).split("!", 1)[0].strip("'")
+    except Exception:
+        pass
+    return "-"
+
+
+_SHEETS_CLIENT_CLS = None
+
+
+def sheets_http_client():
+    """Подкласс gspread HTTPClient, считающий каждый запрос (создаётся лениво — gspread нужен не везде)."""
+    global _SHEETS_CLIENT_CLS
+    if _SHEETS_CLIENT_CLS is not None:
+        return _SHEETS_CLIENT_CLS
+    from gspread.http_client import HTTPClient
+
+    class MetricsHTTPClient(HTTPClient):
+        def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+            op, worksheet = sheets_op(method, endpoint)
+            if worksheet == "-":
+                worksheet = _worksheet_from_body(params, json)
+            SHEETS_CALLS.inc(op, worksheet)
+            t0 = time.perf_counter()
+            nbytes = 0
+            try:
+                response = super().request(method, endpoint, params=params, data=data, json=json, files=files, headers=headers)
+                nbytes = len(response.content or b"")
+                return response
+            except Exception as e:
+                status = getattr(getattr(e, "response", None), "status_code", None) or type(e).__name__
+                SHEETS_ERRORS.inc(op, status)
+                raise
+            finally:
+                seconds = time.perf_counter() - t0
+                SHEETS_SECONDS.observe(op, value=seconds)
+                call_trace.record("sheets", f"{op}:{worksheet}", seconds, nbytes)
+
+    _SHEETS_CLIENT_CLS = MetricsHTTPClient
+    return _SHEETS_CLIENT_CLS
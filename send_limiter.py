@@ -0,0 +1,310 @@
+"""
+send_limiter.py
+
+Планировщик исходящих запросов к Bot API (rate limiter для Application):
+- глобальный token bucket (по умолчанию 30 сообщений/сек на бота);
+- token bucket на каждый чат (личка ~1 сообщение/сек с небольшим запасом, группы/каналы ~20 в минуту);
+- приоритеты: ответы пользователю (PRIORITY_INTERACTIVE, по умолчанию) получают глобальные токены
+  раньше фоновых отправок (PRIORITY_BULK — прогрев file_id, канал-хранилище и т.п.);
+- RetryAfter от Telegram: чат (или весь бот) ставится на паузу, запрос повторяется прозрачно —
+  для чата повтор идёт, не отпуская его очередь, так что порядок сообщений не меняется.
+
+Подключение: ApplicationBuilder().rate_limiter(send_limiter.SEND_LIMITER).
+Фоновые отправки: await bot.send_photo(..., **send_limiter.bulk_args(bot)).
+"""
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+import call_trace
+
+logger = logging.getLogger(__name__)
+
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30"))        # сообщений/сек на бота
+SEND_GLOBAL_BURST = float(os.environ.get("SEND_GLOBAL_BURST", "30"))
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", "1.0"))           # сообщений/сек в личный чат
+SEND_CHAT_BURST = float(os.environ.get("SEND_CHAT_BURST", "3"))
+SEND_GROUP_RATE = float(os.environ.get("SEND_GROUP_RATE", str(20 / 60)))  # сообщений/сек в группу/канал
+SEND_GROUP_BURST = float(os.environ.get("SEND_GROUP_BURST", "3"))
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", "3"))
+SEND_MAX_RETRY_AFTER = float(os.environ.get("SEND_MAX_RETRY_AFTER", "60"))  # сек; дольше — ошибка уходит вызывающему
+SEND_CHAT_STATES_MAX = int(os.environ.get("SEND_CHAT_STATES_MAX", "10000"))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# запросы, не считающиеся сообщениями в чат, но идущие через общий лимит бота
+_GLOBAL_ONLY = {"deleteMessage", "deleteMessages", "sendChatAction"}
+# запросы, которые нельзя задерживать (пользователь ждёт «часики» на кнопке)
+_UNLIMITED = {"answerCallbackQuery", "answerInlineQuery", "answerPreCheckoutQuery", "answerShippingQuery"}
+
+
+def _is_chat_endpoint(endpoint: str) -> bool:
+    if endpoint in _GLOBAL_ONLY:
+        return False
+    return endpoint.startswith("send") or endpoint.startswith("edit") or endpoint in (
+        "copyMessage", "copyMessages", "forwardMessage", "forwardMessages")
+
+
+def is_group_chat(chat_id) -> bool:
+    """
+    Группа/канал (лимит ~20 в минуту) или личный чат. chat_id из env приходит строкой ("-100123") —
+    числовые строки разбираются как числа; нечисловая строка — это @username, а он бывает только у групп и каналов.
+    """
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        return isinstance(chat_id, str)
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    delay = getattr(e, "retry_after", 5)
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+
+def _upload_bytes(data) -> int:
+    """Сколько байт файлов уходит в запросе (InputFile в параметрах и в media)."""
+    total = 0
+    if not isinstance(data, dict):
+        return 0
+    values = list(data.values())
+    for v in list(values):
+        if isinstance(v, (list, tuple)):
+            values.extend(getattr(m, "media", None) for m in v)
+    for v in values:
+        content = getattr(v, "input_file_content", None)
+        if isinstance(content, (bytes, bytearray)):
+            total += len(content)
+    return total
+
+
+def bulk_args(bot) -> dict:
+    """kwargs для фоновой отправки: rate_limit_args=PRIORITY_BULK, если у бота есть rate limiter."""
+    if getattr(bot, "rate_limiter", None) is None:
+        return {}
+    return {"rate_limit_args": PRIORITY_BULK}
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity. Запрос дороже 1 токена может уйти в долг."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(rate, 1e-6)
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def take(self, cost: float = 1.0) -> float:
+        """Взять cost токенов: 0.0 если получилось, иначе сколько секунд подождать."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        need = min(cost, self.capacity)
+        if self.tokens >= need:
+            self.tokens -= cost
+            return 0.0
+        return (need - self.tokens) / self.rate
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class _ChatState:
+    __slots__ = ("bucket", "lock")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        # FIFO внутри чата: сообщения одного чата уходят в порядке вызова (lock держится и на время запроса)
+        self.lock = asyncio.Lock()
+
+
+class SendScheduler(BaseRateLimiter):
+    """
+    Rate limiter для python-telegram-bot: сначала очередь чата (его bucket), затем глобальный bucket,
+    который раздаёт токены по приоритету (меньше — раньше), внутри приоритета — по порядку прихода.
+    rate_limit_args — приоритет (int) или None (PRIORITY_INTERACTIVE).
+    """
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, global_burst=SEND_GLOBAL_BURST, max_retries=SEND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.max_retries = max_retries
+        self._global = None
+        self._chats = OrderedDict()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = None
+        self.sent = 0
+        self.delayed = 0
+        self.retries = 0
+        self.max_wait = 0.0
+
+    async def initialize(self) -> None:
+        self._global = TokenBucket(self.global_rate, self.global_burst)
+        self._cond = asyncio.Condition()
+        logger.info("send limiter: global %.0f/s, chat %.2f/s, group %.2f/s",
+                    self.global_rate, SEND_CHAT_RATE, SEND_GROUP_RATE)
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _chat_state(self, chat_id) -> _ChatState:
+        st = self._chats.get(chat_id)
+        if st is None:
+            group = is_group_chat(chat_id)
+            bucket = TokenBucket(SEND_GROUP_RATE, SEND_GROUP_BURST) if group else TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+            st = self._chats[chat_id] = _ChatState(bucket)
+            self._prune()
+        else:
+            self._chats.move_to_end(chat_id)
+        return st
+
+    def _prune(self):
+        # выбрасываем самые старые чаты без ожидающих запросов
+        extra = len(self._chats) - SEND_CHAT_STATES_MAX
+        if extra <= 0:
+            return
+        for chat_id in list(self._chats.keys()):
+            if extra <= 0:
+                break
+            if not self._chats[chat_id].lock.locked():
+                del self._chats[chat_id]
+                extra -= 1
+
+    async def _acquire_global(self, priority: int):
+        entry = (priority, next(self._seq))
+        async with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    timeout = None
+                    if self._waiters[0] == entry:
+                        timeout = self._global.take()
+                        if timeout <= 0:
+                            heapq.heappop(self._waiters)
+                            return
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                raise
+            finally:
+                # следующий в очереди проверяет свою очередь
+                self._cond.notify_all()
+
+    async def _acquire_chat(self, st: _ChatState, cost: float, priority: int):
+        while True:
+            wait = st.bucket.take(cost)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        await self._acquire_global(priority)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in _UNLIMITED or self._global is None:
+            return await self._call(callback, args, kwargs, endpoint)
+
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else PRIORITY_INTERACTIVE
+        chat_id = data.get("chat_id") if _is_chat_endpoint(endpoint) else None
+        cost = float(len(data.get("media") or ())) if endpoint == "sendMediaGroup" else 1.0
+        cost = max(cost, 1.0)
+
+        if chat_id is None:
+            for attempt in range(self.max_retries + 1):
+                t0 = time.monotonic()
+                await self._acquire_global(priority)
+                self._note_wait(time.monotonic() - t0, endpoint, None, priority)
+                try:
+                    result = await self._call(callback, args, kwargs, endpoint)
+                except RetryAfter as e:
+                    delay = _retry_after_seconds(e)
+                    if attempt >= self.max_retries or delay > SEND_MAX_RETRY_AFTER:
+                        raise
+                    self._global.pause(delay)
+                    self.retries += 1
+                    logger.warning("send limiter: RetryAfter %.1fs for %s (попытка %d)", delay, endpoint, attempt + 1)
+                    continue
+                self.sent += 1
+                return result
+
+        # Очередь чата держится и на время самого HTTP-запроса — намеренно: Telegram не гарантирует
+        # порядок для одновременных запросов в один чат, а ответы бота (карточка, затем текст с кнопками)
+        # должны приходить по порядку. Цена — медленная загрузка задерживает следующее сообщение этого
+        # чата на своё время; другие чаты она не трогает. Повтор после RetryAfter — тоже внутри очереди.
+        st = self._chat_state(chat_id)
+        t0 = time.monotonic()
+        async with st.lock:
+            for attempt in range(self.max_retries + 1):
+                await self._acquire_chat(st, cost, priority)
+                self._note_wait(time.monotonic() - t0, endpoint, chat_id, priority)
+                try:
+                    result = await self._call(callback, args, kwargs, endpoint)
+                except RetryAfter as e:
+                    delay = _retry_after_seconds(e)
+                    if attempt >= self.max_retries or delay > SEND_MAX_RETRY_AFTER:
+                        raise
+                    st.bucket.pause(delay)
+                    self.retries += 1
+                    logger.warning("send limiter: RetryAfter %.1fs for %s chat=%s (попытка %d)",
+                                   delay, endpoint, chat_id, attempt + 1)
+                    t0 = time.monotonic()
+                    continue
+                self.sent += 1
+                return result
+
+    async def _call(self, callback, args, kwargs, endpoint):
+        t0 = time.perf_counter()
+        result = "ok"
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter:
+            result = "retry_after"
+            raise
+        except Exception:
+            result = "error"
+            raise
+        finally:
+            seconds = time.perf_counter() - t0
+            metrics.BOT_API_CALLS.inc(endpoint, result)
+            metrics.BOT_API_SECONDS.observe(endpoint, value=seconds)
+            call_trace.record("bot", endpoint, seconds, _upload_bytes(args[1] if len(args) > 1 else None))
+
+    def _note_wait(self, waited: float, endpoint, chat_id, priority=PRIORITY_INTERACTIVE):
+        metrics.BOT_API_WAIT_SECONDS.observe("bulk" if priority >= PRIORITY_BULK else "interactive", value=waited)
+        if waited > 0.001:
+            self.delayed += 1
+            self.max_wait = max(self.max_wait, waited)
+            if waited > 1.0:
+                logger.info("send limiter: %s chat=%s ждал %.1f с", endpoint, chat_id, waited)
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "delayed": self.delayed,
+            "retries": self.retries,
+            "max_wait_s": round(self.max_wait, 2),
+            "chats": len(self._chats),
+            "waiting": len(self._waiters),
+        }
+
+
+SEND_LIMITER = SendScheduler()
@@ -0,0 +1,13 @@
+"""
+Общие настройки тестов: модули бота лежат в корне репозитория и читают обязательные
+переменные окружения при импорте — подставляем заглушки до импорта (к таблицам тесты не ходят).
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault("SPREADSHEET_KEY", "test")
+os.environ.setdefault("BOT_TOKEN", "123:test")
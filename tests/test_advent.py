@@ -0,0 +1,39 @@
+from datetime import date
+
+import pytest
+
+import winter
+
+
+@pytest.fixture(autouse=True)
+def fixed_event(monkeypatch):
+    monkeypatch.setattr(winter, "_default_advent_start_end", lambda: (date(2025, 12, 22), date(2026, 1, 10)))
+
+
+def test_before_start_all_waiting():
+    state, stored = winter.resolve_advent_state({"ADVENT_STATE": ""}, 5, today=date(2025, 12, 1))
+    assert state == "wwwww"
+    assert stored == ""
+
+
+def test_opens_days_up_to_today_and_keeps_claimed():
+    record = {"advent_state": "1wwww"}  # заголовок без учёта регистра
+    state, stored = winter.resolve_advent_state(record, 5, today=date(2025, 12, 24))
+    assert state == "100ww"
+    assert stored == "1wwww"
+
+
+def test_after_end_everything_open():
+    state, _ = winter.resolve_advent_state({"ADVENT_STATE": "w1w"}, 3, today=date(2026, 2, 1))
+    assert state == "010"
+
+
+def test_short_stored_state_is_reset():
+    state, _ = winter.resolve_advent_state({"ADVENT_STATE": "11"}, 4, today=date(2025, 12, 23))
+    assert state == "00ww"
+
+
+def test_future_days_go_back_to_waiting():
+    # состояние из таблицы «забежало вперёд» (например, сдвинули даты ивента)
+    state, _ = winter.resolve_advent_state({"ADVENT_STATE": "1111"}, 4, today=date(2025, 12, 23))
+    assert state == "11ww"
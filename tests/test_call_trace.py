@@ -0,0 +1,35 @@
+import asyncio
+
+import call_trace
+
+
+def test_background_task_does_not_record_after_stop():
+    tracer = call_trace.Tracer()
+
+    async def background(started, release):
+        started.set()
+        await release.wait()
+        call_trace.record("sheets", "values_get", 0.01)
+
+    async def main():
+        started, release = asyncio.Event(), asyncio.Event()
+        trace, token = tracer.start("shop", update_id=1)
+        call_trace.record("bot", "sendMessage", 0.02, 100)
+        task = asyncio.create_task(background(started, release))   # наследует трассу
+        await started.wait()
+        tracer.stop(trace, token)
+        release.set()
+        await task
+        return trace
+
+    trace = asyncio.run(main())
+    assert trace.closed
+    assert trace.calls["sheets"] == 0 and trace.calls["bot"] == 1
+    assert trace.late == 1
+    [row] = tracer.top(by="bot")
+    assert row["total_bot_calls"] == 1 and row["total_sheets_calls"] == 0
+
+
+def test_record_outside_update_is_noop():
+    assert call_trace.current() is None
+    call_trace.record("sheets", "values_get", 0.01)
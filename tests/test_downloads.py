@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+import pytest
+
+import media
+
+
+def test_single_flight_dedups_and_shares_result():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "x"
+
+    async def main():
+        sf = media.SingleFlight()
+        results = await asyncio.gather(*(sf.do("k", work) for _ in range(5)))
+        assert "k" not in sf
+        return results
+
+    assert asyncio.run(main()) == ["x"] * 5
+    assert len(calls) == 1
+
+
+def test_single_flight_shares_error_and_forgets_key():
+    async def boom():
+        await asyncio.sleep(0)
+        raise ValueError("nope")
+
+    async def main():
+        sf = media.SingleFlight()
+        res = await asyncio.gather(sf.do("k", boom), sf.do("k", boom), return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in res)
+        assert "k" not in sf
+
+    asyncio.run(main())
+
+
+def test_single_flight_cancelled_waiter_does_not_cancel_shared_task():
+    async def slow():
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def main():
+        sf = media.SingleFlight()
+        first = asyncio.ensure_future(sf.do("k", slow))
+        second = asyncio.ensure_future(sf.do("k", slow))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == 42
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    asyncio.run(main())
+
+
+def test_run_sync_standalone_uses_private_session(monkeypatch):
+    dm = media.DownloadManager()
+    seen = []
+    lock = threading.Lock()
+
+    async def fake_read(self, session, url):
+        await asyncio.sleep(0.05)
+        with lock:
+            seen.append((session, asyncio.get_running_loop()))
+        return url.encode()
+
+    monkeypatch.setattr(media.DownloadManager, "_read", fake_read)
+
+    results = {}
+
+    def worker(i):
+        results[i] = dm.fetch_many_sync([f"u{i}", f"u{i}", None])
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+
+    assert results == {i: [f"u{i}".encode(), f"u{i}".encode(), None] for i in range(3)}
+    # одинаковые URL внутри вызова схлопнулись, сессии и loop'ы у вызовов свои
+    assert len(seen) == 3
+    assert len({id(s) for s, _ in seen}) == 3
+    assert len({id(l) for _, l in seen}) == 3
+    assert all(s.closed for s, _ in seen)
+    # общее состояние менеджера не тронуто
+    assert dm._session is None and dm._loop is None
+    assert not dm._inflight._inflight
@@ -0,0 +1,39 @@
+import json
+import os
+import time
+
+import media
+
+
+def test_remember_does_not_write_synchronously(tmp_path):
+    path = str(tmp_path / "ids.json")
+    cache = media.FileIdCache(path, max_items=3)
+    cache._writer.delay = 60
+    for i in range(5):
+        cache.remember(f"k{i}", None, f"fid{i}", media.METHOD_BYTES)
+    assert not os.path.exists(path)
+    assert cache.get_file_id("k4") == "fid4"
+    assert cache.get_file_id("k0") is None  # max_items — LRU
+    assert cache.flush()
+    with open(path, encoding="utf-8") as f:
+        assert sorted(json.load(f)) == ["k2", "k3", "k4"]
+    assert cache._writer.writes == 1
+
+
+def test_debounced_writes_are_coalesced(tmp_path):
+    path = str(tmp_path / "ids.json")
+    cache = media.FileIdCache(path)
+    cache._writer.delay = 0.2
+    for i in range(50):
+        cache.remember(f"k{i}", None, f"fid{i}", media.METHOD_BYTES)
+    cache.forget("k0")
+    deadline = time.time() + 5
+    while cache._writer.writes == 0 and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.3)  # второй записи по таймеру не будет
+    assert cache._writer.writes == 1
+
+    reloaded = media.FileIdCache(path)
+    assert reloaded.get_file_id("k49") == "fid49"
+    assert reloaded.get_file_id("k0") is None
+    assert reloaded.method("k0") == media.METHOD_BYTES
@@ -0,0 +1,33 @@
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import frame_render
+import winter
+
+
+def test_canvas_counters_are_thread_safe():
+    cache = frame_render.CanvasCache(max_items=2)
+
+    def bump():
+        for _ in range(2000):
+            cache.count("hits")
+
+    threads = [threading.Thread(target=bump) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert cache.stats()["hits"] == 16000
+
+
+def test_worker_does_not_import_parent_main(monkeypatch):
+    # главный модуль «бота» тянет telegram/gspread — в воркер он попасть не должен
+    monkeypatch.setitem(sys.modules, "__main__", winter)
+    with ProcessPoolExecutor(max_workers=1, mp_context=frame_render.WORKER_CONTEXT) as pool:
+        modules = pool.submit(eval, "sorted(__import__('sys').modules)").result(timeout=120)
+    assert sys.modules["__main__"] is winter
+    assert "frame_render" in modules
+    assert "winter" not in modules
+    assert "telegram" not in modules
+    assert "gspread" not in modules
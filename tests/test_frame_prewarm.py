@@ -0,0 +1,70 @@
+import asyncio
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+
+import frame_render
+import winter_frame
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch, tmp_path):
+    monkeypatch.setattr(winter_frame, "_PREWARMED", type(winter_frame._PREWARMED)())
+    monkeypatch.setattr(winter_frame, "_PREWARM_TASKS", {})
+    ids = winter_frame.media.FileIdCache(str(tmp_path / "frames.json"))
+    ids._writer.delay = 60
+    monkeypatch.setattr(winter_frame, "FRAME_FILE_IDS", ids)
+
+    async def no_upload(*a, **kw):
+        raise AssertionError("prewarm не должен загружать рамку в Telegram")
+
+    monkeypatch.setattr(winter_frame, "upload_frame", no_upload)
+
+
+def fake_context():
+    loop = asyncio.get_running_loop()
+    return SimpleNamespace(application=SimpleNamespace(create_task=loop.create_task))
+
+
+def spec(card):
+    return frame_render.FrameSpec(10, (card, 0, 0, 0, 0))
+
+
+def test_prewarm_is_debounced_per_user(monkeypatch):
+    rendered = []
+
+    async def fake_render(sp, profile=None, user_id=None):
+        rendered.append((sp, user_id))
+        out = BytesIO(b"jpeg")
+        out.name = "frame.jpg"
+        return out
+
+    monkeypatch.setattr(winter_frame, "render_frame", fake_render)
+
+    async def main():
+        ctx = fake_context()
+        for card in (1, 2, 3):
+            winter_frame.schedule_prewarm(ctx, spec(card), user_id=7, delay=0.05)
+            await asyncio.sleep(0.01)
+        other = winter_frame.schedule_prewarm(ctx, spec(9), user_id=8, delay=0.05)
+        await asyncio.sleep(0.2)
+        assert other.done()
+
+    asyncio.run(main())
+    assert sorted(rendered, key=lambda r: r[1]) == [(spec(3), 7), (spec(9), 8)]
+    assert (spec(3), frame_render.DEFAULT_PROFILE) in winter_frame._PREWARMED
+    assert not winter_frame._PREWARM_TASKS
+
+
+def test_confirmed_render_uses_prewarmed_bytes(monkeypatch):
+    key = (spec(4), frame_render.DEFAULT_PROFILE)
+    winter_frame._PREWARMED[key] = (b"ready", "frame.jpg")
+
+    async def broken_renderer(*a, **kw):
+        raise AssertionError("повторный рендер не нужен")
+
+    monkeypatch.setattr(frame_render.RENDERER, "render", broken_renderer)
+    out = asyncio.run(winter_frame.render_frame(spec(4), None, user_id=5))
+    assert out.getvalue() == b"ready" and out.name == "frame.jpg"
+    assert key not in winter_frame._PREWARMED
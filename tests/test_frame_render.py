@@ -0,0 +1,65 @@
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import frame_render
+
+
+def png_bytes(color, size=(40, 50)):
+    out = BytesIO()
+    Image.new("RGB", size, color).save(out, format="PNG")
+    return out.getvalue()
+
+
+@pytest.fixture
+def counted_reads(monkeypatch):
+    reads = []
+    orig = frame_render._read_source
+
+    def _read(src):
+        reads.append(src)
+        return orig(src)
+
+    monkeypatch.setattr(frame_render, "_read_source", _read)
+    return reads
+
+
+def test_tile_from_path_read_only_on_miss(tmp_path, counted_reads):
+    tiles = frame_render.TileCache(max_items=8)
+    path = str(tmp_path / "cat_1.img")
+    with open(path, "wb") as f:
+        f.write(png_bytes((255, 0, 0)))
+
+    first = tiles.get_tile(1, path, 20, 20)
+    os.utime(path)  # попадание в дисковый кэш трогает mtime — плитка остаётся валидной
+    second = tiles.get_tile(1, path, 20, 20)
+    assert first is second
+    assert counted_reads == [path]
+    assert tiles.stats() == {"items": 1, "hits": 1, "misses": 1}
+
+
+def test_tile_rebuilt_when_file_replaced(tmp_path):
+    tiles = frame_render.TileCache(max_items=8)
+    path = str(tmp_path / "cat_1.img")
+    with open(path, "wb") as f:
+        f.write(png_bytes((255, 0, 0)))
+    red = tiles.get_tile(1, path, 20, 20)
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(png_bytes((0, 0, 255)))
+    os.replace(tmp, path)  # так дисковый кэш пишет новую версию картинки
+    blue = tiles.get_tile(1, path, 20, 20)
+    assert blue is not red
+    assert blue.getpixel((5, 5)) == (0, 0, 255)
+
+
+def test_tile_missing_file_and_bytes_source(tmp_path):
+    tiles = frame_render.TileCache(max_items=8)
+    assert tiles.get_tile(1, str(tmp_path / "nope.img"), 20, 20) is None
+    data = png_bytes((0, 255, 0))
+    a = tiles.get_tile(2, data, 20, 20)
+    assert tiles.get_tile(2, data, 20, 20) is a
+    assert tiles.get_tile(2, png_bytes((1, 2, 3)), 20, 20) is not a
@@ -0,0 +1,75 @@
+import asyncio
+import json
+import os
+import threading
+
+import media
+
+
+def make_cache(tmp_path, **kw):
+    cache = media.ImageDiskCache(str(tmp_path / "images"), **kw)
+    cache._meta_writer.delay = 60  # в тестах таймер не должен сработать сам
+    return cache
+
+
+def test_put_get_roundtrip_and_deferred_index(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=10_000, revalidate_after=0)
+    cache.put("cat:1", "http://img/1", b"abc", {"etag": "e1"})
+    assert cache.get("cat:1", "http://img/1") == b"abc"
+    assert cache.get("cat:1", "http://img/other") is None
+
+    # index.json пишется отложенно, а не на каждый put
+    assert not os.path.exists(cache.index_path)
+    assert cache._meta_writer.dirty
+    assert cache.flush()
+    with open(cache.index_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    assert meta[cache._name("cat:1", "http://img/1")]["etag"] == "e1"
+    assert not cache.flush()  # изменений нет — повторной записи нет
+
+
+def test_lru_eviction_by_size(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=10, revalidate_after=0)
+    cache.put("a", "http://a", b"12345")
+    cache.put("b", "http://b", b"12345")
+    assert cache.get("a", "http://a") == b"12345"  # a — свежее b
+    cache.put("c", "http://c", b"12345")
+    assert cache.get("b", "http://b") is None
+    assert cache.get("a", "http://a") == b"12345"
+    assert cache.stats()["bytes"] == 10
+
+
+def test_async_fetch_does_disk_io_off_loop(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, max_bytes=10_000, revalidate_after=0)
+    loop_thread = []
+    io_threads = []
+
+    async def fake_fetch(url):
+        return b"payload"
+
+    orig_put, orig_get = cache.put, cache.get
+
+    def put(*a, **kw):
+        io_threads.append(threading.get_ident())
+        return orig_put(*a, **kw)
+
+    def get(*a, **kw):
+        io_threads.append(threading.get_ident())
+        return orig_get(*a, **kw)
+
+    monkeypatch.setattr(media.DOWNLOADS, "fetch", fake_fetch)
+    monkeypatch.setattr(cache, "put", put)
+    monkeypatch.setattr(cache, "get", get)
+
+    async def main():
+        loop_thread.append(threading.get_ident())
+        first = await cache.fetch("cat:1", "http://img/1")
+        second = await cache.fetch("cat:1", "http://img/1")
+        path = await cache.fetch_source("cat:1", "http://img/1")
+        return first, second, path
+
+    first, second, path = asyncio.run(main())
+    assert first == second == b"payload"
+    assert os.path.isfile(path)
+    assert io_threads and loop_thread[0] not in io_threads
+    assert cache.hits == 2 and cache.misses == 1
@@ -0,0 +1,93 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageChops
+
+import frame_render
+
+
+def card(color):
+    out = BytesIO()
+    img = Image.new("RGB", (120, 160), color)
+    img.paste((255 - color[0], 255 - color[1], 255 - color[2]), (10, 10, 60, 80))  # не однотонная
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+CARDS = {i: card(((i * 53) % 256, (i * 97) % 256, (i * 151) % 256)) for i in range(1, 10)}
+
+
+@pytest.fixture(autouse=True)
+def clean_caches():
+    frame_render.CANVASES.clear()
+    frame_render.TILES.clear()
+    yield
+    frame_render.CANVASES.clear()
+    frame_render.TILES.clear()
+
+
+def render(frame_set, ids, base_ids=None):
+    sources = [CARDS.get(i) for i in ids]
+    # PNG без потерь: сравниваем сами холсты, а не артефакты JPEG
+    out, _, _ = frame_render._compose_and_encode(frame_set, sources, card_ids=ids, profile="png", base_ids=base_ids)
+    return Image.open(out).convert("RGB")
+
+
+@pytest.mark.parametrize("frame_set", [10, 12])
+@pytest.mark.parametrize("old, new", [
+    ((1, 2, 3, 4, 5), (1, 2, 7, 4, 5)),   # заменена одна карточка
+    ((1, 2, 3, 4, 5), (1, 0, 3, 0, 5)),   # слоты очищены
+    ((0, 0, 0, 0, 0), (6, 0, 8, 0, 9)),   # пустая рамка -> заполненная
+    ((1, 2, 3, 4, 5), (5, 4, 3, 2, 1)),   # перестановка
+])
+def test_incremental_matches_full_render(frame_set, old, new):
+    full = render(frame_set, new)
+    frame_render.CANVASES.clear()
+
+    render(frame_set, old)
+    before = frame_render.CANVASES.stats()["partial"]
+    incremental = render(frame_set, new, base_ids=old)
+    assert frame_render.CANVASES.stats()["partial"] == before + 1
+    assert ImageChops.difference(full, incremental).getbbox() is None
+
+
+def test_cached_canvas_is_not_mutated_by_incremental_render():
+    first = render(10, (1, 2, 3, 4, 5))
+    render(10, (9, 2, 3, 4, 5), base_ids=(1, 2, 3, 4, 5))
+    again = render(10, (1, 2, 3, 4, 5))
+    assert frame_render.CANVASES.stats()["hits"] >= 1
+    assert ImageChops.difference(first, again).getbbox() is None
+
+
+def write_card(path, content):
+    tmp = str(path) + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    frame_render.os.replace(tmp, path)   # как дисковый кэш: новая версия — новый inode
+
+
+def test_changed_card_image_is_not_served_from_canvas_cache(tmp_path):
+    ids = (1, 2, 3, 4, 5)
+    paths = [str(tmp_path / f"{i}.png") for i in ids]
+    for i, p in zip(ids, paths):
+        write_card(p, CARDS[i])
+
+    def render_paths():
+        out, _, _ = frame_render._compose_and_encode(10, paths, card_ids=ids, profile="png")
+        return Image.open(out).convert("RGB")
+
+    old = render_paths()
+    assert ImageChops.difference(old, render_paths()).getbbox() is None
+    hits = frame_render.CANVASES.stats()["hits"]
+
+    write_card(paths[2], CARDS[9])           # каталог перечитан: у карточки 3 новая картинка
+    partial = frame_render.CANVASES.stats()["partial"]
+    updated = render_paths()
+    assert frame_render.CANVASES.stats()["hits"] == hits
+    assert frame_render.CANVASES.stats()["partial"] == partial + 1   # перерисован только её слот
+
+    frame_render.CANVASES.clear()
+    frame_render.TILES.clear()
+    full = render_paths()
+    assert ImageChops.difference(full, updated).getbbox() is None
+    assert ImageChops.difference(full, old).getbbox() is not None
@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, NetworkError, TimedOut
+
+import media
+
+
+class FakeBot:
+    def __init__(self, fail_on_file_id=None):
+        self.fail_on_file_id = fail_on_file_id
+        self.sent = []
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        if photo == "FID" and self.fail_on_file_id is not None:
+            raise self.fail_on_file_id
+        self.sent.append(photo)
+        return SimpleNamespace(message_id=len(self.sent), photo=[SimpleNamespace(file_id="NEW")], document=None)
+
+
+@pytest.fixture
+def file_ids(tmp_path, monkeypatch):
+    cache = media.FileIdCache(str(tmp_path / "file_ids.json"))
+    cache.remember("cat:1", "http://img/1", "FID", media.METHOD_URL)
+    monkeypatch.setattr(media, "FILE_IDS", cache)
+    return cache
+
+
+@pytest.mark.parametrize("exc, bad", [
+    (BadRequest("Wrong file identifier/HTTP URL specified"), True),
+    (BadRequest("Bad Request: wrong remote file identifier specified: wrong padding"), True),
+    (BadRequest("Invalid file_id"), True),
+    (BadRequest("Message caption is too long"), False),
+    (TimedOut(), False),
+    (NetworkError("connection reset"), False),
+])
+def test_is_bad_file_id(exc, bad):
+    assert media.is_bad_file_id(exc) is bad
+
+
+def test_transient_error_keeps_file_id(file_ids):
+    bot = FakeBot(fail_on_file_id=TimedOut())
+    with pytest.raises(TimedOut):
+        asyncio.run(media.send_photo_cached(bot, 1, "cat:1", "http://img/1"))
+    assert file_ids.get_file_id("cat:1") == "FID"
+    assert bot.sent == []  # без повторной отправки по URL
+
+
+def test_rejected_file_id_is_forgotten_and_resent(file_ids):
+    bot = FakeBot(fail_on_file_id=BadRequest("Wrong file identifier/HTTP URL specified"))
+    sent = asyncio.run(media.send_photo_cached(bot, 1, "cat:1", "http://img/1"))
+    assert sent is not None
+    assert bot.sent == ["http://img/1"]
+    assert file_ids.get_file_id("cat:1") == "NEW"
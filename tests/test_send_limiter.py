@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import send_limiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(send_limiter.time, "monotonic", c)
+    return c
+
+
+def test_token_bucket_burst_then_rate(clock):
+    b = send_limiter.TokenBucket(rate=2.0, capacity=3)
+    assert [b.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert b.take() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert b.take() == 0.0
+    clock.now += 100
+    assert b.tokens <= b.capacity
+    assert [b.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+
+
+def test_token_bucket_expensive_request_goes_into_debt(clock):
+    b = send_limiter.TokenBucket(rate=1.0, capacity=3)
+    assert b.take(10) == 0.0  # альбом из 10 фото дороже ёмкости — уходит, но в долг
+    assert b.take() == pytest.approx(8.0)
+
+
+def test_token_bucket_pause(clock):
+    b = send_limiter.TokenBucket(rate=10, capacity=10)
+    b.pause(5)
+    assert b.take() == pytest.approx(5)
+    clock.now += 5
+    assert b.take() == 0.0
+
+
+@pytest.mark.parametrize("chat_id, group", [
+    (12345, False),
+    (-100123, True),
+    ("12345", False),
+    ("-1001234567890", True),
+    ("@gg_ssr", True),
+])
+def test_is_group_chat(chat_id, group):
+    assert send_limiter.is_group_chat(chat_id) is group
+
+
+def make_scheduler(monkeypatch):
+    monkeypatch.setattr(send_limiter, "SEND_CHAT_RATE", 1000.0)
+    monkeypatch.setattr(send_limiter, "SEND_CHAT_BURST", 1000.0)
+    return send_limiter.SendScheduler(global_rate=1000, global_burst=1000)
+
+
+def test_order_within_chat_survives_retry_after(monkeypatch):
+    delivered = []
+    failed_once = set()
+
+    async def main():
+        sched = make_scheduler(monkeypatch)
+        await sched.initialize()
+
+        def request(n, delay=0.0):
+            async def callback(*args, **kwargs):
+                if n == 1 and n not in failed_once:
+                    failed_once.add(n)
+                    raise RetryAfter(1)
+                await asyncio.sleep(delay)
+                delivered.append(n)
+                return n
+            return sched.process_request(callback, (), {}, "sendMessage", {"chat_id": 42}, None)
+
+        tasks = []
+        for n, delay in ((1, 0.0), (2, 0.05), (3, 0.0)):
+            tasks.append(asyncio.ensure_future(request(n, delay)))
+            await asyncio.sleep(0)  # порядок вызова
+        assert await asyncio.gather(*tasks) == [1, 2, 3]
+        assert sched.retries == 1
+
+    asyncio.run(main())
+    assert delivered == [1, 2, 3]
+
+
+def test_other_chats_are_not_blocked_by_slow_send(monkeypatch):
+    delivered = []
+
+    async def main():
+        sched = make_scheduler(monkeypatch)
+        await sched.initialize()
+
+        def send(chat_id, delay, tag):
+            async def callback(*args, **kwargs):
+                await asyncio.sleep(delay)
+                delivered.append(tag)
+            return sched.process_request(callback, (), {}, "sendPhoto", {"chat_id": chat_id}, None)
+
+        await asyncio.gather(send(1, 0.2, "slow upload"), send(2, 0.0, "other chat"))
+
+    asyncio.run(main())
+    assert delivered == ["other chat", "slow upload"]
@@ -0,0 +1,174 @@
+import threading
+
+import pytest
+
+import winter
+
+
+ROWS = [
+    {"ITEM_ID": "a", "NAME": "A", "QUANTITY": 2},
+    {"ITEM_ID": "b", "NAME": "B", "QUANTITY": ""},
+]
+
+
+class FakeSheet:
+    def __init__(self, fail=False, gate=None):
+        self.fail = fail
+        self.gate = gate
+        self.started = threading.Event()
+        self.writes = []
+
+    def batch_update(self, data):
+        self.started.set()
+        if self.gate is not None:
+            assert self.gate.wait(5)
+        if self.fail:
+            raise RuntimeError("sheets down")
+        self.writes.append(data)
+
+
+@pytest.fixture
+def inv():
+    inv = winter.ShopInventory()
+    inv.load(ROWS, "C")
+    # без event loop commit() пишет сразу — в тестах запись запускаем явно
+    inv.schedule_flush = lambda delay=None: None
+    return inv
+
+
+def test_reserve_commit_rollback(inv):
+    assert inv.reserve("a")
+    assert inv.available("a") == 1
+    inv.rollback("a")
+    assert inv.available("a") == 2
+
+    assert inv.reserve("a") and inv.reserve("a")
+    assert not inv.reserve("a")
+    inv.commit("a")
+    inv.commit("a")
+    assert inv.available("a") == 0
+    assert inv._dirty == {"a"}
+
+    # rollback без резерва ничего не возвращает
+    inv.rollback("a")
+    assert inv.available("a") == 0
+
+
+def test_unlimited_and_unknown(inv):
+    for _ in range(5):
+        assert inv.reserve("b")
+    assert inv.available("b") is None
+    assert not inv.known("zzz")
+    assert not inv.reserve("zzz")
+
+
+def test_not_loaded_is_distinguishable():
+    inv = winter.ShopInventory()
+    assert not inv.loaded
+    assert not inv.known("a")
+    assert not inv.reserve("a")
+
+
+def test_concurrent_reserve_never_oversells(inv):
+    results = []
+    lock = threading.Lock()
+
+    def buy():
+        ok = inv.reserve("a")
+        with lock:
+            results.append(ok)
+
+    threads = [threading.Thread(target=buy) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results.count(True) == 2
+    assert inv.available("a") == 0
+
+
+def test_flush_writes_batch(inv, monkeypatch):
+    sheet = FakeSheet()
+    monkeypatch.setattr(winter, "sheet_winter_shop", lambda: sheet)
+    assert inv.reserve("a")
+    inv.commit("a")
+    assert inv.flush() == 1
+    assert sheet.writes == [[{"range": "C2", "values": [[1]]}]]
+    assert not inv._dirty and not inv._inflight
+
+
+def test_failed_flush_requeues(inv, monkeypatch):
+    monkeypatch.setattr(winter, "sheet_winter_shop", lambda: FakeSheet(fail=True))
+    assert inv.reserve("a")
+    inv.commit("a")
+    assert inv.flush() == 0
+    assert inv._dirty == {"a"}
+    assert not inv._inflight
+    # пока запись не прошла, перечитывание листа не возвращает старый остаток
+    inv.load(ROWS, "C")
+    assert inv.available("a") == 1
+
+
+def test_load_during_flush_keeps_memory_value(inv, monkeypatch):
+    gate = threading.Event()
+    sheet = FakeSheet(gate=gate)
+    monkeypatch.setattr(winter, "sheet_winter_shop", lambda: sheet)
+    assert inv.reserve("a")
+    inv.commit("a")
+
+    flusher = threading.Thread(target=inv.flush)
+    flusher.start()
+    assert sheet.started.wait(5)
+    # batch_update ещё не завершился: в листе старое значение 2
+    assert inv._inflight == {"a"} and not inv._dirty
+    inv.load(ROWS, "C")
+    assert inv.available("a") == 1
+
+    gate.set()
+    flusher.join(5)
+    assert not inv._inflight
+    # после записи лист уже содержит новое значение — load снова берёт его из листа
+    inv.load([{"ITEM_ID": "a", "QUANTITY": 1}, ROWS[1]], "C")
+    assert inv.available("a") == 1
+    assert inv.reserve("a")
+    assert not inv.reserve("a")
+
+
+class FakeShopSheet:
+    def __init__(self, rows):
+        self.rows = rows
+        self.reads = 0
+
+    def get_all_records(self):
+        self.reads += 1
+        return [dict(r) for r in self.rows]
+
+
+def test_catalog_serves_one_snapshot_and_reuses_views(monkeypatch):
+    sheet = FakeShopSheet([
+        {"ITEM_ID": "a", "NAME": "A", "PRICE": 5, "QUANTITY": 2},
+        {"ITEM_ID": "b", "NAME": "B", "PRICE": 7, "QUANTITY": 1},
+    ])
+    monkeypatch.setattr(winter, "sheet_winter_shop", lambda: sheet)
+    monkeypatch.setattr(winter, "SHOP_INVENTORY", winter.ShopInventory())
+    catalog = winter.SHOP_CATALOG
+    catalog._cache.clear()
+    try:
+        snap = catalog.refresh(force=True)
+        assert [it["ITEM_ID"] for it in catalog.items] == ["a", "b"]
+        assert catalog.snapshot() is snap and catalog.get("a")["NAME"] == "A"
+        assert snap.qty_col == "D"
+        assert winter.SHOP_INVENTORY.available("a") == 2
+        assert sheet.reads == 1
+
+        sheet.rows[0]["QUANTITY"] = 0   # только остаток — карточки те же
+        again = catalog.refresh(force=True)
+        assert again is not snap and again.views is snap.views
+        assert winter.SHOP_INVENTORY.available("a") == 0
+
+        sheet.rows[1]["PRICE"] = 9      # поменялась цена — новый снимок, старый не тронут
+        changed = catalog.refresh(force=True)
+        assert changed.by_id["b"]["PRICE"] == 9 and snap.by_id["b"]["PRICE"] == 7
+        assert changed.views is not snap.views
+    finally:
+        catalog._cache.clear()
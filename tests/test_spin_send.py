@@ -0,0 +1,93 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import NetworkError, TimedOut
+
+import main
+import media
+import winter
+
+CAT = {"id": "7", "rarity": "COM", "desc": "Кот", "url": "https://example.com/7.jpg"}
+
+
+class FakeSheet:
+    def __init__(self):
+        self.updates = []
+
+    def update(self, values, cell, **kwargs):
+        self.updates.append((cell, values))
+
+    def row_values(self, row):
+        return ["WINTER_CURRENCY"] if row == 1 else ["3"]
+
+
+class FakeBot:
+    """Отправка по сохранённому file_id падает с заданной ошибкой."""
+
+    def __init__(self, error):
+        self.error = error
+        self.photos = []
+        self.messages = []
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        if photo == "FID":
+            raise self.error
+        self.photos.append(photo)
+        return None
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append(text)
+
+
+@pytest.fixture
+def sheet(monkeypatch):
+    sheet = FakeSheet()
+    monkeypatch.setattr(media.FILE_IDS, "get", lambda key, url: {"file_id": "FID", "method": media.METHOD_URL})
+    forgotten = []
+    monkeypatch.setattr(media.FILE_IDS, "forget", forgotten.append)
+    sheet.forgotten = forgotten
+    return sheet
+
+
+@pytest.fixture
+def spin_main(monkeypatch, sheet):
+    monkeypatch.setattr(main, "sheet_users", lambda: sheet)
+    monkeypatch.setattr(main, "find_user_row_fast", lambda s, uid: (2, {"SPINS": 1, "CATS_ID": "", "SUM": 0}))
+    monkeypatch.setattr(main, "get_cats_cached", lambda: [CAT])
+    monkeypatch.setattr(main, "column_letter_by_name", lambda s, name: "E")
+    return main.handle_spin_and_send
+
+
+@pytest.fixture
+def spin_winter(monkeypatch, sheet):
+    monkeypatch.setattr(winter, "sheet_winter_users", lambda: sheet)
+    monkeypatch.setattr(winter, "find_winter_user_row",
+                        lambda s, uid: (2, {"WINTER_SPINS": 1, "W_CATS_ID": "", "SUM": 0, "LUCK_HIDDEN": 0}))
+    monkeypatch.setattr(winter, "get_winter_cats_cached", lambda: [CAT])
+    monkeypatch.setattr(winter, "column_letter_by_name", lambda s, name: "E")
+    monkeypatch.setattr(winter, "adjust_luck_after_spin", lambda *args: None)
+    return winter.handle_winter_spin_and_send
+
+
+@pytest.mark.parametrize("handler", ["spin_main", "spin_winter"])
+def test_network_error_on_file_id_send_falls_back_to_text(request, sheet, handler):
+    spin = request.getfixturevalue(handler)
+    bot = FakeBot(NetworkError("connection reset"))
+    asyncio.run(spin(100, 1, SimpleNamespace(bot=bot)))
+    assert sheet.updates                      # спин списан
+    assert not bot.photos                     # повторной загрузки нет
+    assert sheet.forgotten == []              # file_id не виноват — не забываем
+    assert len(bot.messages) == 1
+    assert bot.messages[0].startswith("(Не удалось отправить изображение)\n")
+    assert "Кот" in bot.messages[0]
+
+
+@pytest.mark.parametrize("handler", ["spin_main", "spin_winter"])
+def test_timeout_on_file_id_send_tells_user_without_duplicate_caption(request, sheet, handler):
+    spin = request.getfixturevalue(handler)
+    bot = FakeBot(TimedOut())
+    asyncio.run(spin(100, 1, SimpleNamespace(bot=bot)))
+    assert len(bot.messages) == 1
+    assert "не ответил вовремя" in bot.messages[0]
+    assert "Кот" not in bot.messages[0]
@@ -0,0 +1,144 @@
+import itertools
+import threading
+
+import pytest
+
+import ttl_cache
+
+_names = itertools.count()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(ttl_cache.time, "time", c)
+    return c
+
+
+def make(loader, **kwargs):
+    return ttl_cache.TTLCache(f"test_{next(_names)}", loader, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def unregister():
+    before = set(ttl_cache.CACHES)
+    yield
+    for name in set(ttl_cache.CACHES) - before:
+        del ttl_cache.CACHES[name]
+
+
+def counting_loader():
+    calls = []
+
+    def loader(key):
+        calls.append(key)
+        return f"{key}#{len(calls)}"
+    return loader, calls
+
+
+def test_ttl_expiry(clock):
+    loader, calls = counting_loader()
+    cache = make(loader, ttl=10)
+    assert cache.get("k") == "k#1"
+    clock.now += 9
+    assert cache.get("k") == "k#1"
+    clock.now += 1
+    assert cache.get("k") == "k#2"
+    assert (cache.hits, cache.misses, cache.loads) == (1, 2, 2)
+
+
+def test_max_size_evicts_least_recently_used(clock):
+    loader, calls = counting_loader()
+    cache = make(loader, max_size=2)
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")          # a — свежее b
+    cache.get("c")          # вытесняет b
+    assert cache.peek("b") is None
+    assert cache.peek("a") == "a#1" and cache.peek("c") == "c#3"
+    assert cache.get("b") == "b#4"
+    assert cache.peek("a") is None
+
+
+def test_clear_and_invalidate(clock):
+    loader, calls = counting_loader()
+    cache = make(loader)
+    cache.get("a")
+    cache.get("b")
+    cache.invalidate("a")
+    assert cache.peek("a") is None and cache.peek("b") == "b#2"
+    cache.clear()
+    assert cache.stats()["items"] == 0
+    assert cache.get("b") == "b#3"
+
+
+def test_error_keeps_stale_value_until_error_ttl(clock):
+    state = {"fail": False, "n": 0}
+
+    def loader(key):
+        state["n"] += 1
+        if state["fail"]:
+            raise RuntimeError("sheets down")
+        return state["n"]
+
+    cache = make(loader, ttl=10, error_ttl=30, default="default")
+    assert cache.get() == 1
+    state["fail"] = True
+    clock.now += 10
+    assert cache.get() == 1           # старое значение
+    assert cache.get() == 1           # без повторной загрузки до error_ttl
+    assert state["n"] == 2 and cache.errors == 1
+    clock.now += 30
+    state["fail"] = False
+    assert cache.get() == 3
+
+    empty = make(lambda key: 1 / 0, default="default")
+    assert empty.get() == "default"
+
+
+def test_concurrent_misses_share_one_load():
+    gate = threading.Event()
+    calls = []
+
+    def loader(key):
+        calls.append(key)
+        assert gate.wait(5)
+        return "value"
+
+    cache = make(loader)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(5)]
+    for t in threads:
+        t.start()
+    gate.set()
+    for t in threads:
+        t.join(5)
+    assert results == ["value"] * 5
+    assert calls == [None]
+
+
+def test_reload_all_uses_default_keys_when_empty(clock):
+    loader, calls = counting_loader()
+    cache = make(loader, default_keys=(20,))
+    assert cache.reload_all() == 1
+    assert calls == [20] and cache.peek(20) == "20#1" and cache.peek(None) is None
+    cache.get(7)
+    assert cache.reload_all() == 2
+    assert sorted(calls[2:]) == [7, 20]
+
+    plain = make(loader)
+    assert plain.reload_all() == 1 and plain.peek(None) is not None
+
+
+def test_duplicate_name_rejected():
+    cache = make(lambda key: 1)
+    with pytest.raises(ValueError):
+        ttl_cache.TTLCache(cache.name, lambda key: 1)
@@ -0,0 +1,84 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import media
+
+
+class HangingBot:
+    """send_* висят, пока тест не остановит uploader (медленная загрузка)."""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.calls = 0
+
+    async def _hang(self):
+        self.calls += 1
+        self.started.set()
+        await asyncio.Event().wait()
+
+    async def send_photo(self, **kwargs):
+        await self._hang()
+
+    async def send_media_group(self, **kwargs):
+        await self._hang()
+
+
+class OkBot:
+    def __init__(self):
+        self.n = 0
+
+    def _msg(self):
+        self.n += 1
+        return SimpleNamespace(message_id=self.n, photo=[SimpleNamespace(file_id=f"F{self.n}")], document=None)
+
+    async def send_photo(self, **kwargs):
+        return self._msg()
+
+    async def send_media_group(self, media, **kwargs):
+        return [self._msg() for _ in media]
+
+
+def test_stop_mid_batch_fails_taken_items():
+    async def main():
+        up = media.CacheUploader(batch_size=10, window=0.01, min_interval=0)
+        bot = HangingBot()
+        up.start(bot, chat_id=-100)
+        futs = [up.submit(b"x", f"{i}.jpg") for i in range(3)]
+        await asyncio.wait_for(bot.started.wait(), 2)
+        late = up.submit(b"y", "late.jpg")  # ещё в очереди
+        await asyncio.wait_for(up.stop(), 2)
+        for f in futs + [late]:
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(f, 1)
+        assert bot.calls == 1
+
+    asyncio.run(main())
+
+
+def test_stop_while_collecting_fails_taken_items():
+    async def main():
+        up = media.CacheUploader(batch_size=10, window=30, min_interval=0)
+        up.start(HangingBot(), chat_id=-100)
+        fut = up.submit(b"x")
+        await asyncio.sleep(0.05)  # воркер снял элемент и ждёт добора пакета
+        assert up._queue.empty()
+        await asyncio.wait_for(up.stop(), 2)
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(fut, 1)
+
+    asyncio.run(main())
+
+
+def test_batches_resolve_file_ids():
+    async def main():
+        up = media.CacheUploader(batch_size=2, window=0.05, min_interval=0)
+        up.start(OkBot(), chat_id=-100)
+        fids = await asyncio.wait_for(asyncio.gather(*(up.upload(b"x") for _ in range(3))), 2)
+        await up.stop()
+        return fids, up.batches
+
+    fids, batches = asyncio.run(main())
+    assert sorted(fids) == ["F1", "F2", "F3"]
+    assert batches == 2
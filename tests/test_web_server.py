@@ -0,0 +1,93 @@
+import asyncio
+import socket
+from types import SimpleNamespace
+
+import aiohttp
+
+import web_server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fake_app():
+    return SimpleNamespace(bot=SimpleNamespace(token="123:test"), running=True)
+
+
+async def status(session, url, **kwargs):
+    async with session.get(url, **kwargs) as resp:
+        return resp.status
+
+
+def test_metrics_require_token_on_public_port():
+    port = free_port()
+
+    async def main():
+        server = web_server.WebServer(port=port, metrics_token="s3cret")
+        await server.start(fake_app())
+        try:
+            base = f"http://127.0.0.1:{port}"
+            async with aiohttp.ClientSession() as session:
+                assert await status(session, base + "/health") == 200
+                assert await status(session, base + "/metrics") == 401
+                assert await status(session, base + "/routes",
+                                    headers={"Authorization": "Bearer wrong"}) == 401
+                ok = {"Authorization": "Bearer s3cret"}
+                assert await status(session, base + "/metrics", headers=ok) == 200
+                assert await status(session, base + "/routes", headers=ok) == 200
+            assert server._internal_runner is None
+        finally:
+            await server.stop()
+
+    asyncio.run(main())
+
+
+def test_metrics_only_on_internal_listener_without_token():
+    port, internal = free_port(), free_port()
+
+    async def main():
+        server = web_server.WebServer(port=port, metrics_token="", metrics_port=internal)
+        await server.start(fake_app())
+        try:
+            async with aiohttp.ClientSession() as session:
+                assert await status(session, f"http://127.0.0.1:{port}/metrics") == 404
+                assert await status(session, f"http://127.0.0.1:{port}/routes") == 404
+                assert await status(session, f"http://127.0.0.1:{internal}/metrics") == 200
+                assert await status(session, f"http://127.0.0.1:{internal}/routes?by=wall") == 200
+        finally:
+            await server.stop()
+        assert not server.running
+
+    asyncio.run(main())
+
+
+def test_webhook_rejects_missing_or_wrong_secret():
+    port = free_port()
+    app = fake_app()
+    app.update_queue = asyncio.Queue()
+
+    async def main():
+        server = web_server.WebServer(port=port, metrics_token="x")
+        await server.start(app, webhook=True)
+        url = f"http://127.0.0.1:{port}/" + web_server.WEBHOOK_PATH.strip("/")
+        update = {"update_id": 1}
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, json=update) as resp:
+                    assert resp.status == 403
+                async with session.post(url, json=update,
+                                        headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as resp:
+                    assert resp.status == 403
+                secret = web_server.webhook_secret(app.bot.token)
+                async with session.post(url, json=update,
+                                        headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as resp:
+                    assert resp.status == 200
+        finally:
+            await server.stop()
+        assert server.rejected == 2 and server.updates == 1
+        assert app.update_queue.qsize() == 1
+
+    asyncio.run(main())
@@ -0,0 +1,225 @@
+"""
+ttl_cache.py
+
+Единый кэш данных из таблиц (каталоги, лидерборды, магазин, адвент):
+- TTLCache: значения по ключу (обычно один ключ None) с TTL (None — пока не сбросят), max_size (LRU),
+  single-flight загрузкой (одновременные промахи ждут одну загрузку), устаревшим значением при ошибке
+  загрузки (повторная попытка — через error_ttl) и метриками hit/miss/возраст/размер;
+- реестр CACHES: все кэши по имени — для админ-команды /caches (список, reload, clear без рестарта).
+
+Загрузчик — обычная блокирующая функция loader(key) (gspread). В async-коде — await cache.aget():
+загрузка уходит в executor и не держит event loop.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_ERROR_TTL = float(os.environ.get("CACHE_ERROR_TTL", "30"))  # сек до повторной загрузки после ошибки
+
+CACHES = OrderedDict()
+
+
+def get_cache(name):
+    return CACHES.get(name)
+
+
+def all_caches():
+    return list(CACHES.values())
+
+
+class _Entry:
+    __slots__ = ("value", "ts", "expires")
+
+    def __init__(self, value, ts, expires):
+        self.value = value
+        self.ts = ts
+        self.expires = expires
+
+
+class TTLCache:
+    def __init__(self, name, loader, ttl=None, max_size=None, error_ttl=CACHE_ERROR_TTL, default=None, description="",
+                 default_keys=(None,)):
+        """
+        loader(key) -> значение (блокирующая). ttl — сек или None (без истечения).
+        default — что вернуть, если загрузка упала, а старого значения нет.
+        default_keys — ключи, которыми кэш читают вызывающие: их перечитывает reload_all(), пока кэш пуст.
+        """
+        if name in CACHES:
+            raise ValueError(f"кэш {name} уже зарегистрирован")
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.max_size = max_size
+        self.error_ttl = error_ttl
+        self.default = default
+        self.description = description
+        self.default_keys = tuple(default_keys)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.errors = 0
+        self.last_error = None
+        CACHES[name] = self
+        metrics.CACHE_AGE.track(name, fn=self.max_age)
+        metrics.CACHE_ITEMS.track(name, fn=lambda: len(self._data))
+
+    # --- чтение ---
+
+    def _fresh(self, key, now):
+        entry = self._data.get(key)
+        if entry is None or (entry.expires is not None and now >= entry.expires):
+            return None
+        if self.max_size:
+            self._data.move_to_end(key)
+        return entry
+
+    def get(self, key=None):
+        """Значение по ключу: из кэша, иначе загрузка (одна на ключ, остальные ждут её результат)."""
+        with self._lock:
+            entry = self._fresh(key, time.time())
+            if entry is not None:
+                self.hits += 1
+        if entry is not None:
+            metrics.cache_hit(self.name)
+            return entry.value
+        return self._load(key, force=False)
+
+    async def aget(self, key=None):
+        """Как get, но промах загружается в executor (event loop не блокируется)."""
+        with self._lock:
+            entry = self._fresh(key, time.time())
+            if entry is not None:
+                self.hits += 1
+        if entry is not None:
+            metrics.cache_hit(self.name)
+            return entry.value
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._load, key, False)
+
+    def peek(self, key=None):
+        """Значение без загрузки и учёта в статистике (None — нет)."""
+        entry = self._data.get(key)
+        return entry.value if entry is not None else None
+
+    def age(self, key=None):
+        entry = self._data.get(key)
+        return time.time() - entry.ts if entry is not None else None
+
+    def max_age(self):
+        with self._lock:
+            stamps = [e.ts for e in self._data.values()]
+        return time.time() - min(stamps) if stamps else None
+
+    # --- загрузка ---
+
+    def _load_lock(self, key):
+        with self._lock:
+            lock = self._load_locks.get(key)
+            if lock is None:
+                lock = self._load_locks[key] = threading.Lock()
+            return lock
+
+    def _load(self, key, force):
+        with self._load_lock(key):
+            # пока ждали lock, значение мог загрузить другой поток
+            if not force:
+                with self._lock:
+                    entry = self._fresh(key, time.time())
+                    if entry is not None:
+                        self.hits += 1
+                if entry is not None:
+                    metrics.cache_hit(self.name)
+                    return entry.value
+            with self._lock:
+                self.misses += 1
+            metrics.cache_miss(self.name)
+            t0 = time.time()
+            try:
+                value = self.loader(key)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    stale = self._data.get(key)
+                    value = stale.value if stale is not None else self.default
+                    # не долбим таблицу на каждый запрос, пока она недоступна
+                    self._data[key] = _Entry(value, stale.ts if stale is not None else t0, time.time() + self.error_ttl)
+                logger.exception("cache %s: загрузка %r не удалась — отдаём %s", self.name, key,
+                                 "старое значение" if stale is not None else "значение по умолчанию")
+                return value
+            self.put(key, value)
+            with self._lock:
+                self.loads += 1
+            return value
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._data[key] = _Entry(value, now, now + self.ttl if self.ttl is not None else None)
+            self._data.move_to_end(key)
+            if self.max_size:
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+
+    def reload(self, key=None):
+        """Перечитать ключ сейчас (блокирующая)."""
+        return self._load(key, force=True)
+
+    def reload_all(self):
+        """Перечитать все загруженные ключи (пустой кэш — default_keys). Возвращает число ключей."""
+        with self._lock:
+            keys = list(self._data.keys()) or list(self.default_keys)
+        for key in keys:
+            self.reload(key)
+        return len(keys)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    # --- состояние ---
+
+    def stats(self):
+        with self._lock:
+            items = len(self._data)
+        requests = self.hits + self.misses
+        return {
+            "name": self.name,
+            "description": self.description,
+            "items": items,
+            "ttl": self.ttl,
+            "max_size": self.max_size,
+            "age_s": round(self.max_age(), 1) if items else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / requests, 3) if requests else None,
+            "loads": self.loads,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+def format_stats(st) -> str:
+    """Строка для админ-команды."""
+    ttl = "∞" if st["ttl"] is None else f"{st['ttl']:g} с"
+    age = "—" if st["age_s"] is None else f"{st['age_s']:.0f} с"
+    ratio = "—" if st["hit_ratio"] is None else f"{st['hit_ratio'] * 100:.0f}%"
+    line = (f"• {st['name']}: {st['items']} шт., возраст {age} / TTL {ttl}, "
+            f"попаданий {ratio} ({st['hits']}/{st['hits'] + st['misses']}), загрузок {st['loads']}, ошибок {st['errors']}")
+    if st["description"]:
+        line += f"\n   {st['description']}"
+    return line
@@ -0,0 +1,116 @@
+"""
+update_processor.py
+
+Параллельная обработка апдейтов с порядком внутри пользователя:
+- апдейты разных пользователей обрабатываются одновременно, не больше UPDATE_WORKERS сразу;
+- апдейты одного пользователя — строго по очереди и взаимно исключающе (двойное нажатие
+  «Крутить» / «Купить» не списывает SPINS / WINTER_CURRENCY дважды из одного и того же прочтения);
+- UPDATE_QUEUE_MAX ограничивает число апдейтов «в работе» вместе с ожидающими очереди своего пользователя.
+
+Подключение: ApplicationBuilder().concurrent_updates(update_processor.UPDATE_PROCESSOR).
+"""
+import os
+import time
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+import call_trace
+
+logger = logging.getLogger(__name__)
+
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_MAX = int(os.environ.get("UPDATE_QUEUE_MAX", "256"))
+
+
+def sequence_key(update):
+    """Ключ очереди: пользователь, иначе чат; None — апдейт без владельца (обрабатывается без очереди)."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return ("user", update.effective_user.id)
+    if update.effective_chat is not None:
+        return ("chat", update.effective_chat.id)
+    return None
+
+
+class _Sequence:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Семафор BaseUpdateProcessor (max_concurrent_updates = queue_max) ограничивает апдейты в системе,
+    собственный семафор workers — реально выполняющиеся обработчики. Порядок: сначала очередь
+    пользователя, потом слот воркера — ожидающие своей очереди апдейты не занимают воркеры.
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS, queue_max=UPDATE_QUEUE_MAX):
+        workers = max(1, workers)
+        super().__init__(max(workers, queue_max))
+        self.workers = workers
+        self._workers_sem = None
+        self._sequences = {}
+        self.processed = 0
+        self.waited = 0
+
+    async def initialize(self) -> None:
+        self._workers_sem = asyncio.Semaphore(self.workers)
+        logger.info("update processor: %d workers, queue %d", self.workers, self.max_concurrent_updates)
+
+    async def shutdown(self) -> None:
+        self._sequences.clear()
+
+    async def _run(self, update, coroutine):
+        route = metrics.update_route(update)
+        user = getattr(update, "effective_user", None)
+        trace, token = call_trace.TRACER.start(route, getattr(update, "update_id", None), user.id if user else None)
+        t0 = time.perf_counter()
+        try:
+            await coroutine
+        except Exception:
+            metrics.UPDATE_ERRORS.inc(route)
+            raise
+        finally:
+            metrics.UPDATE_SECONDS.observe(route, value=time.perf_counter() - t0)
+            call_trace.TRACER.stop(trace, token)
+            self.processed += 1
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = sequence_key(update)
+        if key is None:
+            async with self._workers_sem:
+                await self._run(update, coroutine)
+            return
+
+        seq = self._sequences.get(key)
+        if seq is None:
+            seq = self._sequences[key] = _Sequence()
+        seq.users += 1
+        try:
+            if seq.lock.locked():
+                self.waited += 1
+            async with seq.lock:
+                async with self._workers_sem:
+                    await self._run(update, coroutine)
+        finally:
+            seq.users -= 1
+            if seq.users == 0:
+                self._sequences.pop(key, None)
+
+    def stats(self):
+        return {
+            "processed": self.processed,
+            "waited_for_user": self.waited,
+            "active_users": len(self._sequences),
+        }
+
+
+UPDATE_PROCESSOR = PerUserUpdateProcessor()
@@ -0,0 +1,220 @@
+"""
+web_server.py
+
+Единственный HTTP-сервер процесса (aiohttp, в том же event loop, что и бот):
+- GET / и GET /health — лёгкая проверка живости для хостинга (JSON со статусом, без раздачи файлов);
+- GET /metrics — метрики в формате Prometheus (metrics.REGISTRY);
+- GET /routes?by=sheets|bot|download|wall&n=10 — самые дорогие маршруты по внешним вызовам (call_trace);
+- POST /<WEBHOOK_PATH> — приём апдейтов от Telegram в режиме webhook (если задан WEBHOOK_URL),
+  с проверкой заголовка X-Telegram-Bot-Api-Secret-Token.
+
+/metrics и /routes наружу не открыты: если задан METRICS_TOKEN — они на общем порту, но только
+с заголовком Authorization: Bearer <token>; иначе — на отдельном служебном listener'е
+METRICS_HOST:METRICS_PORT (по умолчанию 127.0.0.1:9090), куда снаружи не достучаться.
+
+Режимы (main.py):
+- WEBHOOK_URL задан — run_webhook(): set_webhook + приём апдейтов здесь, без long polling;
+- иначе — обычный run_polling(), а сервер поднимается только ради health-проверки порта.
+"""
+import os
+import time
+import signal
+import asyncio
+import hmac
+import hashlib
+import logging
+
+from aiohttp import web
+from telegram import Update
+
+import metrics
+import call_trace
+
+logger = logging.getLogger(__name__)
+
+PORT = int(os.environ.get("PORT", "8080"))
+WEBHOOK_URL = (os.environ.get("WEBHOOK_URL") or "").rstrip("/")   # публичный https-адрес, без пути
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")                 # по умолчанию — производный от токена
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")                   # доступ к /metrics и /routes на общем порту
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")        # служебный listener, если токена нет
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+
+# обрабатываем только сообщения и нажатия кнопок — остальное Telegram даже не присылает
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+
+def webhook_secret(token: str) -> str:
+    """Секрет для X-Telegram-Bot-Api-Secret-Token (1-256 символов A-Z a-z 0-9 _ -)."""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(("webhook:" + token).encode("utf-8")).hexdigest()
+
+
+class WebServer:
+    """aiohttp-сервер: health всегда, webhook — если вызван с webhook=True."""
+
+    def __init__(self, port=PORT, metrics_token=None, metrics_host=METRICS_HOST, metrics_port=METRICS_PORT):
+        self.port = port
+        self.metrics_token = metrics_token if metrics_token is not None else METRICS_TOKEN
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.app = None
+        self.webhook = False
+        self.started_at = None
+        self.updates = 0
+        self.rejected = 0
+        self._runner = None
+        self._internal_runner = None
+        self._secret = None
+        self._health_extra = {}
+
+    @property
+    def running(self):
+        return self._runner is not None
+
+    def add_health(self, name, stats_fn):
+        """Добавить раздел в /health: stats_fn() -> dict (вызывается на каждый запрос, должна быть дешёвой)."""
+        self._health_extra[name] = stats_fn
+
+    async def start(self, app, webhook=False):
+        if self.running:
+            return
+        self.app = app
+        self.webhook = webhook
+        self._secret = webhook_secret(app.bot.token)
+        web_app = web.Application()
+        web_app.router.add_get("/", self._health)
+        web_app.router.add_get("/health", self._health)
+        if self.metrics_token:
+            web_app.router.add_get("/metrics", self._metrics)
+            web_app.router.add_get("/routes", self._routes)
+        if webhook:
+            web_app.router.add_post("/" + WEBHOOK_PATH.strip("/"), self._webhook)
+        self._runner = web.AppRunner(web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "0.0.0.0", self.port).start()
+        self.started_at = time.time()
+        logger.info("web server: port %d, %s", self.port, "webhook + health" if webhook else "health")
+        if not self.metrics_token:
+            await self._start_internal()
+
+    async def _start_internal(self):
+        # без токена метрики и маршруты — только на локальном адресе; не поднялся — бот работает без них
+        internal = web.Application()
+        internal.router.add_get("/metrics", self._metrics)
+        internal.router.add_get("/routes", self._routes)
+        runner = web.AppRunner(internal, access_log=None)
+        try:
+            await runner.setup()
+            await web.TCPSite(runner, self.metrics_host, self.metrics_port).start()
+        except Exception:
+            logger.exception("web server: служебный listener %s:%d не поднялся", self.metrics_host, self.metrics_port)
+            await runner.cleanup()
+            return
+        self._internal_runner = runner
+        logger.info("web server: /metrics и /routes на %s:%d", self.metrics_host, self.metrics_port)
+
+    async def stop(self):
+        runner, self._runner = self._runner, None
+        internal, self._internal_runner = self._internal_runner, None
+        for r in (runner, internal):
+            if r is not None:
+                await r.cleanup()
+
+    def _authorized(self, request):
+        """Служебный listener доверенный; на общем порту нужен Authorization: Bearer <METRICS_TOKEN>."""
+        if not self.metrics_token:
+            return True
+        auth = request.headers.get("Authorization", "")
+        scheme, _, token = auth.partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode("utf-8"),
+                                                                  self.metrics_token.encode("utf-8"))
+
+    async def _health(self, request):
+        body = {
+            "status": "ok" if self.app is not None and self.app.running else "starting",
+            "mode": "webhook" if self.webhook else "polling",
+            "uptime_s": int(time.time() - self.started_at) if self.started_at else 0,
+            "updates": self.updates,
+        }
+        for name, fn in self._health_extra.items():
+            try:
+                body[name] = fn()
+            except Exception:
+                logger.exception("health: раздел %s не отдался", name)
+        return web.json_response(body)
+
+    async def _metrics(self, request):
+        if not self._authorized(request):
+            return web.Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+        return web.Response(body=metrics.REGISTRY.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def _routes(self, request):
+        if not self._authorized(request):
+            return web.Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+        try:
+            n = max(1, min(100, int(request.query.get("n", "10"))))
+        except ValueError:
+            n = 10
+        return web.json_response(call_trace.TRACER.top(n, request.query.get("by", "sheets")))
+
+    async def _webhook(self, request):
+        # нет заголовка — пустая строка (не совпадёт с непустым секретом); сравнение за постоянное время
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), self._secret.encode("utf-8")):
+            self.rejected += 1
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.app.bot)
+        except Exception:
+            logger.exception("webhook: не удалось разобрать апдейт")
+            return web.Response(status=400)
+        if update is not None:
+            self.updates += 1
+            # обработка — в Application (update_processor), Telegram получает 200 сразу
+            await self.app.update_queue.put(update)
+        return web.Response()
+
+
+SERVER = WebServer()
+
+
+async def _run_webhook(app):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL}/{WEBHOOK_PATH.strip('/')}",
+            allowed_updates=ALLOWED_UPDATES,
+            secret_token=webhook_secret(app.bot.token),
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        await app.start()
+        logger.info("webhook: %s/%s", WEBHOOK_URL, WEBHOOK_PATH.strip("/"))
+        await stop.wait()
+    finally:
+        if app.running:
+            await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+def run_webhook(app):
+    """Аналог app.run_polling() для режима webhook: блокирует до SIGINT/SIGTERM."""
+    asyncio.run(_run_webhook(app))
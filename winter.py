@@ -19,19 +19,21 @@ import random
 import re
 import logging
 from datetime import datetime, timedelta, date
-import aiohttp
-from io import BytesIO
 import asyncio
+import threading
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes, CallbackQueryHandler
-from telegram.error import BadRequest
-from telegram import InputFile
+from telegram.error import BadRequest, TimedOut
 
 
 import gspread
 from google.oauth2.service_account import Credentials
 
+import media
+import metrics
+import ttl_cache
+
 logger = logging.getLogger(__name__)
 
 # -------------------------- Настройки / Константы --------------------------
@@ -46,18 +48,20 @@ WINTER_CATS_SHEET = "winter_cats"
 WINTER_LEADER_SHEET = "winter_top"
 WINTER_ADVENT_SHEET = "winter_advent"
 
-# cache
-_WINTER_CATS_CACHE = {"ts": 0, "data": None}
+# кэши — ttl_cache.TTLCache (WINTER_CATS, WINTER_LEADER, ADVENT, каталог магазина), объявлены у загрузчиков
 CATS_TTL = 300
+# каталог winter_cats по умолчанию не истекает (читается при старте, сброс — /caches reload winter_cats)
+WINTER_CATS_TTL = float(os.environ["WINTER_CATS_TTL"]) if os.environ.get("WINTER_CATS_TTL") else None
 
 # leader cache
-_WINTER_LEADER_CACHE = {"ts": 0, "data": None}
 _WINTER_LEADER_TTL = 60  # 1 минута
-_winter_leader_lock = asyncio.Lock()
 
-# shop cache
-_WINTER_SHOP_CACHE = {"ts": 0, "data": None}
+# shop cache (SHOP_CATALOG)
 _WINTER_SHOP_TTL = 300  # 5 минут
+SHOP_FLUSH_DELAY = 5    # задержка пакетной записи остатков, сек
+
+# advent — таблица наград читается один раз за ивент (сброс: reload_advent_table или /caches reload advent)
+ADVENT_DAYS_DEFAULT = 20
 
 # лимит спинов
 MAX_WINTER_SPINS = 999
@@ -101,7 +105,7 @@ ADVENT_DEFAULT_END_DAY = 10
 
 def gs_client():
     creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-    return gspread.authorize(creds)
+    return gspread.authorize(creds, http_client=metrics.sheets_http_client())
 
 def _open_wb():
     client = gs_client()
@@ -165,17 +169,55 @@ def column_letter_by_name(sheet, name):
     sheet.update([[name]], f"{colnum_to_letter(next_idx)}1")
     return colnum_to_letter(next_idx)
 
+def update_row_fields(sheet, row, values, value_input_option="RAW"):
+    """
+    Записывает несколько полей одной строки за один batch_update.
+    values: {"WINTER_SPINS": 5, "WINTER_CURRENCY": 40, ...}
+    Заголовки читаются один раз; отсутствующие колонки добавляются в конец.
+    """
+    if not values:
+        return
+    headers = sheet.row_values(1)
+    upper = [str(h).strip().upper() for h in headers]
+    data = []
+    for name, value in values.items():
+        key = name.upper()
+        if key in upper:
+            idx = upper.index(key) + 1
+        else:
+            headers.append(name)
+            upper.append(key)
+            idx = len(headers)
+            sheet.update([[name]], f"{colnum_to_letter(idx)}1")
+        data.append({"range": f"{colnum_to_letter(idx)}{row}", "values": [[value]]})
+    sheet.batch_update(data, value_input_option=value_input_option)
+
+def record_get(record, name, default=""):
+    """Значение поля записи без учёта регистра заголовка."""
+    if not record:
+        return default
+    if name in record:
+        return record.get(name)
+    key = name.upper()
+    for k, v in record.items():
+        if str(k).strip().upper() == key:
+            return v
+    return default
+
 # -------------------------- Winter sheet user helpers --------------------------
 
+def read_row_record(sheet, row):
+    headers = sheet.row_values(1)
+    row_values = sheet.row_values(row)
+    if len(row_values) < len(headers):
+        row_values += [""] * (len(headers) - len(row_values))
+    return dict(zip(headers, row_values))
+
 def find_winter_user_row(sheet, user_id):
     try:
         cell = sheet.find(str(user_id), in_column=1)
         row = cell.row
-        headers = sheet.row_values(1)
-        row_values = sheet.row_values(row)
-        if len(row_values) < len(headers):
-            row_values += [""] * (len(headers) - len(row_values))
-        record = dict(zip(headers, row_values))
+        record = read_row_record(sheet, row)
         return row, record
     except Exception:
         return None, None
@@ -197,152 +239,452 @@ def clean_cat_records(records):
         cleaned.append({"id": cid, "url": url, "desc": desc, "rarity": rarity})
     return cleaned
 
+def _load_winter_cats(_key=None):
+    cats = clean_cat_records(sheet_winter_cats().get_all_records())
+    logger.info("winter_cats loaded: %d items", len(cats))
+    return cats
+
+
+WINTER_CATS = ttl_cache.TTLCache("winter_cats", _load_winter_cats, ttl=WINTER_CATS_TTL, default=[],
+                                 description="лист winter_cats (зимний каталог)")
+
+
 def load_winter_cats_once():
     """
-    Загрузить таблицу winter_cats *один раз* и пометить как static.
-    Вызвать при старте бота (main) — тогда get_winter_cats_cached будет возвращать кэш всегда.
+    Загрузить таблицу winter_cats при старте бота (main). Дальше get_winter_cats_cached
+    отдаёт кэш (по умолчанию без истечения — см. WINTER_CATS_TTL).
     """
-    global _WINTER_CATS_CACHE
-    # если уже загружено — вернуть
-    if _WINTER_CATS_CACHE["data"] is not None:
-        _WINTER_CATS_CACHE["static"] = True
-        return _WINTER_CATS_CACHE["data"]
-
-    try:
-        s = sheet_winter_cats()
-        records = s.get_all_records()
-        cats = clean_cat_records(records)
-    except Exception as e:
-        logger.exception("preload load_winter_cats_once failed: %s", e)
-        cats = []
-
-    _WINTER_CATS_CACHE["data"] = cats
-    _WINTER_CATS_CACHE["ts"] = time.time()
-    _WINTER_CATS_CACHE["static"] = True
-    logger.info("winter_cats preloaded: %d items", len(cats))
-    return cats
+    return WINTER_CATS.get() or []
 
 def get_winter_cats_cached():
     """
-    Возвращает kэш каталога котов.
-    - Если load_winter_cats_once() был вызван (static=True), возвращаем всегда один и тот же кэш.
-    - Иначе — обычный TTL-based кэш (CATS_TTL).
+    Возвращает кэш каталога котов (WINTER_CATS). При ошибке чтения — прошлый список (или пустой).
     (Функция совместима с существующим кодом.)
     """
-    now = time.time()
-    if _WINTER_CATS_CACHE["data"] is not None:
-        # если поставлен static — сразу вернуть (не дергаем sheets)
-        if _WINTER_CATS_CACHE.get("static"):
-            return _WINTER_CATS_CACHE["data"]
-        # иначе — проверяем TTL
-        if (now - _WINTER_CATS_CACHE["ts"]) < CATS_TTL:
-            return _WINTER_CATS_CACHE["data"]
-
-    # загрузим свежие записи
-    try:
-        s = sheet_winter_cats()
-        records = s.get_all_records()
-        cats = clean_cat_records(records)
-    except Exception as e:
-        logger.exception("Ошибка чтения winter_cats (get_winter_cats_cached): %s", e)
-        # если кэш уже есть — вернём его, иначе пустой список
-        return _WINTER_CATS_CACHE["data"] or []
-
-    _WINTER_CATS_CACHE["data"] = cats
-    _WINTER_CATS_CACHE["ts"] = now
-    return cats
+    return WINTER_CATS.get() or []
 
 # --- Leaderboard (async) cache ---
+def _load_winter_leader(_key=None):
+    s_top = sheet_winter_leader()
+    return s_top.get_all_records() if s_top else []
+
+
+WINTER_LEADER = ttl_cache.TTLCache("winter_leader", _load_winter_leader, ttl=_WINTER_LEADER_TTL, default=[],
+                                   description="лист winter_top")
+
+
 async def get_winter_leader_cached():
     """
     Возвращает список записей winter_top c кешем 60s.
     """
-    now = time.time()
-    if _WINTER_LEADER_CACHE["data"] is not None and (now - _WINTER_LEADER_CACHE["ts"]) < _WINTER_LEADER_TTL:
-        return _WINTER_LEADER_CACHE["data"]
-
-    async with _winter_leader_lock:
-        now = time.time()
-        if _WINTER_LEADER_CACHE["data"] is not None and (now - _WINTER_LEADER_CACHE["ts"]) < _WINTER_LEADER_TTL:
-            return _WINTER_LEADER_CACHE["data"]
+    return await WINTER_LEADER.aget() or []
+
+# --- Shop rows ---
+def _parse_shop_row(r):
+    item = {k: (r.get(k) if r.get(k) is not None else "") for k in r.keys()}
+    try:
+        item["PRICE"] = int(r.get("PRICE") or 0)
+    except Exception:
+        item["PRICE"] = 0
+    try:
+        item["SPINS"] = int(r.get("SPINS") or 0)
+    except Exception:
+        item["SPINS"] = 0
+    try:
+        item["LUCK"] = int(r.get("LUCK") or 0)
+    except Exception:
+        item["LUCK"] = 0
+    q = r.get("QUANTITY")
+    if q is None or str(q).strip() == "":
+        item["QUANTITY"] = None
+    else:
         try:
-            s_top = sheet_winter_leader()
-            records = s_top.get_all_records() if s_top else []
-        except Exception as e:
-            logger.warning("Ошибка при чтении winter_top: %s", e)
-            records = []
-        _WINTER_LEADER_CACHE["data"] = records
-        _WINTER_LEADER_CACHE["ts"] = time.time()
-        return records
+            item["QUANTITY"] = int(q)
+        except Exception:
+            item["QUANTITY"] = None
+    return item
 
-# --- Shop cache (sync) ---
-def load_shop_items():
+# --- Shop inventory (in-memory остатки) ---
+
+class ShopInventory:
     """
-    Кеширующая оболочка вокруг чтения winter_shop.
-    TTL = _WINTER_SHOP_TTL (5 минут).
-    (Совместима с существующими вызовами load_shop_items() в коде.)
+    Остатки магазина в памяти процесса: ITEM_ID -> QUANTITY (None — без ограничения).
+    - reserve() атомарно проверяет и резервирует единицу товара — два покупателя
+      не могут одновременно забрать последнюю штуку;
+    - commit() подтверждает резерв и ставит новое значение в очередь на запись;
+    - rollback() возвращает единицу, если покупка не состоялась;
+    - изменения пишутся в winter_shop одним batch_update раз в SHOP_FLUSH_DELAY секунд,
+      строка каждого товара известна из индекса, построенного при загрузке;
+    - пока запись идёт, позиции числятся «в записи» (_inflight): load() из другого потока
+      не перетирает их старым значением из листа; при ошибке записи они возвращаются в _dirty.
     """
-    now = time.time()
-    if _WINTER_SHOP_CACHE["data"] is not None and (now - _WINTER_SHOP_CACHE["ts"]) < _WINTER_SHOP_TTL:
-        return _WINTER_SHOP_CACHE["data"]
 
-    # старый код чтения таблицы (минорные правки: конвертации как в оригинале)
-    try:
-        s = sheet_winter_shop()
-        rows = s.get_all_records()
-        items = []
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stock = {}      # item_id -> int | None
+        self._rows = {}       # item_id -> номер строки в листе
+        self._reserved = {}   # item_id -> количество незавершённых резервов
+        self._dirty = set()   # item_id, которые нужно записать в таблицу
+        self._inflight = set()  # item_id, запись которых уже отправлена, но ещё не подтверждена
+        self._qty_col = None
+        self._ts = 0
+        self._flush_task = None
+
+    @staticmethod
+    def _parse_qty(q):
+        if q is None or str(q).strip() == "":
+            return None
+        try:
+            return int(q)
+        except Exception:
+            return None
+
+    def load(self, rows=None, qty_col=None):
+        """
+        (Пере)строить индекс из записей листа (rows — результат get_all_records).
+        Несохранённые, записываемые и зарезервированные позиции сохраняют значение из памяти.
+        """
+        if rows is None or qty_col is None:
+            self.flush()
+            s = sheet_winter_shop()
+            if rows is None:
+                rows = s.get_all_records()
+            qty_col = column_letter_by_name(s, "QUANTITY")
+        with self._lock:
+            stock, index = {}, {}
+            for row_idx, r in enumerate(rows, start=2):
+                iid = str(r.get("ITEM_ID") or "").strip()
+                if not iid:
+                    continue
+                index[iid] = row_idx
+                if (iid in self._dirty or iid in self._inflight or self._reserved.get(iid)) and iid in self._stock:
+                    stock[iid] = self._stock[iid]
+                else:
+                    stock[iid] = self._parse_qty(r.get("QUANTITY"))
+            self._stock = stock
+            self._rows = index
+            self._qty_col = qty_col
+            self._ts = time.time()
+
+    @property
+    def loaded(self):
+        return bool(self._ts)
+
+    def known(self, item_id):
+        """Товар есть в загруженных остатках (False и при неудачной загрузке)."""
+        return str(item_id) in self._stock
+
+    def ensure_loaded(self, item_id=None, max_age=_WINTER_SHOP_TTL):
+        """Блокирующая (чтение листа) — из async-кода вызывать через run_in_executor."""
+        item_id = str(item_id) if item_id is not None else None
+        stale = not self._ts or (time.time() - self._ts) >= max_age
+        if stale or (item_id is not None and item_id not in self._stock):
+            self.load()
+
+    def available(self, item_id):
+        """Текущий остаток (None — без ограничения или товар неизвестен)."""
+        return self._stock.get(str(item_id))
+
+    def reserve(self, item_id):
+        """
+        Проверить и зарезервировать одну единицу. False — товар закончился или неизвестен
+        (остатки не загрузились — отличать через known()).
+        """
+        item_id = str(item_id)
+        with self._lock:
+            if item_id not in self._stock:
+                return False
+            q = self._stock[item_id]
+            if q is not None:
+                if q <= 0:
+                    return False
+                self._stock[item_id] = q - 1
+            self._reserved[item_id] = self._reserved.get(item_id, 0) + 1
+            return True
+
+    def commit(self, item_id):
+        item_id = str(item_id)
+        with self._lock:
+            self._reserved[item_id] = max(0, self._reserved.get(item_id, 0) - 1)
+            if self._stock.get(item_id) is not None:
+                self._dirty.add(item_id)
+        if item_id in self._dirty:
+            self.schedule_flush()
+
+    def rollback(self, item_id):
+        item_id = str(item_id)
+        with self._lock:
+            if self._reserved.get(item_id, 0) <= 0:
+                return
+            self._reserved[item_id] -= 1
+            if self._stock.get(item_id) is not None:
+                self._stock[item_id] += 1
+
+    def flush(self):
+        """Записать накопленные изменения остатков одним batch_update. Возвращает число ячеек."""
+        with self._lock:
+            if not self._dirty or not self._qty_col:
+                return 0
+            pending = set(self._dirty)
+            data = [
+                {"range": f"{self._qty_col}{self._rows[iid]}", "values": [[self._stock[iid]]]}
+                for iid in pending
+                if iid in self._rows and self._stock.get(iid) is not None
+            ]
+            self._dirty.clear()
+            self._inflight |= pending
+        if not data:
+            with self._lock:
+                self._inflight -= pending
+            return 0
+        try:
+            sheet_winter_shop().batch_update(data)
+        except Exception:
+            logger.exception("Не удалось записать остатки магазина")
+            with self._lock:
+                self._inflight -= pending
+                self._dirty |= pending
+            return 0
+        with self._lock:
+            self._inflight -= pending
+        logger.info("winter_shop: записано остатков: %d", len(data))
+        return len(data)
+
+    def schedule_flush(self, delay=None):
+        """Отложенная запись: все покупки за delay секунд уходят одним запросом."""
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        delay = SHOP_FLUSH_DELAY if delay is None else delay
+
+        async def _flush_later():
+            await asyncio.sleep(delay)
+            loop = asyncio.get_running_loop()
+            while self._dirty:
+                written = await loop.run_in_executor(None, self.flush)
+                if not written and self._dirty:
+                    # запись не удалась — повторим позже
+                    await asyncio.sleep(delay)
+
+        try:
+            self._flush_task = asyncio.get_running_loop().create_task(_flush_later())
+        except RuntimeError:
+            # нет запущенного event loop — пишем сразу
+            self.flush()
+
+
+SHOP_INVENTORY = ShopInventory()
+
+# --- Shop catalog (индекс по ITEM_ID + готовые карточки товаров) ---
+
+class ShopItemView:
+    """Заранее собранное представление товара: текст описания, клавиатура, картинка."""
+
+    def __init__(self, item):
+        item_id = item.get("ITEM_ID")
+        text_lines = []
+        text_lines.append(f"Описание товара")
+        desc = item.get("DESCRIPTION") or ""
+        if desc:
+            text_lines.append(desc)
+        text_lines.append(f"Тип: {item.get('TYPE')}, Редкость: {item.get('RARITY') or '-'}")
+        text_lines.append(f"Цена: {item.get('PRICE')} ✨")
+        if item.get("SPINS"):
+            text_lines.append(f"Даёт спинов: {item.get('SPINS')}")
+        if item.get("CARD_ID"):
+            text_lines.append(f"Карточка: #{item.get('CARD_ID')}")
+        self.text = "\n".join(text_lines)
+        self.image = item.get("IMAGE_URL") or ""
+        self.markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Купить", callback_data=f"winter_shop_buy:{item_id}")],
+            [InlineKeyboardButton("⬅️ В магазин", callback_data="winter_shop"), InlineKeyboardButton("⬅️ Назад", callback_data="winter_main")]
+        ])
+        self.buy_text = f"Подтвердите покупку: {item.get('NAME')} — {item.get('PRICE', 0)} ✨"
+        self.buy_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Купить", callback_data=f"winter_shop_confirm:{item_id}")],
+            [InlineKeyboardButton("❌ Отмена", callback_data=f"winter_shop_show:{item_id}")]
+        ])
+
+    def render_text(self, quantity=None):
+        """Текст товара; остаток подставляется на момент показа (он меняется чаще каталога)."""
+        if quantity is None:
+            return self.text
+        return f"{self.text}\nОстаток: {quantity}"
+
+
+class _ShopSnapshot:
+    """Одно чтение листа winter_shop: товары, индекс, карточки, меню и буква колонки QUANTITY."""
+    __slots__ = ("items", "by_id", "views", "menu_markup", "qty_col", "fingerprint")
+
+    def __init__(self, items=(), by_id=None, views=None, menu_markup=None, qty_col=None, fingerprint=None):
+        self.items = tuple(items)
+        self.by_id = by_id or {}
+        self.views = views or {}
+        self.menu_markup = menu_markup or InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="winter_main")]])
+        self.qty_col = qty_col
+        self.fingerprint = fingerprint
+
+
+class ShopCatalog:
+    """
+    Каталог winter_shop: товары в порядке листа, индекс по ITEM_ID,
+    готовые ShopItemView и клавиатура меню магазина.
+    Значение кэша — неизменяемый снимок (_ShopSnapshot); поля каталога читаются через self._cache.get(),
+    так что все читатели видят один и тот же снимок, а ошибка чтения оставляет прошлый.
+    Лист перечитывается не чаще _WINTER_SHOP_TTL; представления пересобираются
+    только если содержимое листа (без QUANTITY) действительно изменилось.
+    Остатки из того же чтения передаются в SHOP_INVENTORY.
+    """
+
+    def __init__(self):
+        self._cache = ttl_cache.TTLCache("shop_catalog", self._load, ttl=_WINTER_SHOP_TTL, default=_ShopSnapshot(),
+                                         description="лист winter_shop: товары + остатки SHOP_INVENTORY")
+
+    @staticmethod
+    def _fingerprint_rows(rows):
+        return hash(tuple(
+            tuple((k, str(v)) for k, v in r.items() if str(k).strip().upper() != "QUANTITY")
+            for r in rows
+        ))
+
+    @staticmethod
+    def _build(rows, qty_col, fingerprint):
+        items, by_id, views = [], {}, {}
         for r in rows:
-            item = {k: (r.get(k) if r.get(k) is not None else "") for k in r.keys()}
-            try:
-                item["PRICE"] = int(r.get("PRICE") or 0)
-            except Exception:
-                item["PRICE"] = 0
-            try:
-                item["SPINS"] = int(r.get("SPINS") or 0)
-            except Exception:
-                item["SPINS"] = 0
+            item = _parse_shop_row(r)
+            iid = str(item.get("ITEM_ID") or "").strip()
+            if not iid:
+                continue
+            item["ITEM_ID"] = iid
+            items.append(item)
+            by_id[iid] = item
+            views[iid] = ShopItemView(item)
+        kb = []
+        for it in items:
+            label = f"{it.get('NAME','')} — {it.get('PRICE',0)}✨"
+            kb.append([InlineKeyboardButton(label, callback_data=f"winter_shop_show:{it['ITEM_ID']}")])
+        kb.append([InlineKeyboardButton("⬅️ Назад", callback_data="winter_main")])
+        logger.info("winter_shop catalog rebuilt: %d items", len(items))
+        return _ShopSnapshot(items, by_id, views, InlineKeyboardMarkup(kb), qty_col, fingerprint)
+
+    def snapshot(self):
+        return self._cache.get()
+
+    @property
+    def items(self):
+        return self._cache.get().items
+
+    @property
+    def by_id(self):
+        return self._cache.get().by_id
+
+    @property
+    def views(self):
+        return self._cache.get().views
+
+    @property
+    def menu_markup(self):
+        return self._cache.get().menu_markup
+
+    def refresh(self, force=False):
+        # ошибка чтения: остаётся прошлый снимок, повтор — через CACHE_ERROR_TTL (не на каждый клик)
+        if force:
+            return self._cache.reload()
+        return self._cache.get()
+
+    def _load(self, _key=None):
+        rows = sheet_winter_shop().get_all_records()
+        fp = self._fingerprint_rows(rows)
+        # буква QUANTITY — по порядку заголовков записи
+        headers = [str(k).strip().upper() for k in rows[0].keys()] if rows else []
+        qty_col = colnum_to_letter(headers.index("QUANTITY") + 1) if "QUANTITY" in headers else None
+        prev = self._cache.peek()
+        if prev is not None and prev.fingerprint == fp:
+            # цены и описания не менялись — карточки и меню прежние, меняются только остатки
+            snap = _ShopSnapshot(prev.items, prev.by_id, prev.views, prev.menu_markup, qty_col, fp)
+        else:
+            snap = self._build(rows, qty_col, fp)
+        # остатки — из того же чтения
+        if qty_col:
             try:
-                item["LUCK"] = int(r.get("LUCK") or 0)
+                SHOP_INVENTORY.load(rows, qty_col)
             except Exception:
-                item["LUCK"] = 0
-            q = r.get("QUANTITY")
-            if q is None or str(q).strip() == "":
-                item["QUANTITY"] = None
-            else:
-                try:
-                    item["QUANTITY"] = int(q)
-                except Exception:
-                    item["QUANTITY"] = None
-            items.append(item)
-    except Exception as e:
-        logger.exception("Ошибка чтения winter_shop: %s", e)
-        items = []
+                logger.exception("Не удалось обновить остатки магазина")
+        return snap
 
-    _WINTER_SHOP_CACHE["data"] = items
-    _WINTER_SHOP_CACHE["ts"] = now
-    return items
+    def get(self, item_id):
+        return self._cache.get().by_id.get(str(item_id).strip())
+
+    def view(self, item_id):
+        return self._cache.get().views.get(str(item_id).strip())
+
+
+SHOP_CATALOG = ShopCatalog()
+
+def load_shop_items():
+    """Список товаров магазина (через SHOP_CATALOG, совместимо со старыми вызовами)."""
+    return list(SHOP_CATALOG.items)
 
 # -------------------------- Advent calendar helpers --------------------------
 
-def ensure_advent_table(days_count=20):
+def _parse_advent_rows(rows):
+    table = []
+    for r in rows:
+        try:
+            spins = int(r.get("SPINS") or 0)
+        except Exception:
+            spins = 0
+        try:
+            cur = int(r.get("CURRENCY") or 0)
+        except Exception:
+            cur = 0
+        try:
+            luck = int(r.get("LUCK") or 0)
+        except Exception:
+            luck = 0
+        table.append((spins, cur, luck))
+    return table
+
+def get_advent_table(days_count=ADVENT_DAYS_DEFAULT, reload=False):
+    """
+    Таблица наград адвента: список (spins, currency, luck) по дням (индекс 0 = день 1).
+    Лист winter_advent читается один раз за ивент; повторное чтение — только reload=True.
+    Если в листе меньше days_count дней — недостающие дописываются одним append_rows.
+    """
+    if reload:
+        return ADVENT.reload(days_count) or []
+    return ADVENT.get(days_count) or []
+
+def _load_advent_table(days_count=None):
+    days_count = days_count or ADVENT_DAYS_DEFAULT
     s = sheet_winter_advent()
     rows = s.get_all_records()
-    if len(rows) >= days_count:
-        return
-    for d in range(len(rows) + 1, days_count + 1):
-        s.append_row([d, 1, 5, 0], value_input_option="USER_ENTERED")
+    if len(rows) < days_count:
+        missing = [[d, 1, 5, 0] for d in range(len(rows) + 1, days_count + 1)]
+        s.append_rows(missing, value_input_option="USER_ENTERED")
+        rows = list(rows) + [{"DAY": m[0], "SPINS": m[1], "CURRENCY": m[2], "LUCK": m[3]} for m in missing]
+    table = _parse_advent_rows(rows)
+    logger.info("winter_advent loaded: %d days", len(table))
+    return table
+
+# ключ — days_count; без истечения (читается один раз за ивент)
+ADVENT = ttl_cache.TTLCache("advent", _load_advent_table, ttl=None, max_size=4, default=[],
+                            default_keys=(ADVENT_DAYS_DEFAULT,),
+                            description="лист winter_advent (награды по дням)")
+
+def reload_advent_table():
+    """Принудительно перечитать лист winter_advent (после правки наград в таблице)."""
+    return get_advent_table(reload=True)
+
+def ensure_advent_table(days_count=ADVENT_DAYS_DEFAULT):
+    get_advent_table(days_count=days_count)
 
 def get_advent_days_count():
-    s = sheet_winter_advent()
-    rows = s.get_all_records()
-    return len(rows)
+    return len(get_advent_table())
 
 def get_advent_reward_for_day(day_index):
-    s = sheet_winter_advent()
-    rows = s.get_all_records()
-    if 1 <= day_index <= len(rows):
-        r = rows[day_index - 1]
-        return int(r.get("SPINS") or 0), int(r.get("CURRENCY") or 0), int(r.get("LUCK") or 0)
+    table = get_advent_table()
+    if 1 <= day_index <= len(table):
+        return table[day_index - 1]
     return 0, 0, 0
 
 def _default_advent_start_end():
@@ -400,98 +742,79 @@ def _default_advent_start_end():
                 return s, date(s.year + 1, ADVENT_DEFAULT_END_MONTH, ADVENT_DEFAULT_END_DAY)
             return s, date(s.year, ADVENT_DEFAULT_END_MONTH, ADVENT_DEFAULT_END_DAY)
 
-def read_user_advent_state(s_users, row, days_count):
-    headers = s_users.row_values(1)
-    upper_headers = [h.upper() for h in headers]
-    if "ADVENT_STATE" not in upper_headers:
-        s_users.update([["ADVENT_STATE"]], f"{colnum_to_letter(len(headers)+1)}1")
-        headers = s_users.row_values(1)
-        upper_headers = [h.upper() for h in headers]
-    try:
-        row_vals = s_users.row_values(row)
-        idx = upper_headers.index('ADVENT_STATE')
-        state = row_vals[idx] if len(row_vals) > idx else ""
-    except Exception:
-        state = ""
-    if not state or len(state) < days_count:
-        state = ("w" * days_count)
-    return state
-
-def ensure_user_advent_state(s_users, row):
-    days = get_advent_days_count()
-    if days <= 0:
-        ensure_advent_table(days_count=20)
-        days = get_advent_days_count()
-
-    state = read_user_advent_state(s_users, row, days)
+def _advent_day_index(days, today=None):
+    """Номер текущего дня адвента (0 — ещё не начался, days — уже закончился)."""
     start_date, end_date = _default_advent_start_end()
-    today = datetime.utcnow().date()
-
+    if today is None:
+        today = datetime.utcnow().date()
     if today < start_date:
-        day_index = 0
-    elif today > end_date:
-        day_index = days
-    else:
-        day_index = (today - start_date).days + 1
-        if day_index < 0:
-            day_index = 0
-        if day_index > days:
-            day_index = days
-
-    new_state = list(state)
-    if len(new_state) < days:
-        new_state += ["w"] * (days - len(new_state))
-    elif len(new_state) > days:
-        new_state = new_state[:days]
+        return 0
+    if today > end_date:
+        return days
+    day_index = (today - start_date).days + 1
+    return max(0, min(day_index, days))
 
+def resolve_advent_state(record, days, today=None):
+    """
+    Вычисляет актуальную строку ADVENT_STATE за один проход по уже загруженной записи,
+    без обращений к таблице. Возвращает (new_state, stored_state).
+    Символы: 'w' — день ещё не настал, '0' — доступен, '1' — уже получен.
+    """
+    stored = str(record_get(record, "ADVENT_STATE") or "")
+    state = stored if len(stored) >= days else "w" * days
+    day_index = _advent_day_index(days, today)
+
+    new_state = []
     for i in range(days):
+        ch = state[i]
         if i < day_index:
-            if new_state[i] not in ("1", "0"):
-                new_state[i] = "0"
+            new_state.append(ch if ch in ("1", "0") else "0")
         else:
-            new_state[i] = "w"
-    new_state_str = "".join(new_state)
-    if new_state_str != state:
+            new_state.append("w")
+    return "".join(new_state), stored
+
+def ensure_user_advent_state(s_users, row, record=None):
+    """
+    Приводит ADVENT_STATE пользователя к текущей дате.
+    Пишет в таблицу только если состояние изменилось.
+    """
+    if record is None:
+        record = read_row_record(s_users, row)
+    days = get_advent_days_count()
+    new_state, stored = resolve_advent_state(record, days)
+    if new_state != stored:
         try:
-            s_users.update([[new_state_str]], f"{column_letter_by_name(s_users, 'ADVENT_STATE')}{row}")
+            update_row_fields(s_users, row, {"ADVENT_STATE": new_state})
+            record["ADVENT_STATE"] = new_state
         except Exception:
             logger.exception("Не удалось обновить ADVENT_STATE")
-    return new_state_str
+    return new_state
 
-def claim_advent_day(s_users, row, day_idx):
-    days = get_advent_days_count()
+def claim_advent_day(s_users, row, day_idx, record=None):
+    table = get_advent_table()
+    days = len(table)
     if day_idx < 1 or day_idx > days:
         return False, "Недопустимый день"
-    state = read_user_advent_state(s_users, row, days)
-    if len(state) < days:
-        state = ensure_user_advent_state(s_users, row)
+    if record is None:
+        record = read_row_record(s_users, row)
+    state, _ = resolve_advent_state(record, days)
     ch = state[day_idx - 1]
     if ch == '1':
         return False, "Уже получено"
     if ch == 'w':
         return False, "День ещё не настал"
-    spins, cur, luck_gain = get_advent_reward_for_day(day_idx)
-
-    headers = s_users.row_values(1)
-    row_vals = s_users.row_values(row)
-
-    def get_header_val(hname):
-        upper = [h.upper() for h in headers]
-        if hname.upper() in upper:
-            idx = upper.index(hname.upper())
-            return row_vals[idx] if idx < len(row_vals) else ""
-        return ""
+    spins, cur, luck_gain = table[day_idx - 1]
 
     try:
-        spins_old = int(get_header_val('WINTER_SPINS') or 0)
+        spins_old = int(record_get(record, 'WINTER_SPINS') or 0)
     except Exception:
         spins_old = 0
     try:
-        cur_old = int(get_header_val('WINTER_CURRENCY') or 0)
+        cur_old = int(record_get(record, 'WINTER_CURRENCY') or 0)
     except Exception:
         cur_old = 0
     try:
-        luck_old = int(get_header_val('LUCK_HIDDEN') or 0)
+        luck_old = int(record_get(record, 'LUCK_HIDDEN') or 0)
     except Exception:
         luck_old = 0
 
@@ -499,14 +822,16 @@ def claim_advent_day(s_users, row, day_idx):
     cur_new = cur_old + cur
     luck_new = min(MAX_LUCK, luck_old + luck_gain)
 
-    s_users.update([[spins_new]], f"{column_letter_by_name(s_users, 'WINTER_SPINS')}{row}")
-    s_users.update([[cur_new]], f"{column_letter_by_name(s_users, 'WINTER_CURRENCY')}{row}")
-    s_users.update([[luck_new]], f"{column_letter_by_name(s_users, 'LUCK_HIDDEN')}{row}")
-
     state_list = list(state)
     state_list[day_idx - 1] = '1'
     new_state = "".join(state_list)
-    s_users.update([[new_state]], f"{column_letter_by_name(s_users, 'ADVENT_STATE')}{row}")
+
+    update_row_fields(s_users, row, {
+        "WINTER_SPINS": spins_new,
+        "WINTER_CURRENCY": cur_new,
+        "LUCK_HIDDEN": luck_new,
+        "ADVENT_STATE": new_state,
+    })
 
     if spins  == 1:
         return True, f"Забрано: +{spins} спин, как-то мало, может хотя бы повезет?)"
@@ -593,8 +918,7 @@ async def send_card_message(chat_id: int, card_id, context):
     Надёжно отправляет карточку пользователю:
       - ищет карточку в кэше get_winter_cats_cached() (предпочтительно),
       - берёт url/desc/rarity,
-      - сначала пытается отправить photo(url, caption),
-      - если не получается — скачивает bytes и отправляет InputFile,
+      - отправляет фото через media.send_photo_cached (file_id из кэша -> URL -> скачанные байты),
       - если нет картинки — отправляет текст.
     """
     try:
@@ -656,57 +980,16 @@ async def send_card_message(chat_id: int, card_id, context):
     caption_lines.append(f"🆔 ID: {card_id}")
     caption = "\n".join([ln for ln in caption_lines if ln is not None]).strip()
 
-    # helper: convert google drive links to direct download if needed
-    def _convert_drive_link(u: str):
-        if not u:
-            return u
-        lu = u.lower()
-        if "drive.google.com" in lu:
-            if "/d/" in u:
-                fid = u.split("/d/")[1].split("/")[0]
-                return f"https://drive.google.com/uc?export=download&id={fid}"
-            if "id=" in u:
-                fid = u.split("id=")[1].split("&")[0]
-                return f"https://drive.google.com/uc?export=download&id={fid}"
-        return u
-
-    if url:
-        url = _convert_drive_link(url)
-
-    # Отправка: первый попытка — send_photo(url, caption) (работает если Telegram/URL поддерживается)
+    # Отправка: file_id из кэша -> URL -> скачанные байты; если картинки нет — текст
     try:
         if url:
-            # try direct send by url / file_id
-            # if url looks like a file_id (no http and short) — try as file_id
-            if (not url.lower().startswith("http")) and " " not in url and len(url) < 200:
-                try:
-                    await context.bot.send_photo(chat_id=chat_id, photo=url, caption=caption)
-                    return
-                except Exception:
-                    logger.exception("send_card_message: send_photo with file_id failed, will try to download or send link")
-            else:
-                # try send by url first (most efficient)
-                try:
-                    await context.bot.send_photo(chat_id=chat_id, photo=url, caption=caption)
-                    return
-                except Exception:
-                    logger.warning("send_card_message: send_photo by URL failed, will try download")
-                    # try download bytes
-                    try:
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(url, timeout=20) as resp:
-                                if resp.status == 200:
-                                    content = await resp.read()
-                                    if content:
-                                        bio = BytesIO(content)
-                                        bio.name = f"card_{card_id}.jpg"
-                                        bio.seek(0)
-                                        await context.bot.send_photo(chat_id=chat_id, photo=InputFile(bio, filename=bio.name), caption=caption)
-                                        return
-                                else:
-                                    logger.warning("send_card_message: download returned status %s for %s", resp.status, url)
-                    except Exception:
-                        logger.exception("send_card_message: download-bytes attempt failed")
+            sent = await media.send_photo_cached(
+                context.bot, chat_id, f"winter:{card_id}", url,
+                caption=caption, filename=f"card_{card_id}.jpg",
+            )
+            if sent is not None:
+                return
+            url = media.drive_direct_url(url)
         # если картинка не отправилась — отправим текст с (опциональной) ссылкой
         text = caption or f"Карточка ID {card_id}"
         if url:
@@ -935,15 +1218,6 @@ async def handle_winter_spin_and_send(chat_id, user_id, context: ContextTypes.DE
         logger.exception("Не удалось записать кешбек за спин")
     # --- /END кешбек ---
 
-    url = (chosen.get("url") or "").strip()
-    if "drive.google.com" in url:
-        if "/d/" in url:
-            file_id = url.split("/d/")[1].split("/")[0]
-            url = f"https://drive.google.com/uc?export=download&id={file_id}"
-        elif "id=" in url:
-            file_id = url.split("id=")[1].split("&")[0]
-            url = f"https://drive.google.com/uc?export=download&id={file_id}"
-
     rarity_label = RARITY_STYLES_WINTER.get(chosen.get("rarity"), chosen.get("rarity"))
     card_id = chosen.get("id")
     # добавляем информацию о кешбеке в подпись
@@ -954,55 +1228,28 @@ async def handle_winter_spin_and_send(chat_id, user_id, context: ContextTypes.DE
         f"❄️ За эту карточку: +{gained} ❄️\n\n"
     )
 
+    # спин и кешбек уже записаны — ошибка отправки не должна оставить пользователя без карточки
     try:
-        await context.bot.send_photo(chat_id=chat_id, photo=url, caption=caption)
-    except Exception as e:
-        logger.warning("winter send_photo failed: %s; trying to download and send bytes", e)
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, timeout=15) as resp:
-                    if resp.status != 200:
-                        raise Exception(f"HTTP {resp.status}")
-                    content = await resp.read()
-            bio = BytesIO(content)
-            bio.name = f"winter_cat_{chosen.get('id')}.jpg"
-            await context.bot.send_photo(chat_id=chat_id, photo=bio, caption=caption)
-        except Exception as e2:
-            logger.exception("Не удалось скачать/отправить winter картинку: %s", e2)
-            await context.bot.send_message(chat_id=chat_id, text="(Не удалось отправить изображение)\n" + caption)
+        sent = await media.send_photo_cached(
+            context.bot, chat_id, f"winter:{card_id}", chosen.get("url") or "",
+            caption=caption, filename=f"winter_cat_{card_id}.jpg",
+        )
+    except TimedOut:
+        # фото могло дойти — подпись текстом не дублируем
+        logger.warning("Таймаут отправки winter картинки %s", card_id)
+        await context.bot.send_message(chat_id=chat_id, text="⏳ Telegram не ответил вовремя. Карточка засчитана, "
+                                                              "картинка может прийти с задержкой.")
+        return
+    except Exception:
+        logger.exception("Ошибка отправки winter картинки %s", card_id)
+        sent = None
+    if sent is None:
+        logger.error("Не удалось отправить winter картинку %s", card_id)
+        await context.bot.send_message(chat_id=chat_id, text="(Не удалось отправить изображение)\n" + caption)
 
 
 # -------------------------- Shop / Daily claim --------------------------
 
-def load_shop_items():
-    s = sheet_winter_shop()
-    rows = s.get_all_records()
-    items = []
-    for r in rows:
-        item = {k: (r.get(k) if r.get(k) is not None else "") for k in r.keys()}
-        try:
-            item["PRICE"] = int(r.get("PRICE") or 0)
-        except Exception:
-            item["PRICE"] = 0
-        try:
-            item["SPINS"] = int(r.get("SPINS") or 0)
-        except Exception:
-            item["SPINS"] = 0
-        try:
-            item["LUCK"] = int(r.get("LUCK") or 0)
-        except Exception:
-            item["LUCK"] = 0
-        q = r.get("QUANTITY")
-        if q is None or str(q).strip() == "":
-            item["QUANTITY"] = None
-        else:
-            try:
-                item["QUANTITY"] = int(q)
-            except Exception:
-                item["QUANTITY"] = None
-        items.append(item)
-    return items
-
 # --- Заменить существующую функцию winter_shop_menu на эту ---
 async def winter_shop_menu(query, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
@@ -1012,16 +1259,8 @@ async def winter_shop_menu(query, context: ContextTypes.DEFAULT_TYPE):
         create_new_winter_user(s_users, user_id)
         row, record = find_winter_user_row(s_users, user_id)
 
-    items = load_shop_items()
-    kb = []
-    for it in items:
-        label = f"{it.get('NAME','')} — {it.get('PRICE',0)}✨"
-        cb = f"winter_shop_show:{it.get('ITEM_ID')}"
-        kb.append([InlineKeyboardButton(label, callback_data=cb)])
-    kb.append([InlineKeyboardButton("⬅️ Назад", callback_data="winter_main")])
-
     text = "🏪 Магазин — выберите позицию для подробностей:"
-    markup = InlineKeyboardMarkup(kb)
+    markup = SHOP_CATALOG.menu_markup
 
     msg = query.message
     try:
@@ -1058,43 +1297,33 @@ async def winter_shop_show(query, context: ContextTypes.DEFAULT_TYPE, item_id=No
             await query.answer()
             return
 
-    items = load_shop_items()
-    item = next((it for it in items if str(it.get("ITEM_ID")) == str(item_id)), None)
-    if item is None:
+    view = SHOP_CATALOG.view(item_id)
+    if view is None:
         await query.answer("Товар не найден", show_alert=True)
         return
 
-    text_lines = []
-    text_lines.append(f"Описание товара")
-    desc = item.get("DESCRIPTION") or ""
-    if desc:
-        text_lines.append(desc)
-    text_lines.append(f"Тип: {item.get('TYPE')}, Редкость: {item.get('RARITY') or '-'}")
-    text_lines.append(f"Цена: {item.get('PRICE')} ✨")
-    if item.get("SPINS"):
-        text_lines.append(f"Даёт спинов: {item.get('SPINS')}")
-    if item.get("CARD_ID"):
-        text_lines.append(f"Карточка: #{item.get('CARD_ID')}")
-    if item.get("QUANTITY") is not None:
-        text_lines.append(f"Остаток: {item.get('QUANTITY')}")
-    image = item.get("IMAGE_URL") or ""
-    full_text = "\n".join(text_lines)
-
-    kb = [
-        [InlineKeyboardButton("Купить", callback_data=f"winter_shop_buy:{item_id}")],
-        [InlineKeyboardButton("⬅️ В магазин", callback_data="winter_shop"), InlineKeyboardButton("⬅️ Назад", callback_data="winter_main")]
-    ]
+    quantity = SHOP_INVENTORY.available(item_id)
+    if quantity is None:
+        item = SHOP_CATALOG.get(item_id)
+        quantity = item.get("QUANTITY") if item else None
+    full_text = view.render_text(quantity)
+    image = view.image
+    markup = view.markup
 
     try:
         if image:
             # отправляем новое сообщение с фотографией (и клавиатурой). 
             # reply_photo создаст отдельный message — исходное меню удалим.
             try:
-                sent = await query.message.reply_photo(photo=image, caption=full_text, reply_markup=InlineKeyboardMarkup(kb))
+                sent = await media.send_photo_cached(
+                    context.bot, query.message.chat_id, f"shop:{item_id}", image,
+                    caption=full_text, reply_markup=markup, filename=f"shop_{item_id}.jpg",
+                )
             except Exception:
-                # если reply_photo провалился (часто из-за URL) — попробуем как обычный text fallback
                 sent = None
-                raise
+            if sent is None:
+                # если фото не отправилось ни одним способом — попробуем как обычный text fallback
+                raise RuntimeError("shop image send failed")
 
             # удаляем исходное сообщение (чтобы не осталось "меню" под картинкой)
             try:
@@ -1110,11 +1339,11 @@ async def winter_shop_show(query, context: ContextTypes.DEFAULT_TYPE, item_id=No
 
     # fallback: показываем как текст (без фото)
     try:
-        await safe_edit_message(query.message, full_text, reply_markup=InlineKeyboardMarkup(kb))
+        await safe_edit_message(query.message, full_text, reply_markup=markup)
     except Exception:
         # последний вариант — просто отправим новое сообщение с текстом
         try:
-            await context.bot.send_message(chat_id=query.message.chat_id, text=full_text, reply_markup=InlineKeyboardMarkup(kb))
+            await context.bot.send_message(chat_id=query.message.chat_id, text=full_text, reply_markup=markup)
             try:
                 await query.message.delete()
             except Exception:
@@ -1123,55 +1352,6 @@ async def winter_shop_show(query, context: ContextTypes.DEFAULT_TYPE, item_id=No
             logger.exception("winter_shop_show: не удалось показать товар ни одним способом")
 
 
-async def winter_shop_show(query, context: ContextTypes.DEFAULT_TYPE, item_id=None):
-    data = query.data or ""
-    if item_id is None:
-        try:
-            item_id = data.split(":", 1)[1]
-        except Exception:
-            await query.answer()
-            return
-
-    items = load_shop_items()
-    item = next((it for it in items if str(it.get("ITEM_ID")) == str(item_id)), None)
-    if item is None:
-        await query.answer("Товар не найден", show_alert=True)
-        return
-
-    text_lines = []
-    text_lines.append(f"Описание товара")
-    desc = item.get("DESCRIPTION") or ""
-    if desc:
-        text_lines.append(desc)
-    text_lines.append(f"Тип: {item.get('TYPE')}, Редкость: {item.get('RARITY') or '-'}")
-    text_lines.append(f"Цена: {item.get('PRICE')} ✨")
-    if item.get("SPINS"):
-        text_lines.append(f"Даёт спинов: {item.get('SPINS')}")
-    if item.get("CARD_ID"):
-        text_lines.append(f"Карточка: #{item.get('CARD_ID')}")
-    if item.get("QUANTITY") is not None:
-        text_lines.append(f"Остаток: {item.get('QUANTITY')}")
-    image = item.get("IMAGE_URL") or ""
-    full_text = "\n".join(text_lines)
-
-    kb = [
-        [InlineKeyboardButton("Купить", callback_data=f"winter_shop_buy:{item_id}")],
-        [InlineKeyboardButton("⬅️ В магазин", callback_data="winter_shop"), InlineKeyboardButton("⬅️ Назад", callback_data="winter_main")]
-    ]
-
-    try:
-        if image:
-            await query.message.reply_photo(photo=image, caption=full_text, reply_markup=InlineKeyboardMarkup(kb))
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            return
-    except Exception:
-        pass
-
-    await query.message.edit_text(full_text, reply_markup=InlineKeyboardMarkup(kb))
-
 async def winter_shop_buy(query, context: ContextTypes.DEFAULT_TYPE):
     data = query.data or ""
     try:
@@ -1179,19 +1359,12 @@ async def winter_shop_buy(query, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         await query.answer()
         return
-    items = load_shop_items()
-    item = next((it for it in items if str(it.get("ITEM_ID")) == str(item_id)), None)
-    if item is None:
+    view = SHOP_CATALOG.view(item_id)
+    if view is None:
         await query.answer("Товар не найден", show_alert=True)
         return
 
-    price = item.get("PRICE", 0)
-    text = f"Подтвердите покупку: {item.get('NAME')} — {price} ✨"
-    kb = [
-        [InlineKeyboardButton("✅ Купить", callback_data=f"winter_shop_confirm:{item_id}")],
-        [InlineKeyboardButton("❌ Отмена", callback_data=f"winter_shop_show:{item_id}")]
-    ]
-    await safe_edit_msg(query, text, InlineKeyboardMarkup(kb))
+    await safe_edit_msg(query, view.buy_text, view.buy_markup)
 
 
 async def winter_shop_confirm(query, context: ContextTypes.DEFAULT_TYPE):
@@ -1241,9 +1414,7 @@ async def winter_shop_confirm(query, context: ContextTypes.DEFAULT_TYPE):
         old_luck = 0
     existing_cards = _get_user_field("W_CATS_ID") or ""
 
-    # items и item уже у тебя ниже — оставляем
-    items = load_shop_items()
-    item = next((it for it in items if str(it.get("ITEM_ID")) == str(item_id)), None)
+    item = SHOP_CATALOG.get(item_id)
     if item is None:
         await query.answer("Товар не найден", show_alert=True)
         return
@@ -1282,15 +1453,23 @@ async def winter_shop_confirm(query, context: ContextTypes.DEFAULT_TYPE):
             await winter_shop_show(query, context, item_id=item_id)
             return
 
-    # check quantity
-    q = item.get("QUANTITY")
-    if q is not None and q <= 0:
-        await query.answer("К сожалению, товар закончился.", show_alert=True)
+    if cur < price:
+        await query.answer("Недостаточно средств.", show_alert=True)
         await winter_shop_show(query, context, item_id=item_id)
         return
 
-    if cur < price:
-        await query.answer("Недостаточно средств.", show_alert=True)
+    # check quantity: атомарный резерв единицы товара в памяти
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, SHOP_INVENTORY.ensure_loaded, item_id)
+    except Exception:
+        logger.exception("Не удалось загрузить остатки магазина")
+    if not SHOP_INVENTORY.known(item_id):
+        # остатки не загрузились (или товара нет в листе) — это не «закончился»
+        await query.answer("Не удалось проверить остаток товара. Попробуй позже.", show_alert=True)
+        await winter_shop_show(query, context, item_id=item_id)
+        return
+    if not SHOP_INVENTORY.reserve(item_id):
+        await query.answer("К сожалению, товар закончился.", show_alert=True)
         await winter_shop_show(query, context, item_id=item_id)
         return
 
@@ -1326,6 +1505,7 @@ async def winter_shop_confirm(query, context: ContextTypes.DEFAULT_TYPE):
         s_users.update([[appended]], f"{column_letter_by_name(s_users, 'W_CATS_ID')}{row}")
     except Exception as e:
         logger.exception("Ошибка при обновлении пользователя в магазине: %s", e)
+        SHOP_INVENTORY.rollback(item_id)
         await query.answer("Ошибка базы данных. Попробуй позже.", show_alert=True)
         await winter_shop_show(query, context, item_id=item_id)
         return
@@ -1347,35 +1527,13 @@ async def winter_shop_confirm(query, context: ContextTypes.DEFAULT_TYPE):
 
             # Записываем новый FRAME_SET в таблицу
             col_fs = column_letter_by_name(s_users, "FRAME_SET")
+            # file_id рамки привязан к (FRAME_SET, слоты) — сбрасывать FRAME_FILE_ID не нужно
             s_users.update([[new_frame]], f"{col_fs}{row}", value_input_option="USER_ENTERED")
-
-            # Сбрасываем закэшированный file_id рамки (FRAME_FILE_ID) для пересоздания изображения
-            col_fid = column_letter_by_name(s_users, "FRAME_FILE_ID")
-            s_users.update([[""]], f"{col_fid}{row}", value_input_option="USER_ENTERED")
     except Exception as e:
         logger.exception("Не удалось обновить FRAME_SET после покупки: %s", e)
 
-    # decrement shop quantity if set
-    if item.get("QUANTITY") is not None:
-        try:
-            s_shop = sheet_winter_shop()
-            all_rows = s_shop.get_all_records()
-            for idx, r in enumerate(all_rows, start=2):
-                if str(r.get("ITEM_ID")) == str(item.get("ITEM_ID")):
-                    cur_q_raw = r.get("QUANTITY")
-                    if cur_q_raw is None or str(cur_q_raw).strip() == "":
-                        # nothing to do (infinite)
-                        pass
-                    else:
-                        try:
-                            cur_q = int(cur_q_raw)
-                            new_q = max(0, cur_q - 1)
-                            s_shop.update([[new_q]], f"{column_letter_by_name(s_shop, 'QUANTITY')}{idx}")
-                        except Exception:
-                            logger.exception("Не удалось уменьшить QUANTITY товара")
-                    break
-        except Exception:
-            logger.exception("Ошибка при уменьшении количества товара")
+    # подтверждаем резерв — остаток уйдёт в winter_shop пакетной записью
+    SHOP_INVENTORY.commit(item_id)
 
     # success — формируем текст для подтверждения
     text = f"Покупка успешна: {item.get('NAME')} — списано {price}✨"
@@ -1432,14 +1590,13 @@ async def winter_advent_menu(query, context: ContextTypes.DEFAULT_TYPE):
         create_new_winter_user(s_users, user_id)
         row, record = find_winter_user_row(s_users, user_id)
 
-    ensure_advent_table(days_count=20)
-    ensure_user_advent_state(s_users, row)
-    days = get_advent_days_count()
-    state = read_user_advent_state(s_users, row, days)
+    # таблица наград — из кэша, состояние — из уже прочитанной записи (запись только при изменении)
+    state = ensure_user_advent_state(s_users, row, record=record)
+    days = len(state)
+    start_date, _ = _default_advent_start_end()
 
     # helper: date for index
     def _advent_date_for_index(idx):
-        start_date, _ = _default_advent_start_end()
         return start_date + timedelta(days=idx)
 
     kb = []
@@ -1493,7 +1650,7 @@ async def winter_advent_claim_callback(update: Update, context: ContextTypes.DEF
     if record is None:
         await query.answer("Сначала /start, пожалуйста.", show_alert=True)
         return
-    success, msg = claim_advent_day(s_users, row, day)
+    success, msg = claim_advent_day(s_users, row, day, record=record)
     if success:
         await query.message.edit_text("🎉 " + msg, reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("⬅️ Назад", callback_data="winter_advent")]
@@ -4,12 +4,11 @@ from io import BytesIO
 from typing import List, Tuple
 from telegram import InputFile, InputMediaPhoto
 import asyncio
+import hashlib
+from collections import OrderedDict
 from typing import Optional
 import os
 
-
-import requests
-from PIL import Image, ImageOps
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -24,40 +23,19 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
+from telegram.error import BadRequest
 
 import winter  # ваш модуль для работы с winter sheets
+import media
+import frame_render
 
 logger = logging.getLogger(__name__)
-FRAME_DEBUG = False
-
-# ------------------ Настройки рамки (настройте под себя) ------------------
-BG_WIDTH = 1280
-BG_HEIGHT = 800
-
-# Словарь слотов рамки для каждого фона
-FRAME_SLOTS = {
-    10: [  # фон 10
-        {"x":  83, "y": 102, "w": 237, "h": 268},
-        {"x": 405, "y": 102, "w": 238, "h": 268},
-        {"x": 718, "y": 102, "w": 239, "h": 268},
-        {"x": 236, "y": 458, "w": 235, "h": 268},
-        {"x": 554, "y": 458, "w": 235, "h": 268},
-    ],
-    11: [  # фон 11 (замените на реальные координаты)
-        {"x":  83, "y": 102, "w": 237, "h": 268},
-        {"x": 405, "y": 102, "w": 238, "h": 268},
-        {"x": 718, "y": 102, "w": 239, "h": 268},
-        {"x": 236, "y": 458, "w": 235, "h": 268},
-        {"x": 554, "y": 458, "w": 235, "h": 268},
-    ],
-    12: [  # фон 12
-        {"x":  95, "y": 102, "w": 236, "h": 268},
-        {"x": 416, "y": 102, "w": 238, "h": 268},
-        {"x": 728, "y": 102, "w": 238, "h": 268},
-        {"x": 245, "y": 457, "w": 238, "h": 269},
-        {"x": 564, "y": 457, "w": 235, "h": 269},
-    ],
-}
+FRAME_DEBUG = frame_render.FRAME_DEBUG
+
+# Геометрия рамки живёт в frame_render (его импортируют и воркеры рендера)
+BG_WIDTH = frame_render.BG_WIDTH
+BG_HEIGHT = frame_render.BG_HEIGHT
+FRAME_SLOTS = frame_render.FRAME_SLOTS
 FRAME_SEP = " | "
 
 # ------------------ Вспомогательные функции для работы с таблицей ------------------
@@ -66,179 +44,228 @@ def _ensure_frame_column(sheet):
     return winter.column_letter_by_name(sheet, "FRAME")
 
 # ------------------ Frame cache helpers (Telegram file_id) ------------------
+# file_id рамки зависит только от содержимого: (FRAME_SET, id карточек по слотам, профиль рендера).
+# Кэш общий для всех пользователей и переживает смену слотов: вернул карточку назад или собрал
+# такую же рамку, как у другого игрока (например пустую) — картинка уже есть в Telegram.
 
-def _ensure_frame_fileid_column(sheet):
-    """
-    Убедиться, что колонка FRAME_FILE_ID существует — вернуть её букву.
-    """
-    return winter.column_letter_by_name(sheet, "FRAME_FILE_ID")
+FRAME_FILE_IDS_PATH = os.path.join(media.MEDIA_CACHE_DIR, "frame_file_ids.json")
+FRAME_FILE_IDS_MAX = int(os.environ.get("FRAME_FILE_IDS_MAX", "20000"))
+FRAME_FILE_IDS = media.FileIdCache(FRAME_FILE_IDS_PATH, max_items=FRAME_FILE_IDS_MAX)
+
+
+def frame_cache_key(spec: frame_render.FrameSpec, profile: Optional[str] = None) -> str:
+    raw = f"{spec.frame_set}|{','.join(str(int(i or 0)) for i in spec.slot_card_ids)}|{profile or frame_render.DEFAULT_PROFILE}"
+    return "frame:" + hashlib.sha1(raw.encode("utf-8")).hexdigest()
 
 
-def invalidate_user_frame_cache(s_users, row):
+def _frame_filename(buf) -> str:
+    """Имя файла для InputFile: рендер выставляет .name по профилю (frame.jpg / .webp / .png)."""
+    name = getattr(buf, "name", None)
+    return name if isinstance(name, str) and name else "frame.png"
+
+
+async def _upload_frame(context: ContextTypes.DEFAULT_TYPE, img_buf: BytesIO, caption: str) -> Optional[str]:
     """
-    Сбросить кэшированное telegram file_id для пользователя (FRAME_FILE_ID = "").
+    Загружает картинку в канал-хранилище через media.UPLOADER (пакетами, в фоне) и возвращает file_id.
     """
-    try:
-        col = _ensure_frame_fileid_column(s_users)
-        s_users.update([[""]], f"{col}{row}", value_input_option="USER_ENTERED")
-    except Exception:
-        logger.exception("invalidate_user_frame_cache failed")
+    if not media.UPLOADER.running:
+        logger.warning("media.UPLOADER не запущен; file_id рамки не будет кэшироваться.")
+        return None
+    data = img_buf.getvalue() if hasattr(img_buf, "getvalue") else bytes(img_buf)
+    return await media.UPLOADER.upload(data, _frame_filename(img_buf), caption)
+
 
+# Одновременные запросы одной и той же рамки (двойное нажатие «Показать рамку»,
+# подтверждение слота во время показа) делят один рендер и одну загрузку.
+_RENDER_FLIGHTS = media.SingleFlight()
+_UPLOAD_FLIGHTS = media.SingleFlight()
 
-async def _upload_image_and_cache_file_id(context: ContextTypes.DEFAULT_TYPE, s_users, row: int, user_id: int, img_buf: BytesIO) -> Optional[str]:
+
+async def upload_frame(context: ContextTypes.DEFAULT_TYPE, spec: frame_render.FrameSpec, profile: Optional[str] = None, user_id: Optional[int] = None) -> Tuple[Optional[str], Optional[BytesIO]]:
     """
-    Загружает BytesIO в Telegram (в ADMIN_ID) чтобы получить file_id, записывает file_id в таблицу и возвращает его.
-    Удаляет сообщение в admin-чате после загрузки.
+    Отрендерить рамку spec и загрузить в канал-хранилище ради file_id (не отправляя пользователю) —
+    одна операция на одинаковое содержимое.
+    Полученный file_id запоминается в FRAME_FILE_IDS.
+    Возвращает (file_id | None, картинка | None); картинка — собственный BytesIO вызывающего.
     """
-    try:
-        admin_chat = getattr(winter, "ADMIN_ID", None)
-        if not admin_chat:
-            logger.warning("ADMIN_ID не настроен в winter модуле; file_id не будет кэшироваться.")
-            return None
-        # обязательно rewind
-        if hasattr(img_buf, "seek"):
-            img_buf.seek(0)
-
-        # отправляем в админ-чат (чтобы получить file_id), потом удаляем сообщение
-        sent = await context.bot.send_photo(chat_id=admin_chat, photo=InputFile(img_buf, filename="frame.png"), caption=f"cache frame {user_id}")
-        # получаем file_id
-        fid = None
-        try:
-            if getattr(sent, "photo", None):
-                fid = sent.photo[-1].file_id
-            elif getattr(sent, "document", None):
-                fid = sent.document.file_id
-        except Exception:
-            logger.exception("Не удалось прочитать file_id из ответа send_photo")
-            fid = None
+    key = frame_cache_key(spec, profile)
 
-        # удаляем сообщение-источник (чтобы не мусорить в админ-чате)
+    async def _do():
+        out = await render_frame(spec, profile, user_id)
         try:
-            await context.bot.delete_message(chat_id=admin_chat, message_id=sent.message_id)
+            fid = await _upload_frame(context, out, f"cache frame {spec.frame_set}:{','.join(map(str, spec.slot_card_ids))}")
         except Exception:
-            pass
-
-        # записываем в таблицу
+            logger.exception("Не удалось загрузить рамку ради file_id")
+            fid = None
         if fid:
-            try:
-                col = _ensure_frame_fileid_column(s_users)
-                s_users.update([[fid]], f"{col}{row}", value_input_option="USER_ENTERED")
-            except Exception:
-                logger.exception("Не удалось записать FRAME_FILE_ID в таблицу")
-            return fid
-    except Exception:
-        logger.exception("_upload_image_and_cache_file_id failed")
-    return None
+            FRAME_FILE_IDS.remember(key, None, fid, media.METHOD_BYTES)
+        return fid, out.getvalue(), out.name
+
+    fid, data, name = await _UPLOAD_FLIGHTS.do(key, _do)
+    return fid, _frame_buffer(data, name)
 
 
-async def get_or_create_cached_frame_file_id(context: ContextTypes.DEFAULT_TYPE, s_users, row: int, user_id: int, generate_fn) -> Optional[str]:
+async def get_or_create_cached_frame_file_id(context: ContextTypes.DEFAULT_TYPE, spec: frame_render.FrameSpec, profile: Optional[str] = None) -> Optional[str]:
     """
-    Если в таблице уже есть FRAME_FILE_ID — вернуть его.
-    Иначе: сгенерировать изображение через generate_fn(user_id) (может быть тяжёлой операцией;
-    вызываем в executor, чтобы не блокировать loop), загрузить в Telegram, сохранить file_id в таблице и вернуть.
+    file_id рамки spec: из FRAME_FILE_IDS, иначе отрендерить и загрузить (upload_frame).
     """
-    # 1) прочитать текущий file_id (свежо)
-    try:
-        headers = s_users.row_values(1)
-        upper = [h.upper() for h in headers]
-        fid = ""
-        if "FRAME_FILE_ID" in upper:
-            idx = upper.index("FRAME_FILE_ID")
-            row_vals = s_users.row_values(row)
-            if idx < len(row_vals):
-                fid = row_vals[idx] or ""
-    except Exception:
-        logger.exception("Не удалось прочитать FRAME_FILE_ID из таблицы")
-        fid = ""
-
+    fid = FRAME_FILE_IDS.get_file_id(frame_cache_key(spec, profile))
     if fid:
         return fid
-
-    # 2) сгенерировать изображение (в executor, т.к. generate_fn может быть блокирующей)
-    try:
-        loop = asyncio.get_running_loop()
-        out = await loop.run_in_executor(None, generate_fn, user_id)  # блокирующая генерация в пуле
-        if not out:
-            logger.exception("generate_fn вернул пустой результат")
-            return None
-    except Exception:
-        logger.exception("Ошибка при генерации рамки в executor, пробуем синхронно")
-        try:
-            out = generate_fn(user_id)
-        except Exception:
-            logger.exception("Синхронная генерация тоже упала")
-            return None
-
-    # 3) загрузить и записать file_id
     try:
-        fid = await _upload_image_and_cache_file_id(context, s_users, row, user_id, out)
+        fid, _ = await upload_frame(context, spec, profile)
         return fid
     except Exception:
-        logger.exception("Ошибка при загрузке/кешировании изображения")
+        logger.exception("Ошибка при генерации рамки")
         return None
 
 
-async def send_user_frame_fast(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE, generate_fn):
+def _load_frame_user(user_id: int):
+    """Одно чтение из таблицы для показа рамки: (s_users, row, record). Блокирующая — звать в executor."""
+    s_users = winter.sheet_winter_users()
+    row, record = winter.find_winter_user_row(s_users, user_id)
+    if row is None:
+        winter.create_new_winter_user(s_users, user_id)
+        row, record = winter.find_winter_user_row(s_users, user_id)
+    return s_users, row, record
+
+
+async def send_user_frame_fast(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE, profile: Optional[str] = None):
     """
-    Удобная обёртка: пытается отправить кэшированную рамку (по file_id).
-    Если нет file_id — создаёт и кэширует, затем отправляет.
+    Удобная обёртка: читает FrameSpec пользователя и отправляет рамку по file_id из FRAME_FILE_IDS.
+    Если такой рамки ещё нет — рендерит и отправляет байты, file_id запоминается из ответа.
     Возвращает True/False.
     """
     try:
-        s_users = winter.sheet_winter_users()
-        row, _ = winter.find_winter_user_row(s_users, user_id)
-        if row is None:
-            winter.create_new_winter_user(s_users, user_id)
-            row, _ = winter.find_winter_user_row(s_users, user_id)
-
-        # попытка взять file_id из таблицы
-        headers = s_users.row_values(1)
-        upper = [h.upper() for h in headers]
-        fid = ""
-        if "FRAME_FILE_ID" in upper:
-            idx = upper.index("FRAME_FILE_ID")
-            row_vals = s_users.row_values(row)
-            if idx < len(row_vals):
-                fid = row_vals[idx] or ""
+        loop = asyncio.get_running_loop()
+        _, _, record = await loop.run_in_executor(None, _load_frame_user, user_id)
+        spec = frame_spec_from_record(record)
+        key = frame_cache_key(spec, profile)
 
+        fid = FRAME_FILE_IDS.get_file_id(key)
         if fid:
             # отправляем по file_id (быстро)
             try:
                 await context.bot.send_photo(chat_id=chat_id, photo=fid, caption="Твоя рамка:")
                 return True
-            except Exception:
-                logger.exception("Отправка по file_id не удалась — попробуем пересоздать")
-                # очистим нерабочий fid
-                try:
-                    col = _ensure_frame_fileid_column(s_users)
-                    s_users.update([[""]], f"{col}{row}", value_input_option="USER_ENTERED")
-                except Exception:
-                    logger.exception("Не удалось очистить нерабочий FRAME_FILE_ID")
-
-        # если fid нет или невалиден — создаём и кэшируем
-        fid2 = await get_or_create_cached_frame_file_id(context, s_users, row, user_id, generate_fn)
-        if fid2:
-            try:
-                await context.bot.send_photo(chat_id=chat_id, photo=fid2, caption="Твоя рамка:")
-                return True
-            except Exception:
-                logger.exception("Не удалось отправить уже закэшированную рамку")
-        # fallback: отправим напрямую BytesIO с генерацией (если всё остальное упало)
+            except BadRequest as e:
+                # забываем только file_id, который Telegram отверг; сетевые ошибки — наружу (без повторной отправки)
+                if not media.is_bad_file_id(e):
+                    raise
+                logger.warning("Отправка по file_id не удалась (%s) — пересоздаём", e)
+                FRAME_FILE_IDS.forget(key)
+
+        # если fid нет или невалиден — рендерим и отправляем пользователю байты напрямую;
+        # file_id берём из этого же сообщения (без отдельной загрузки в служебный чат)
         try:
-            loop = asyncio.get_running_loop()
-            out = await loop.run_in_executor(None, generate_fn, user_id)
-            if hasattr(out, "seek"):
-                out.seek(0)
-            await context.bot.send_photo(chat_id=chat_id, photo=InputFile(out, filename="frame.png"), caption="Твоя рамка:")
-            return True
+            out = await render_frame(spec, profile, user_id)
+            sent = await context.bot.send_photo(chat_id=chat_id, photo=InputFile(out, filename=_frame_filename(out)), caption="Твоя рамка:")
         except Exception:
-            logger.exception("Fallback: отправка напрямую bytes также не удалась")
+            logger.exception("Не удалось отрендерить/отправить рамку")
             return False
+        fid2 = media.file_id_from_message(sent)
+        if fid2:
+            FRAME_FILE_IDS.remember(key, None, fid2, media.METHOD_BYTES)
+        return True
     except Exception:
         logger.exception("send_user_frame_fast failed")
         return False
 
 
+# ------------------ Превью при подтверждении слота ------------------
+
+def candidate_frame_spec(spec: frame_render.FrameSpec, slot_index: int, card_id: int) -> frame_render.FrameSpec:
+    """FrameSpec с карточкой-кандидатом в слоте slot_index (в таблицу ничего не пишется)."""
+    ids = list(spec.slot_card_ids) + [0] * max(0, 5 - len(spec.slot_card_ids))
+    ids[slot_index] = int(card_id) if card_id else 0
+    return frame_render.FrameSpec(spec.frame_set, tuple(ids))
+
+
+async def send_frame_preview(chat_id: int, context: ContextTypes.DEFAULT_TYPE, spec: frame_render.FrameSpec, user_id: int, caption: str, reply_markup=None):
+    """
+    Отправить уменьшенное превью рамки spec (профиль preview) — для шага подтверждения слота.
+    file_id превью тоже запоминается в FRAME_FILE_IDS (повторный ввод той же карточки — без рендера).
+    Возвращает отправленное сообщение или None.
+    """
+    key = frame_cache_key(spec, "preview")
+    fid = FRAME_FILE_IDS.get_file_id(key)
+    if fid:
+        try:
+            return await context.bot.send_photo(chat_id=chat_id, photo=fid, caption=caption, reply_markup=reply_markup)
+        except BadRequest as e:
+            if not media.is_bad_file_id(e):
+                raise
+            logger.warning("Отправка превью по file_id не удалась (%s) — рендерим заново", e)
+            FRAME_FILE_IDS.forget(key)
+    try:
+        out = await render_frame(spec, "preview", user_id)
+        sent = await context.bot.send_photo(chat_id=chat_id, photo=InputFile(out, filename=_frame_filename(out)),
+                                            caption=caption, reply_markup=reply_markup)
+    except Exception:
+        logger.exception("Не удалось отрендерить/отправить превью рамки")
+        return None
+    fid2 = media.file_id_from_message(sent)
+    if fid2:
+        FRAME_FILE_IDS.remember(key, None, fid2, media.METHOD_BYTES)
+    return sent
+
+
+# прогрев полной рамки кандидата: только локальный рендер (без загрузки в Telegram — кандидат
+# может так и не быть подтверждён), с задержкой и отменой при новом вводе того же пользователя
+PREWARM_DELAY = float(os.environ.get("FRAME_PREWARM_DELAY", "1.5"))  # сек
+PREWARM_KEEP = int(os.environ.get("FRAME_PREWARM_KEEP", "64"))       # готовых рамок в памяти
+_PREWARM_TASKS = {}        # user_id -> asyncio.Task
+_PREWARMED = OrderedDict()  # (spec, profile) -> (bytes, name)
+
+
+def _take_prewarmed(key):
+    return _PREWARMED.pop(key, None)
+
+
+async def prewarm_frame(context: ContextTypes.DEFAULT_TYPE, spec: frame_render.FrameSpec, user_id: Optional[int] = None):
+    """
+    Фоновый полный рендер рамки spec, пока пользователь решает. Результат остаётся в памяти
+    (_PREWARMED): после подтверждения render_frame отдаёт его без рендера, а file_id появится
+    из отправки пользователю — в канал-хранилище ничего не загружается.
+    """
+    if FRAME_FILE_IDS.get_file_id(frame_cache_key(spec)):
+        return
+    key = (spec, frame_render.DEFAULT_PROFILE)
+    if key in _PREWARMED:
+        return
+    try:
+        out = await render_frame(spec, None, user_id)
+    except Exception:
+        logger.exception("Фоновый рендер рамки не удался")
+        return
+    _PREWARMED[key] = (out.getvalue(), out.name)
+    while len(_PREWARMED) > PREWARM_KEEP:
+        _PREWARMED.popitem(last=False)
+
+
+def schedule_prewarm(context: ContextTypes.DEFAULT_TYPE, spec: frame_render.FrameSpec, user_id: int, delay: float = None):
+    """
+    Отложенный prewarm_frame: новый ввод того же пользователя в течение delay секунд отменяет
+    предыдущий (перебор кандидатов не стоит рендера на каждую попытку).
+    """
+    delay = PREWARM_DELAY if delay is None else delay
+    old = _PREWARM_TASKS.pop(user_id, None)
+    if old is not None and not old.done():
+        old.cancel()
+
+    async def _later():
+        try:
+            await asyncio.sleep(delay)
+            await prewarm_frame(context, spec, user_id)
+        finally:
+            if _PREWARM_TASKS.get(user_id) is task:
+                _PREWARM_TASKS.pop(user_id, None)
+
+    task = context.application.create_task(_later())
+    _PREWARM_TASKS[user_id] = task
+    return task
+
+
 def _read_frame_str_from_record(record) -> str:
     frame_raw = ""
     if record:
@@ -247,14 +274,7 @@ def _read_frame_str_from_record(record) -> str:
         return FRAME_SEP.join(["0"] * 5)
     return str(frame_raw)
 
-def get_user_frame_list(user_id: int) -> Tuple[int, List[int]]:
-    s_users = winter.sheet_winter_users()
-    row, record = winter.find_winter_user_row(s_users, user_id)
-    if record is None:
-        winter.create_new_winter_user(s_users, user_id)
-        row, record = winter.find_winter_user_row(s_users, user_id)
-
-    frame_str = _read_frame_str_from_record(record)
+def _parse_frame_ids(frame_str: str) -> List[int]:
     parts = [p.strip() for p in frame_str.split("|")]
     ids = []
     for p in parts:
@@ -266,7 +286,16 @@ def get_user_frame_list(user_id: int) -> Tuple[int, List[int]]:
         ids += [0] * (5 - len(ids))
     else:
         ids = ids[:5]
-    return row, ids
+    return ids
+
+def get_user_frame_list(user_id: int) -> Tuple[int, List[int]]:
+    s_users = winter.sheet_winter_users()
+    row, record = winter.find_winter_user_row(s_users, user_id)
+    if record is None:
+        winter.create_new_winter_user(s_users, user_id)
+        row, record = winter.find_winter_user_row(s_users, user_id)
+
+    return row, _parse_frame_ids(_read_frame_str_from_record(record))
 
 def set_user_frame_slot(user_id: int, slot_index: int, card_id: int) -> bool:
     if slot_index < 0 or slot_index >= 5:
@@ -279,12 +308,8 @@ def set_user_frame_slot(user_id: int, slot_index: int, card_id: int) -> bool:
     frame_str = FRAME_SEP.join(str(i) for i in frame_ids)
     try:
         col_letter = _ensure_frame_column(s_users)
+        # file_id рамки привязан к содержимому (frame_cache_key) — инвалидировать нечего
         s_users.update([[frame_str]], f"{col_letter}{row}", value_input_option="USER_ENTERED")
-        # сразу инвалидируем кэш рамки для этого пользователя
-        try:
-            invalidate_user_frame_cache(s_users, row)
-        except Exception:
-            logger.exception("Не удалось инвалидировать кэш после set_user_frame_slot")
         return True
     except Exception as e:
         logger.exception("Не удалось записать FRAME в таблицу: %s", e)
@@ -293,228 +318,131 @@ def set_user_frame_slot(user_id: int, slot_index: int, card_id: int) -> bool:
 
 # ------------------ Генерация итоговой рамки ------------------
 
-def _drive_direct_url(url: str) -> str:
-    if not url:
-        return url
-    url = url.strip()
-    if "drive.google.com" in url:
-        try:
-            if "/d/" in url:
-                file_id = url.split("/d/")[1].split("/")[0]
-                return f"https://drive.google.com/uc?export=download&id={file_id}"
-            if "id=" in url:
-                file_id = url.split("id=")[1].split("&")[0]
-                return f"https://drive.google.com/uc?export=download&id={file_id}"
-        except Exception:
-            return url
-    return url
-
-def generate_frame_image(user_id: int) -> BytesIO:
-    """
-    Robust generation of user frame:
-    - reads FRAME_SET for user
-    - attempts to load <FRAME_SET>.png (or assets/<FRAME_SET>.png)
-    - forces background to BG_WIDTH x BG_HEIGHT using ImageOps.fit (guarantees exact size)
-    - pastes cards into slots
-    - saves a debug image next to module if FRAME_DEBUG is True
-    """
-    # info_lines собираются только если FRAME_DEBUG включён
-    info_lines = [] if FRAME_DEBUG else None
+_drive_direct_url = media.drive_direct_url
 
-    def log_info(s):
-        # Если отладка включена — записываем в info_lines и (по желанию) логируем через logger.info
-        if not FRAME_DEBUG:
-            return
+def frame_spec_from_record(record) -> frame_render.FrameSpec:
+    """FrameSpec из уже прочитанной записи пользователя (FRAME + FRAME_SET, по умолчанию 10)."""
+    frame_ids = _parse_frame_ids(_read_frame_str_from_record(record))
+    frame_set = 10
+    raw_set = str(winter.record_get(record, "FRAME_SET", "") or "").strip()
+    if raw_set:
         try:
-            logger.info(s)
+            frame_set = int(raw_set)
         except Exception:
-            pass
-        info_lines.append(str(s))
+            frame_set = 10
+    return frame_render.FrameSpec(frame_set, tuple(frame_ids))
 
-    try:
-        s_users = winter.sheet_winter_users()
-    except Exception as e:
-        logger.exception("Не удалось открыть sheet_winter_users: %s", e)
-        img_blank = Image.new("RGB", (int(BG_WIDTH), int(BG_HEIGHT)), "white")
-        buf_b = BytesIO()
-        img_blank.save(buf_b, format="PNG")
-        buf_b.seek(0)
-        return buf_b
-
-    # user row and frame ids
-    row, frame_ids = get_user_frame_list(user_id)
 
-    # read FRAME_SET (default 10)
-    frame_set = 10
-    try:
-        headers = s_users.row_values(1)
-        upper = [h.upper() for h in headers]
-        if "FRAME_SET" in upper:
-            idx = upper.index("FRAME_SET")
-            row_vals = s_users.row_values(row)
-            if idx < len(row_vals) and str(row_vals[idx]).strip():
-                try:
-                    frame_set = int(row_vals[idx])
-                except Exception:
-                    frame_set = 10
-    except Exception as e:
-        logger.exception("Ошибка чтения FRAME_SET: %s", e)
-
-    log_info(f"User {user_id} FRAME_SET = {frame_set}")
-
-    # pick slots
-    slots = FRAME_SLOTS.get(frame_set, FRAME_SLOTS.get(10))
-    log_info(f"Using {len(slots)} slots for frame {frame_set}")
-
-    # locate background file
-    bg_img = None
-    try:
-        base_dir = os.path.dirname(os.path.abspath(__file__)) or "."
-        candidates = [
-            os.path.join(base_dir, f"{frame_set}.png"),
-            os.path.join(base_dir, "assets", f"{frame_set}.png"),
-            os.path.join(base_dir, "assets", str(frame_set) + ".PNG"),
-            os.path.join(base_dir, f"{frame_set}.PNG"),
-        ]
-        found_path = None
-        for p in candidates:
-            if p and os.path.isfile(p):
-                found_path = p
-                break
-
-        if found_path:
-            log_info(f"Found background file: {found_path}")
-            bg_img = Image.open(found_path)
-            log_info(f"Original bg size: {bg_img.size}, mode={bg_img.mode}")
-            # convert to RGBA (to preserve alpha) then fit to exact size
-            try:
-                bg_img = bg_img.convert("RGBA")
-            except Exception:
-                bg_img = bg_img.convert("RGB").convert("RGBA")
-            # force-fit to exact BG_WIDTH x BG_HEIGHT (this crops/pads as needed)
-            try:
-                bg_img = ImageOps.fit(bg_img, (int(BG_WIDTH), int(BG_HEIGHT)), method=Image.LANCZOS)
-                log_info(f"Bg after fit size: {bg_img.size}")
-            except Exception as e:
-                logger.exception("ImageOps.fit failed: %s", e)
-                # fallback to simple resize
-                try:
-                    bg_img = bg_img.resize((int(BG_WIDTH), int(BG_HEIGHT)), Image.LANCZOS)
-                    log_info(f"Bg after resize size: {bg_img.size}")
-                except Exception as e2:
-                    logger.exception("Fallback resize failed: %s", e2)
-                    bg_img = None
-        else:
-            log_info(f"No background file found among candidates: {candidates}")
-    except Exception as e:
-        logger.exception("Ошибка при загрузке фона: %s", e)
-        bg_img = None
+def read_user_frame_spec(user_id: int) -> frame_render.FrameSpec:
+    """Прочитать FrameSpec пользователя из таблицы (блокирующая; одна запись пользователя)."""
+    _, _, record = _load_frame_user(user_id)
+    return frame_spec_from_record(record)
 
-    # prepare base image
-    if bg_img is None:
-        frame_img = Image.new("RGB", (int(BG_WIDTH), int(BG_HEIGHT)), "white")
-        log_info("Using white background (bg_img not found)")
-    else:
-        # if bg_img is RGBA convert to RGB on copy
-        try:
-            frame_img = bg_img.convert("RGB").copy()
-        except Exception:
-            frame_img = Image.new("RGB", (int(BG_WIDTH), int(BG_HEIGHT)), "white")
-            log_info("Failed to convert bg_img to RGB; using white fallback")
 
-    # prepare cats map
+def _frame_card_sources(frame_ids: List[int]) -> List[Optional[Tuple[str, str]]]:
+    """(ключ кэша, URL) картинки для каждого слота (None — слот пустой или карточка не найдена)."""
     cats = winter.get_winter_cats_cached() or []
     cats_map = {str(c.get("id")): c for c in cats if c.get("id") is not None}
 
-    # paste cards
-    for idx, slot in enumerate(slots):
+    sources = []
+    for card_id in frame_ids:
         try:
-            card_id = int(frame_ids[idx]) if idx < len(frame_ids) else 0
+            card_id = int(card_id)
         except Exception:
             card_id = 0
         if not card_id:
+            sources.append(None)
             continue
-
         cat_rec = cats_map.get(str(card_id))
         if not cat_rec:
             logger.warning("No cat record for id %s", card_id)
+            sources.append(None)
             continue
-
         url = (cat_rec.get("url") or "").strip()
-        if not url:
-            continue
-        url = _drive_direct_url(url)
+        sources.append((f"winter:{card_id}", _drive_direct_url(url)) if url else None)
+    return sources
 
-        try:
-            resp = requests.get(url, timeout=12)
-            resp.raise_for_status()
-            img = Image.open(BytesIO(resp.content))
-        except Exception as e:
-            logger.warning("Failed to download image %s: %s", url, e)
-            continue
 
-        try:
-            if img.mode in ("RGBA", "LA"):
-                bg = Image.new("RGBA", img.size, (255,255,255,255))
-                bg.paste(img, (0,0), img)
-                img = bg.convert("RGB")
-            else:
-                img = img.convert("RGB")
-        except Exception:
-            try:
-                img = img.convert("RGB")
-            except Exception:
-                logger.exception("Failed to convert card image %s", url)
-                continue
-
-        # slot expected as dict with x,y,w,h
-        x = int(slot.get("x", 0))
-        y = int(slot.get("y", 0))
-        w = int(slot.get("w", 0))
-        h = int(slot.get("h", 0))
-        if w <= 0 or h <= 0:
-            logger.warning("Invalid slot size for frame %s slot %s", frame_set, slot)
-            continue
+async def fetch_frame_images(frame_ids) -> List:
+    """
+    Картинки всех слотов из дискового кэша media.IMAGES (пути к файлам — воркер рендера читает их сам),
+    промахи качаются параллельно (общий пул соединений DOWNLOADS). Время ожидания сети = самая медленная карточка.
+    """
+    return await media.IMAGES.fetch_sources(_frame_card_sources(frame_ids))
 
-        try:
-            img_resized = ImageOps.fit(img, (w, h), method=Image.LANCZOS)
-        except Exception:
-            try:
-                img_resized = img.resize((w, h))
-            except Exception:
-                logger.exception("Failed to resize card img %s", url)
-                continue
 
-        try:
-            frame_img.paste(img_resized, (x, y))
-        except Exception as e:
-            logger.exception("Failed to paste card into frame: %s", e)
-            continue
+def _frame_buffer(data: bytes, name: str) -> BytesIO:
+    bio = BytesIO(data)
+    bio.name = name
+    return bio
 
-    # Save debug image and info next to module for inspection only if FRAME_DEBUG True
-    if FRAME_DEBUG:
-        try:
-            debug_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"debug_frame_{user_id}_{frame_set}.png")
-            frame_img.save(debug_name, format="PNG")
-            log_info(f"Saved debug framing image: {debug_name} size={frame_img.size}")
-            info_txt = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"debug_frame_{user_id}_{frame_set}.txt")
-            with open(info_txt, "w", encoding="utf-8") as f:
-                f.write("\n".join(info_lines or []))
-            log_info(f"Wrote debug info: {info_txt}")
-        except Exception:
-            logger.exception("Не удалось записать debug файлы")
 
-    # return bytes
-    out = BytesIO()
+# последняя отрендеренная рамка каждого пользователя — база для инкрементальной перерисовки
+LAST_FRAME_SPECS_MAX = int(os.environ.get("LAST_FRAME_SPECS_MAX", "5000"))
+_LAST_FRAME_SPECS = OrderedDict()
+
+
+def _remember_last_spec(user_id, spec: frame_render.FrameSpec):
+    _LAST_FRAME_SPECS[user_id] = spec
+    _LAST_FRAME_SPECS.move_to_end(user_id)
+    while len(_LAST_FRAME_SPECS) > LAST_FRAME_SPECS_MAX:
+        _LAST_FRAME_SPECS.popitem(last=False)
+
+
+async def render_frame(spec: frame_render.FrameSpec, profile: Optional[str] = None, user_id: Optional[int] = None) -> BytesIO:
+    """
+    Рендер рамки по FrameSpec: без Google Sheets, только каталог карточек в памяти и кэш картинок.
+    Композиция и кодирование — в пуле процессов frame_render.RENDERER, профиль — frame_render.RENDER_PROFILES.
+    Одновременные рендеры одинакового (spec, profile) выполняются один раз.
+    С user_id рендер идёт в «его» воркер, и если там ещё лежит холст прошлой рамки с тем же фоном —
+    перерисовываются только изменившиеся слоты.
+    """
+    key = (spec, profile or frame_render.DEFAULT_PROFILE)
+    ready = _take_prewarmed(key)
+    if ready is not None:
+        if user_id is not None:
+            _remember_last_spec(user_id, spec)
+        return _frame_buffer(*ready)
+    prev = _LAST_FRAME_SPECS.get(user_id) if user_id is not None else None
+    base_ids = prev.slot_card_ids if prev is not None and prev.frame_set == spec.frame_set else None
+
+    async def _do():
+        images = await fetch_frame_images(spec.slot_card_ids)
+        out = await frame_render.RENDERER.render(spec.frame_set, images, spec.slot_card_ids, profile,
+                                                 base_ids=base_ids, affinity=user_id)
+        return out.getvalue(), out.name
+
+    data, name = await _RENDER_FLIGHTS.do(key, _do)
+    if user_id is not None:
+        _remember_last_spec(user_id, spec)
+    return _frame_buffer(data, name)
+
+
+def render_frame_sync(spec: frame_render.FrameSpec, profile: Optional[str] = None) -> BytesIO:
+    """Блокирующий вариант render_frame (потоки, скрипты, бенчмарки)."""
+    images = media.IMAGES.fetch_many_sync(_frame_card_sources(spec.slot_card_ids))
+    return frame_render.compose_frame(spec.frame_set, images, card_ids=spec.slot_card_ids, profile=profile)
+
+
+async def render_frame_image(user_id: int, profile: Optional[str] = None) -> BytesIO:
+    """Рендер рамки пользователя: чтение FrameSpec из таблицы (executor) + render_frame."""
+    loop = asyncio.get_running_loop()
     try:
-        frame_img.save(out, format="PNG")
-    except Exception:
-        try:
-            frame_img.convert("RGB").save(out, format="PNG")
-        except Exception:
-            logger.exception("Не удалось сохранить итоговое изображение")
-    out.seek(0)
-    return out
+        spec = await loop.run_in_executor(None, read_user_frame_spec, user_id)
+    except Exception as e:
+        logger.exception("Не удалось прочитать рамку пользователя: %s", e)
+        spec = frame_render.FrameSpec(10, ())
+    return await render_frame(spec, profile, user_id)
+
+
+def generate_frame_image(user_id: int, profile: Optional[str] = None) -> BytesIO:
+    """Синхронный вариант render_frame_image (для вызова из потоков/скриптов)."""
+    try:
+        spec = read_user_frame_spec(user_id)
+    except Exception as e:
+        logger.exception("Не удалось прочитать рамку пользователя: %s", e)
+        spec = frame_render.FrameSpec(10, ())
+    return render_frame_sync(spec, profile)
 
 
 
@@ -693,7 +621,7 @@ async def frame_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
 
         # Попытка отправить закэшированную рамку (быстро)
         try:
-            ok = await send_user_frame_fast(chat_id, user_id, context, generate_frame_image)
+            ok = await send_user_frame_fast(chat_id, user_id, context)
             if not ok:
                 await context.bot.send_message(chat_id=chat_id, text="Ошибка при отправке рамки.")
                 # продолжаем — отправим меню ниже
@@ -701,11 +629,10 @@ async def frame_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
             logger.exception("frame_show (send_user_frame_fast) failed: %s", e)
             # fallback: старая логика — генерируем в executor и отправляем
             try:
-                loop = asyncio.get_running_loop()
-                out = await loop.run_in_executor(None, generate_frame_image, user_id)
+                out = await render_frame_image(user_id)
                 if hasattr(out, "seek"):
                     out.seek(0)
-                sent = await context.bot.send_photo(chat_id=chat_id, photo=InputFile(out, filename="frame.png"), caption="Твоя рамка:")
+                sent = await context.bot.send_photo(chat_id=chat_id, photo=InputFile(out, filename=_frame_filename(out)), caption="Твоя рамка:")
                 try:
                     context.user_data["frame_last_photo"] = (chat_id, sent.message_id if hasattr(sent, "message_id") else None)
                 except Exception:
@@ -741,11 +668,6 @@ async def frame_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         try:
             col_letter = _ensure_frame_column(s_users)
             s_users.update([[frame_str]], f"{col_letter}{row}", value_input_option="USER_ENTERED")
-            # инвалидируем cached file_id
-            try:
-                invalidate_user_frame_cache(s_users, row)
-            except Exception:
-                logger.exception("Не удалось инвалидировать кэш после очистки всех слотов")
             success = True
         except Exception as e:
             logger.exception("Не удалось записать FRAME в таблицу: %s", e)
@@ -841,17 +763,16 @@ async def frame_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
 
         # Попытка отправить закэшированную рамку (или создать и закешировать её)
         try:
-            sent_ok = await send_user_frame_fast(chat_id, user_id, context, generate_frame_image)
+            sent_ok = await send_user_frame_fast(chat_id, user_id, context)
         except Exception:
             logger.exception("send_user_frame_fast failed")
             sent_ok = False
         if not sent_ok:
             # Fallback: сгенерировать и отправить напрямую в executor, чтобы не блокировать loop
             try:
-                loop = asyncio.get_running_loop()
-                out = await loop.run_in_executor(None, generate_frame_image, user_id)
+                out = await render_frame_image(user_id)
                 if not out:
-                    raise RuntimeError("generate_frame_image вернул пустое значение")
+                    raise RuntimeError("render_frame_image вернул пустое значение")
                 # подготовка BytesIO для отправки
                 if isinstance(out, BytesIO):
                     out.seek(0)
@@ -868,7 +789,7 @@ async def frame_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
                         out.seek(0)
                         bio_upload = BytesIO(out.read())
 
-                bio_upload.name = "frame.png"
+                bio_upload.name = _frame_filename(out)
                 bio_upload.seek(0)
 
                 # попытка удалить прошлое фото (если есть)
@@ -879,7 +800,7 @@ async def frame_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
 
                 sent = await context.bot.send_photo(
                     chat_id=chat_id,
-                    photo=InputFile(bio_upload, filename="frame.png"),
+                    photo=InputFile(bio_upload, filename=bio_upload.name),
                     caption="Рамка (обновлённая):"
                 )
 
@@ -982,17 +903,36 @@ async def text_message_handler_for_frame(update: Update, context: ContextTypes.D
         [InlineKeyboardButton("❌ Отмена", callback_data="frame_cancel_input")],
     ])
 
+    try:
+        # превью всей рамки с кандидатом в выбранном слоте (уменьшенное, быстрое);
+        # полный рендер этой же рамки греется в фоне (локально, с задержкой), пока пользователь решает
+        candidate = candidate_frame_spec(frame_spec_from_record(record), slot_idx, card_id)
+        caption = f"Подтвердите установку карточки #{card_id} в слот #{slot_idx+1}:"
+        sent = await send_frame_preview(chat_id, context, candidate, user_id, caption, reply_markup=kb)
+        if sent is not None:
+            schedule_prewarm(context, candidate, user_id)
+            context.user_data["frame_confirm_msg_id"] = sent.message_id
+            try:
+                context.user_data["frame_last_photo"] = (sent.chat.id if hasattr(sent, "chat") else chat_id, sent.message_id)
+            except Exception:
+                context.user_data["frame_last_photo"] = (chat_id, sent.message_id)
+            return
+    except Exception:
+        logger.exception("Превью рамки не удалось — показываем саму карточку")
+
     try:
         cats = winter.get_winter_cats_cached() or []
         cats_map = {str(c.get("id")): c for c in cats if c.get("id") is not None}
         rec = cats_map.get(str(card_id))
         url = _drive_direct_url(rec.get("url", "")) if rec else ""
         if url:
-            sent = await update.message.reply_photo(
-                photo=url,
+            sent = await media.send_photo_cached(
+                context.bot, chat_id, f"winter:{card_id}", url,
                 caption=f"Подтвердите установку карточки #{card_id} в слот #{slot_idx+1}:",
-                reply_markup=kb
+                reply_markup=kb, filename=f"card_{card_id}.jpg",
             )
+            if sent is None:
+                raise RuntimeError("preview send failed")
             context.user_data["frame_confirm_msg_id"] = sent.message_id
             # запомним превью-фото, чтобы можно было удалить при выходе
             try: